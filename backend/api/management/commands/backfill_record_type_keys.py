@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from django.core.management.base import BaseCommand
+from boto3.dynamodb.conditions import Key
+from api.services.ddb_service import (
+    DICOM_DYNAMO_TABLE, DICOM_RECORD_TYPE_INDEX_NAME, DICOM_RECORD_TYPE_INDEX_READS, DICOM_DATA_TYPES, get_dynamodb_resource, record_type_key
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the record type GSI (with --create-index) and stamps RecordTypeKey on every "
+        "patient/study/series/instance record written before the index existed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--create-index", action="store_true", help="Add the GSI to the table if it is missing and wait for it")
+        parser.add_argument("--user-id", help="Only backfill this user's partition (a query instead of a full table scan)")
+        parser.add_argument("--workers", type=int, default=8, help="Parallel UpdateItem calls")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the records that would be updated")
+
+    def handle(self, *args, **options):
+        dynamodb = get_dynamodb_resource()
+        table = dynamodb.Table(DICOM_DYNAMO_TABLE)
+
+        if options["create_index"]:
+            self.create_index(dynamodb.meta.client)
+
+        read_kwargs = {
+            "ProjectionExpression": "#uid, #fk, #dt, #rtk",
+            "ExpressionAttributeNames": {"#uid": "UserId", "#fk": "FileKey", "#dt": "DataType", "#rtk": "RecordTypeKey"},
+        }
+        if options["user_id"]:
+            read_kwargs["KeyConditionExpression"] = Key("UserId").eq(options["user_id"])
+            read = table.query
+        else:
+            read = table.scan
+
+        scanned = 0
+        updated = 0
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as executor:
+            exclusive_start_key = None
+            while True:
+                if exclusive_start_key:
+                    response = read(**read_kwargs, ExclusiveStartKey=exclusive_start_key)
+                else:
+                    response = read(**read_kwargs)
+
+                items = response.get("Items", [])
+                scanned += len(items)
+                stale = [
+                    item for item in items
+                    if item.get("DataType") in DICOM_DATA_TYPES
+                    and item.get("RecordTypeKey") != record_type_key(item["DataType"], item["FileKey"])
+                ]
+                if not options["dry_run"]:
+                    updated += sum(executor.map(lambda item: self.stamp(table, item), stale))
+                else:
+                    updated += len(stale)
+
+                exclusive_start_key = response.get("LastEvaluatedKey")
+                if not exclusive_start_key:
+                    break
+                self.stdout.write(f"Scanned {scanned} records, {updated} {'to update' if options['dry_run'] else 'updated'} so far")
+
+        verb = "would be updated" if options["dry_run"] else "updated"
+        self.stdout.write(self.style.SUCCESS(f"Done: scanned {scanned} records, {updated} {verb}"))
+        if not options["dry_run"] and not options["user_id"] and not DICOM_RECORD_TYPE_INDEX_READS:
+            self.stdout.write("Every record is in the index now, set DICOM_RECORD_TYPE_INDEX_READS=true to read through it")
+
+    def stamp(self, table, item):
+        try:
+            table.update_item(
+                Key={"UserId": item["UserId"], "FileKey": item["FileKey"]},
+                UpdateExpression="SET RecordTypeKey = :rtk",
+                # The record may have been deleted since it was scanned, don't bring it back as a stub
+                ConditionExpression="attribute_exists(FileKey)",
+                ExpressionAttributeValues={":rtk": record_type_key(item["DataType"], item["FileKey"])},
+            )
+            return 1
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return 0
+            raise
+
+    def create_index(self, client):
+        description = client.describe_table(TableName=DICOM_DYNAMO_TABLE)["Table"]
+        existing = {index["IndexName"] for index in description.get("GlobalSecondaryIndexes", [])}
+
+        if DICOM_RECORD_TYPE_INDEX_NAME not in existing:
+            index = {
+                "IndexName": DICOM_RECORD_TYPE_INDEX_NAME,
+                "KeySchema": [
+                    {"AttributeName": "UserId", "KeyType": "HASH"},
+                    {"AttributeName": "RecordTypeKey", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            }
+            if description.get("BillingModeSummary", {}).get("BillingMode") != "PAY_PER_REQUEST":
+                throughput = description["ProvisionedThroughput"]
+                index["ProvisionedThroughput"] = {
+                    "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                    "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+                }
+
+            self.stdout.write(f"Creating index {DICOM_RECORD_TYPE_INDEX_NAME} on {DICOM_DYNAMO_TABLE}")
+            client.update_table(
+                TableName=DICOM_DYNAMO_TABLE,
+                AttributeDefinitions=[
+                    {"AttributeName": "UserId", "AttributeType": "S"},
+                    {"AttributeName": "RecordTypeKey", "AttributeType": "S"},
+                ],
+                GlobalSecondaryIndexUpdates=[{"Create": index}],
+            )
+
+        # Records can be stamped while the index builds, but reads shouldn't switch over until it is active
+        while True:
+            indexes = client.describe_table(TableName=DICOM_DYNAMO_TABLE)["Table"].get("GlobalSecondaryIndexes", [])
+            status = next((index["IndexStatus"] for index in indexes if index["IndexName"] == DICOM_RECORD_TYPE_INDEX_NAME), None)
+            if status == "ACTIVE":
+                self.stdout.write(f"Index {DICOM_RECORD_TYPE_INDEX_NAME} is active")
+                return
+            self.stdout.write(f"Waiting for index {DICOM_RECORD_TYPE_INDEX_NAME} (status: {status})")
+            time.sleep(10)
@@ -0,0 +1,318 @@
+import io
+import json
+import time
+import random
+import logging
+import platform
+import resource
+import subprocess
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from api.services import reset_clients, set_endpoint_override
+from api.services.ddb_service import DICOM_DYNAMO_TABLE, DICOM_RECORD_TYPE_INDEX_NAME, get_dicom_metadata, get_dynamodb_resource
+from api.services.s3_service import S3_BUCKET, S3_REGION, get_s3_client
+from api.services.stats_service import get_stats
+from api.views.upload import upload_dicom
+from api.views.delete import delete_data_by_file_key
+
+BENCHMARK_USER_ID = "benchmark-user"
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+ENHANCED_CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2.1"  # multi-frame
+
+
+def make_study(patient_id, slices, rows, columns, frames):
+    """One synthetic CT study (a single series) as uploadable files"""
+    study_uid = generate_uid()
+    series_uid = generate_uid()
+    sop_class_uid = ENHANCED_CT_IMAGE_STORAGE if frames > 1 else CT_IMAGE_STORAGE
+    # Noise compresses like nothing, which is closer to real pixel data than a constant
+    pixel_data = random.randbytes(rows * columns * 2 * frames)
+
+    files = []
+    for i in range(slices):
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        file_meta.MediaStorageSOPClassUID = sop_class_uid
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = sop_class_uid
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID = patient_id
+        ds.PatientName = f"Benchmark^{patient_id}"
+        ds.PatientSex = "O"
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.StudyDate = "20250101"
+        ds.StudyDescription = "Benchmark CT"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = i + 1
+        ds.Modality = "CT"
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.WindowCenter = 40
+        ds.WindowWidth = 400
+        ds.SliceThickness = 1
+        ds.ImagePositionPatient = [0, 0, i]
+        if frames > 1:
+            ds.NumberOfFrames = frames
+        ds.PixelData = pixel_data
+
+        buffer = io.BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        files.append(SimpleUploadedFile(f"{ds.SOPInstanceUID}.dcm", buffer.getvalue(), content_type="application/dicom"))
+    return {"patient_id": patient_id, "study_uid": study_uid, "files": files}
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank, good enough for the sample sizes we run
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(durations, peak_memory_bytes, units=None):
+    durations_ms = sorted(d * 1000 for d in durations)
+    total_seconds = sum(durations)
+    result = {
+        "runs": len(durations),
+        "total_seconds": round(total_seconds, 4),
+        "requests_per_second": round(len(durations) / total_seconds, 2) if total_seconds else None,
+        "latency_ms": {
+            "min": round(durations_ms[0], 2),
+            "mean": round(total_seconds * 1000 / len(durations), 2),
+            "p50": round(percentile(durations_ms, 0.5), 2),
+            "p90": round(percentile(durations_ms, 0.9), 2),
+            "p99": round(percentile(durations_ms, 0.99), 2),
+            "max": round(durations_ms[-1], 2),
+        },
+        "peak_memory_mb": round(peak_memory_bytes / 1024 / 1024, 2) if peak_memory_bytes is not None else None,
+    }
+    # Per-unit throughput, e.g. instances and MB per second for uploads
+    for name, amount in (units or {}).items():
+        result[f"{name}_per_second"] = round(amount / total_seconds, 2) if total_seconds else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks upload_dicom, get_dicom_metadata, get_stats and delete_data_by_file_key on synthetic studies, "
+        "against in-process moto stand-ins (default) or a local S3/DynamoDB endpoint, and writes the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--studies", type=int, default=3, help="Studies to upload (one upload request each)")
+        parser.add_argument("--slices", type=int, default=50, help="Instances per study")
+        parser.add_argument("--rows", type=int, default=512)
+        parser.add_argument("--columns", type=int, default=None, help="Defaults to --rows")
+        parser.add_argument("--frames", type=int, default=1, help="Frames per instance (> 1 makes multi-frame instances)")
+        parser.add_argument("--iterations", type=int, default=20, help="Runs of each read path")
+        parser.add_argument("--endpoint-url", help="S3/DynamoDB endpoint (LocalStack, moto server...) instead of in-process moto")
+        parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc, it slows everything down noticeably")
+        parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+        parser.add_argument("--baseline", help="Earlier results file to compare against")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        options["columns"] = options["columns"] or options["rows"]
+        if options["verbosity"] < 2:
+            # One log line per request would drown the numbers
+            logging.getLogger("api").setLevel(logging.WARNING)
+
+        if options["endpoint_url"]:
+            aws = nullcontext()
+            set_endpoint_override("s3", options["endpoint_url"])
+            set_endpoint_override("dynamodb", options["endpoint_url"])
+        else:
+            try:
+                from moto import mock_aws
+            except ImportError:
+                raise CommandError("In-process runs need moto (pip install moto), or pass --endpoint-url")
+            aws = mock_aws()
+
+        with aws:
+            reset_clients()
+            self.create_resources()
+            results = self.run_benchmarks(options)
+
+        report = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "backend": options["endpoint_url"] or "moto",
+            "config": {key: options[key] for key in ("studies", "slices", "rows", "columns", "frames", "iterations", "seed")},
+            "results": results,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        }
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+            self.stderr.write(f"Results written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                self.compare(json.load(f), report)
+
+    def create_resources(self):
+        s3 = get_s3_client()
+        bucket = {"Bucket": S3_BUCKET}
+        if S3_REGION != "us-east-1":
+            bucket["CreateBucketConfiguration"] = {"LocationConstraint": S3_REGION}
+        try:
+            s3.create_bucket(**bucket)
+        except (s3.exceptions.BucketAlreadyOwnedByYou, s3.exceptions.BucketAlreadyExists):
+            pass
+
+        dynamodb = get_dynamodb_resource().meta.client
+        attribute_definitions = [
+            {"AttributeName": "UserId", "AttributeType": "S"},
+            {"AttributeName": "FileKey", "AttributeType": "S"},
+        ]
+        table = {
+            "TableName": DICOM_DYNAMO_TABLE,
+            "KeySchema": [
+                {"AttributeName": "UserId", "KeyType": "HASH"},
+                {"AttributeName": "FileKey", "KeyType": "RANGE"},
+            ],
+            "AttributeDefinitions": attribute_definitions,
+            "BillingMode": "PAY_PER_REQUEST",
+        }
+        if DICOM_RECORD_TYPE_INDEX_NAME:
+            attribute_definitions.append({"AttributeName": "RecordTypeKey", "AttributeType": "S"})
+            table["GlobalSecondaryIndexes"] = [{
+                "IndexName": DICOM_RECORD_TYPE_INDEX_NAME,
+                "KeySchema": [
+                    {"AttributeName": "UserId", "KeyType": "HASH"},
+                    {"AttributeName": "RecordTypeKey", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            }]
+        try:
+            dynamodb.create_table(**table)
+            dynamodb.get_waiter("table_exists").wait(TableName=DICOM_DYNAMO_TABLE)
+        except dynamodb.exceptions.ResourceInUseException:
+            pass
+
+    @contextmanager
+    def measure(self, trace_memory, peak):
+        """Tracks the peak traced memory of a phase in peak[0]"""
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if trace_memory:
+                peak[0] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+    def timed_runs(self, view, requests, expected_statuses, trace_memory):
+        durations = []
+        peak = [None]
+        with self.measure(trace_memory, peak):
+            for request in requests:
+                start = time.perf_counter()
+                response = view(request)
+                # Streaming responses do their work while being consumed
+                if response.streaming:
+                    b"".join(response.streaming_content)
+                durations.append(time.perf_counter() - start)
+                if response.status_code not in expected_statuses:
+                    raise CommandError(f"{view.__name__} returned {response.status_code}: {response.content[:500]!r}")
+        return durations, peak[0]
+
+    def run_benchmarks(self, options):
+        factory = RequestFactory()
+        trace_memory = not options["no_memory"]
+        results = {}
+
+        self.stderr.write(
+            f"Generating {options['studies']} studies of {options['slices']} x {options['rows']}x{options['columns']}"
+            f" ({options['frames']} frame(s)) instances"
+        )
+        studies = [
+            make_study(f"BENCH{i:04d}", options["slices"], options["rows"], options["columns"], options["frames"])
+            for i in range(options["studies"])
+        ]
+
+        # Request bodies are encoded up front so only the view is timed
+        upload_requests = [
+            factory.post("/api/upload-dicom", {"files": study["files"]}, HTTP_AUTHORIZATION="Bearer benchmark")
+            for study in studies
+        ]
+        upload_bytes = sum(f.size for study in studies for f in study["files"])
+        # No Cognito here, every token belongs to the benchmark user
+        with mock.patch("api.views.upload.cognito_token_verification", return_value=BENCHMARK_USER_ID):
+            durations, peak = self.timed_runs(upload_dicom, upload_requests, {200}, trace_memory)
+        results["upload_dicom"] = summarize(durations, peak, {
+            "instances": options["studies"] * options["slices"],
+            "mb": upload_bytes / 1024 / 1024,
+        })
+
+        read_paths = {
+            "get_dicom_metadata_instances": (get_dicom_metadata, "/api/get-dicom-metadata", {"recordType": "instance"}),
+            "get_dicom_metadata_instances_page": (get_dicom_metadata, "/api/get-dicom-metadata", {"recordType": "instance", "limit": "100"}),
+            "get_dicom_metadata_instances_stream": (get_dicom_metadata, "/api/get-dicom-metadata", {"recordType": "instance", "stream": "ndjson"}),
+            "get_dicom_metadata_studies": (get_dicom_metadata, "/api/get-dicom-metadata", {"recordType": "study"}),
+            "get_stats": (get_stats, "/api/stats", {}),
+        }
+        for name, (view, path, params) in read_paths.items():
+            requests = [factory.get(path, {"userId": BENCHMARK_USER_ID, **params}) for _ in range(options["iterations"])]
+            durations, peak = self.timed_runs(view, requests, {200}, trace_memory)
+            results[name] = summarize(durations, peak)
+
+        delete_requests = [
+            factory.get("/api/delete-data-by-file-key", {
+                "userId": BENCHMARK_USER_ID,
+                "fileKey": f"{BENCHMARK_USER_ID}/{study['patient_id']}/{study['study_uid']}/",
+            })
+            for study in studies
+        ]
+        durations, peak = self.timed_runs(delete_data_by_file_key, delete_requests, {200}, trace_memory)
+        results["delete_data_by_file_key"] = summarize(durations, peak, {"instances": options["studies"] * options["slices"]})
+
+        for name, result in results.items():
+            self.stderr.write(
+                f"{name:40} p50 {result['latency_ms']['p50']:>9.2f} ms  p99 {result['latency_ms']['p99']:>9.2f} ms"
+                f"  {result['requests_per_second'] or 0:>8.2f} req/s"
+            )
+        return results
+
+    def compare(self, baseline, report):
+        self.stderr.write(f"\nCompared with {baseline.get('commit') or 'baseline'} (p50 latency, negative is faster):")
+        if baseline.get("config") != report["config"]:
+            self.stderr.write(self.style.WARNING("  The runs used different settings, the numbers aren't directly comparable"))
+        for name, result in report["results"].items():
+            before = baseline.get("results", {}).get(name)
+            if not before:
+                continue
+            old, new = before["latency_ms"]["p50"], result["latency_ms"]["p50"]
+            change = (new - old) / old * 100 if old else 0
+            self.stderr.write(f"  {name:40} {old:>9.2f} -> {new:>9.2f} ms ({change:+.1f}%)")
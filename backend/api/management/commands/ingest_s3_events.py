@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+from django.core.management.base import BaseCommand, CommandError
+from api.services import get_client
+from api.services.ingest_service import parse_s3_event_records, ingest_s3_objects
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingests DICOM files uploaded straight to the staging prefix. Reads S3 ObjectCreated notifications "
+        "from an SQS queue (long polling), or a single event JSON from a file or stdin."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue-url", default=os.getenv("DICOM_INGEST_QUEUE_URL"), help="SQS queue the bucket notifications go to")
+        parser.add_argument("--file", help="Ingest the S3 event in this JSON file ('-' reads stdin) and exit")
+        parser.add_argument("--once", action="store_true", help="Stop once the queue is empty instead of polling forever")
+        parser.add_argument("--wait-seconds", type=int, default=20, help="SQS long polling wait time")
+
+    def handle(self, *args, **options):
+        if options["file"]:
+            if options["file"] == "-":
+                event = json.load(sys.stdin)
+            else:
+                with open(options["file"]) as f:
+                    event = json.load(f)
+            summary = ingest_s3_objects(parse_s3_event_records(event))
+            self.report(summary)
+            if summary["Failed"]:
+                raise CommandError(f"{len(summary['Failed'])} objects could not be ingested")
+            return
+
+        if not options["queue_url"]:
+            raise CommandError("Pass --queue-url (or set DICOM_INGEST_QUEUE_URL) or --file")
+        self.poll(options["queue_url"], options["wait_seconds"], options["once"])
+
+    def poll(self, queue_url, wait_seconds, once):
+        sqs = get_client("sqs", region_name=os.getenv("AWS_REGION"))
+        while True:
+            messages = sqs.receive_message(
+                QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait_seconds
+            ).get("Messages", [])
+            if not messages:
+                if once:
+                    return
+                continue
+
+            # All messages of a receive are ingested together so their instances share rollup writes
+            objects_by_message = {}
+            for message in messages:
+                try:
+                    objects_by_message[message["ReceiptHandle"]] = parse_s3_event_records(self.event_from_message(message["Body"]))
+                except ValueError as e:
+                    self.stderr.write(f"Dropping unreadable message {message.get('MessageId')}: {e}")
+                    objects_by_message[message["ReceiptHandle"]] = []
+
+            summary = ingest_s3_objects([obj for objects in objects_by_message.values() for obj in objects])
+            self.report(summary)
+
+            # Messages with a failed object stay on the queue and come back after the visibility timeout
+            failed_keys = {failure["key"] for failure in summary["Failed"]}
+            done = [
+                {"Id": str(i), "ReceiptHandle": receipt_handle}
+                for i, (receipt_handle, objects) in enumerate(objects_by_message.items())
+                if not any(obj["key"] in failed_keys for obj in objects)
+            ]
+            if done:
+                sqs.delete_message_batch(QueueUrl=queue_url, Entries=done)
+
+    def event_from_message(self, body):
+        event = json.loads(body)
+        # Notifications fanned out through SNS arrive wrapped in an SNS envelope
+        if "Records" not in event and "Message" in event:
+            event = json.loads(event["Message"])
+        return event
+
+    def report(self, summary):
+        self.stdout.write(
+            f"Ingested {len(summary['Ingested'])}, already stored {len(summary['Duplicates'])}, "
+            f"skipped {len(summary['Skipped'])}, failed {len(summary['Failed'])}"
+        )
+        for failure in summary["Failed"]:
+            self.stderr.write(f"  {failure['key']}: {failure['error']}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from api.services.search_service import rebuild_search_index
+from api.management.commands.rebuild_stats import Command as RebuildStatsCommand
+
+
+class Command(BaseCommand):
+    help = "Recreates the per-user study search index from the study records."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user-id", action="append", dest="user_ids", help="Only rebuild these users (can be repeated)")
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"] or sorted(RebuildStatsCommand().all_user_ids())
+
+        for user_id in user_ids:
+            studies = rebuild_search_index(user_id)
+            self.stdout.write(f"{user_id}: indexed {studies} studies")
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the search index for {len(user_ids)} users"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from api.services.ddb_service import get_dicom_table
+from api.services.stats_service import rebuild_stats, format_stats
+
+
+class Command(BaseCommand):
+    help = "Recomputes the per-user stats aggregates from the study records."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user-id", action="append", dest="user_ids", help="Only rebuild these users (can be repeated)")
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"] or sorted(self.all_user_ids())
+
+        for user_id in user_ids:
+            aggregate = rebuild_stats(user_id)
+            stats = format_stats(aggregate)
+            self.stdout.write(f"{user_id}: {stats['totalStudies']} studies, {stats['totalInstances']} instances")
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stats for {len(user_ids)} users"))
+
+    def all_user_ids(self):
+        table = get_dicom_table()
+        user_ids = set()
+        scan_kwargs = {"ProjectionExpression": "UserId"}
+        while True:
+            response = table.scan(**scan_kwargs)
+            user_ids.update(item["UserId"] for item in response.get("Items", []))
+            if not response.get("LastEvaluatedKey"):
+                return user_ids
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
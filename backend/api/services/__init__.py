@@ -1,4 +1,15 @@
-from .ddb_service import get_dicom_metadata, get_dynamodb_resource
-from .s3_service import generate_and_return_presigned_url, get_s3_client, generate_pre_signed_url_with_file_key
-from .auth_service import get_cognito_public_keys, cognito_token_verification
-from .stats_service import get_stats
\ No newline at end of file
+from .ddb_service import (
+    get_dicom_metadata, get_dicom_metadata_async, get_dynamodb_resource, get_dicom_table, data_version_state, batch_write_requests, batch_put_items,
+    build_metadata_query, iter_query_pages, record_type_key, with_record_type_key
+)
+from .s3_service import (
+    generate_and_return_presigned_url, get_s3_client, generate_pre_signed_url_with_file_key,
+    direct_upload_staging_key, user_id_from_staging_key, generate_presigned_put_url,
+    create_presigned_multipart_upload, complete_multipart_upload, abort_multipart_upload,
+    presigned_get_url, presigned_get_urls
+)
+from .auth_service import get_cognito_public_keys, cognito_token_verification, get_request_user_id
+from .stats_service import get_stats, get_stats_async, rebuild_stats, record_upload_in_stats, record_deletion_in_stats
+from .aws_clients import get_client, get_resource, set_endpoint_override, reset_clients, run_io, submit_io
+from .upload_handler import S3StreamingUploadHandler
+from .metrics import metrics_view, timed, inc_counter, observe
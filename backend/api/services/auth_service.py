@@ -1,43 +1,192 @@
+import logging
 import jwt
 import requests
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from .metrics import inc_counter
+
+logger = logging.getLogger(__name__)
 
 COGNITO_REGION = os.getenv("AWS_REGION", "us-east-1")
 COGNITO_USERPOOL_ID = os.getenv("COGNITO_USERPOOL_ID", "us-east-1_QAGkAfsHK")
+COGNITO_ISSUER = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}"
+
+# How long a fetched key set is considered fresh, and how much longer we keep serving it while a
+# background refresh runs (stale-while-revalidate). Cognito rotates keys rarely, so these can be generous.
+JWKS_CACHE_TTL_SECONDS = int(os.getenv("COGNITO_JWKS_CACHE_TTL", "3600"))
+JWKS_STALE_TTL_SECONDS = int(os.getenv("COGNITO_JWKS_STALE_TTL", "86400"))
+# Tokens with a kid we have never seen trigger a refetch (key rotation), but not more often than this,
+# otherwise anyone could make us hammer Cognito by sending made-up kids.
+JWKS_MIN_REFRESH_INTERVAL_SECONDS = int(os.getenv("COGNITO_JWKS_MIN_REFRESH_INTERVAL", "30"))
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("COGNITO_VERIFIED_TOKEN_CACHE_SIZE", "1024"))
+
+# kid -> RSA public key object, so we also skip re-parsing the JWK on every request
+_jwks_cache = {"keys": {}, "fetched_at": None, "last_attempt": None}
+_jwks_refresh_lock = threading.Lock()  # only one thread talks to Cognito at a time (single-flight)
+
+# sha256(token) -> (user_id, exp), oldest first
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
 
 def get_cognito_public_keys():
     """Fetch Cognito public keys for token verification"""
-    url = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}/.well-known/jwks.json"
-    print("In the get_cognito_public_keys function")
+    url = f"{COGNITO_ISSUER}/.well-known/jwks.json"
+    logger.debug("Fetching Cognito public keys")
     try:
         response = requests.get(url, timeout=5)  # Add timeout
         return response.json().get("keys", [])
     except requests.RequestException as e:
-        print(f"Failed to fetch Cognito keys: {e}")
+        logger.warning("Failed to fetch Cognito keys: %s", e)
         return None  # Return None if the request fails
 
+def _refresh_jwks_cache():
+    """Fetch the key set and swap it into the cache. Caller must hold _jwks_refresh_lock."""
+    _jwks_cache["last_attempt"] = time.monotonic()
+    keys = get_cognito_public_keys()
+    if keys is None:
+        # Keep whatever we had, a slow or failing Cognito shouldn't take auth down with it
+        return False
+
+    parsed_keys = {}
+    for key in keys:
+        try:
+            parsed_keys[key["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(key)
+        except Exception as e:
+            logger.warning("Skipping unusable Cognito key %s: %s", key.get("kid"), e)
+
+    _jwks_cache["keys"] = parsed_keys
+    _jwks_cache["fetched_at"] = time.monotonic()
+    return True
+
+def _recently_attempted():
+    last_attempt = _jwks_cache["last_attempt"]
+    return last_attempt is not None and time.monotonic() - last_attempt < JWKS_MIN_REFRESH_INTERVAL_SECONDS
+
+def _start_background_refresh():
+    """Revalidate the key set on a background thread, unless one is running or one was tried (even failed) recently"""
+    # Taken here and handed over to the thread, so concurrent requests can't each start one
+    if not _jwks_refresh_lock.acquire(blocking=False):
+        return
+    if _recently_attempted():
+        _jwks_refresh_lock.release()
+        return
+    _jwks_cache["last_attempt"] = time.monotonic()
+    try:
+        threading.Thread(target=_background_refresh_jwks, daemon=True).start()
+    except Exception:
+        _jwks_refresh_lock.release()
+        raise
+
+def _background_refresh_jwks():
+    try:
+        _refresh_jwks_cache()
+    finally:
+        _jwks_refresh_lock.release()
+
+def _jwks_age():
+    fetched_at = _jwks_cache["fetched_at"]
+    if fetched_at is None:
+        return None
+    return time.monotonic() - fetched_at
+
+def get_cognito_signing_key(kid):
+    """Return the public key for a kid, fetching the key set only when it is stale or the kid is unknown"""
+    age = _jwks_age()
+    key = _jwks_cache["keys"].get(kid)
+
+    if key is not None and age < JWKS_CACHE_TTL_SECONDS:
+        return key
+
+    if key is not None and age < JWKS_CACHE_TTL_SECONDS + JWKS_STALE_TTL_SECONDS:
+        # Serve the stale key right away and let a background thread revalidate it
+        _start_background_refresh()
+        return key
+
+    # Either we have nothing usable, or the kid is new (keys were rotated): refresh synchronously.
+    # Threads arriving here at the same time wait on the lock and reuse the first thread's result.
+    with _jwks_refresh_lock:
+        age = _jwks_age()
+        key = _jwks_cache["keys"].get(kid)
+        if key is not None and age < JWKS_CACHE_TTL_SECONDS + JWKS_STALE_TTL_SECONDS:
+            return key
+
+        if _recently_attempted() and key is None and _jwks_cache["keys"]:
+            return None
+
+        _refresh_jwks_cache()
+        return _jwks_cache["keys"].get(kid)
+
+def _token_cache_key(token):
+    # Don't keep raw bearer tokens around in memory longer than we have to
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _get_verified_token(token):
+    cache_key = _token_cache_key(token)
+    with _verified_tokens_lock:
+        entry = _verified_tokens.get(cache_key)
+        if entry is None:
+            return None
+        user_id, exp = entry
+        if exp <= time.time():
+            del _verified_tokens[cache_key]
+            return None
+        _verified_tokens.move_to_end(cache_key)
+        return user_id
+
+def _remember_verified_token(token, user_id, exp):
+    if not exp or VERIFIED_TOKEN_CACHE_SIZE <= 0:
+        return
+    cache_key = _token_cache_key(token)
+    with _verified_tokens_lock:
+        _verified_tokens[cache_key] = (user_id, exp)
+        _verified_tokens.move_to_end(cache_key)
+        while len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+
 def cognito_token_verification(token):
     """Verify JWT token and extract user ID"""
     try:
-        print("In the cognito_token_verification function try block")
-        keys = get_cognito_public_keys()
+        # Same token seen earlier in this session and not expired yet, no need to check the signature again
+        cached_user_id = _get_verified_token(token)
+        if cached_user_id is not None:
+            inc_counter("auth_verifications_total", outcome="cached")
+            return cached_user_id
+
         header = jwt.get_unverified_header(token)
+        public_key = get_cognito_signing_key(header["kid"])
 
-        key = next((k for k in keys if k["kid"] == header["kid"]), None)
-        
-        if not key:
+        if not public_key:
+            inc_counter("auth_verifications_total", outcome="rejected")
             return None
 
-        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(key)
-        payload = jwt.decode(token, public_key, algorithms=["RS256"], issuer=f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}")
+        payload = jwt.decode(token, public_key, algorithms=["RS256"], issuer=COGNITO_ISSUER)
         # before you had the audience parameter that has the Cognito App client ID
         # but you were verifying an access token which doesn't have the audience parameter, hence you changed the parameter
         # to issuer.
-        print(f"-------------------------payload: {payload}")
+        logger.debug("Verified token payload", extra={"payload": payload})
         cognito_user_id = payload.get("sub")
-        print(f"User ID: {cognito_user_id}")
+
+        inc_counter("auth_verifications_total", outcome="verified" if cognito_user_id else "rejected")
+        if cognito_user_id:
+            _remember_verified_token(token, cognito_user_id, payload.get("exp"))
 
         return cognito_user_id  # Cognito user ID
     except Exception as e:
-        print(f"Exception: {e}")
+        logger.info("Token verification failed: %s", e)
+        inc_counter("auth_verifications_total", outcome="rejected")
         return Exception
+
+def get_request_user_id(request):
+    """User ID from the request's "Authorization: Bearer <token>" header, None if it is missing or invalid"""
+    auth_header = request.headers.get("Authorization", "")
+    parts = auth_header.split(" ")
+    if len(parts) != 2 or not parts[1]:
+        return None
+
+    user_id = cognito_token_verification(parts[1])
+    if not user_id or user_id is Exception:
+        return None
+    return user_id
@@ -0,0 +1,123 @@
+import os
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from .metrics import instrument_client
+
+# This module keeps one boto3 session per process and hands out shared clients, so every request reuses the same
+# credentials and connection pools instead of building new ones.
+
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))  # should cover our biggest thread pools
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "5"))
+AWS_RETRY_MODE = os.getenv("AWS_RETRY_MODE", "adaptive")  # adaptive = standard retries + client-side rate limiting
+AWS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("AWS_CONNECT_TIMEOUT_SECONDS", "5"))
+AWS_READ_TIMEOUT_SECONDS = float(os.getenv("AWS_READ_TIMEOUT_SECONDS", "60"))
+
+BOTO_CONFIG = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=AWS_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=AWS_READ_TIMEOUT_SECONDS,
+    retries={"mode": AWS_RETRY_MODE, "max_attempts": AWS_MAX_ATTEMPTS},
+)
+
+# Threads the async views hand blocking boto3 calls to. Bounded so a burst of requests queues up here instead of
+# opening more connections than the pools above allow.
+AWS_IO_THREADS = int(os.getenv("AWS_IO_THREADS", "32"))
+
+_lock = threading.Lock()  # boto3 sessions aren't safe to create clients from concurrently
+_session = None
+_clients = {}
+# Resources (unlike clients) aren't thread safe, so each thread gets its own
+_thread_local = threading.local()
+_generation = 0  # bumped by reset_clients so other threads drop their resources too
+_endpoint_overrides = {}
+
+def set_endpoint_override(service_name, endpoint_url):
+    """
+    Point a service at another endpoint (moto server, LocalStack, DynamoDB Local...). Pass None to go back to AWS.
+    AWS_ENDPOINT_URL_<SERVICE> (e.g. AWS_ENDPOINT_URL_DYNAMODB) does the same from the environment.
+    """
+    with _lock:
+        if endpoint_url:
+            _endpoint_overrides[service_name] = endpoint_url
+        else:
+            _endpoint_overrides.pop(service_name, None)
+    reset_clients()
+
+def get_endpoint_url(service_name):
+    return _endpoint_overrides.get(service_name) or os.getenv(f"AWS_ENDPOINT_URL_{service_name.upper()}") or None
+
+def reset_clients():
+    """Forget every cached session, client and resource (threads pick up new ones on their next call)"""
+    global _session, _generation
+    with _lock:
+        _session = None
+        _clients.clear()
+        _generation += 1
+
+def _get_session():
+    # Caller must hold _lock
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+def get_client(service_name, region_name=None):
+    """Shared, thread-safe client for a service/region, created on first use"""
+    cache_key = (service_name, region_name)
+    client = _clients.get(cache_key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            client = _get_session().client(
+                service_name,
+                region_name=region_name,
+                endpoint_url=get_endpoint_url(service_name),
+                config=BOTO_CONFIG,
+            )
+            instrument_client(client)
+            _clients[cache_key] = client
+        return client
+
+def get_resource(service_name, region_name=None):
+    """Resource for a service/region, cached per thread"""
+    if getattr(_thread_local, "generation", None) != _generation:
+        _thread_local.resources = {}
+        _thread_local.generation = _generation
+    resources = _thread_local.resources
+
+    cache_key = (service_name, region_name)
+    resource = resources.get(cache_key)
+    if resource is None:
+        with _lock:
+            resource = _get_session().resource(
+                service_name,
+                region_name=region_name,
+                endpoint_url=get_endpoint_url(service_name),
+                config=BOTO_CONFIG,
+            )
+            instrument_client(resource.meta.client)
+        resources[cache_key] = resource
+    return resource
+
+_io_executor = ThreadPoolExecutor(max_workers=AWS_IO_THREADS, thread_name_prefix="aws-io")
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking (boto3, Cognito...) call on the I/O threads without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # Carry context variables (request ids and the like) over to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_io_executor, functools.partial(context.run, func, *args, **kwargs))
+
+def submit_io(func, *args, **kwargs):
+    """Start a blocking call on the I/O threads without waiting for it (work that can finish after the response)"""
+    context = contextvars.copy_context()
+    return _io_executor.submit(context.run, func, *args, **kwargs)
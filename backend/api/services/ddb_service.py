@@ -1,46 +1,459 @@
+import logging
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.csrf import csrf_exempt
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from .aws_clients import get_resource, run_io
+from .metrics import timed, inc_counter
+from .thumbnail_service import add_thumbnail_urls
+from .metadata_cache import (
+    get_data_version_state, metadata_etag, etag_matches, not_modified_response, with_validators, cached_body, cache_body
+)
 import os
+import asyncio
+import random
+import time
+import re
+import json
+import base64
+
+logger = logging.getLogger(__name__)
 
 # This module provides utility functions to interact with AWS DynamoDB for DICOM data retrieval.
 
-# Create DynamoDB resource
+DICOM_DYNAMO_TABLE = os.getenv("DICOM_DYNAMO_TABLE", "dicomFileMetadataTable")
+
+# GSI keyed on (UserId, RecordTypeKey) where RecordTypeKey is "<DataType>#<FileKey>". Every record type gets its
+# own sort-key namespace in the index, so "all studies of a user" or "all series under this study" is a key
+# condition instead of a FilterExpression over the user's whole partition. New records always get a RecordTypeKey,
+# but reads only go through the index with DICOM_RECORD_TYPE_INDEX_READS=true: until
+# `manage.py backfill_record_type_keys --create-index` has created it and stamped the older records, those would be
+# missing from every listing (or the query would fail on the missing index). Off, reads filter the partition.
+DICOM_RECORD_TYPE_INDEX_NAME = os.getenv("DICOM_RECORD_TYPE_INDEX", "RecordTypeIndex")
+DICOM_RECORD_TYPE_INDEX_READS = os.getenv("DICOM_RECORD_TYPE_INDEX_READS", "false").lower() == "true"
+DICOM_RECORD_TYPE_INDEX = DICOM_RECORD_TYPE_INDEX_NAME if DICOM_RECORD_TYPE_INDEX_READS else ""
+DICOM_DATA_TYPES = ("patient", "study", "series", "instance")
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+DDB_BATCH_WRITE_SIZE = 25
+DDB_BATCH_WRITE_CONCURRENCY = int(os.getenv("DDB_BATCH_WRITE_CONCURRENCY", "4"))
+DDB_BATCH_WRITE_MAX_ATTEMPTS = int(os.getenv("DDB_BATCH_WRITE_MAX_ATTEMPTS", "8"))
+DDB_BACKOFF_BASE_SECONDS = float(os.getenv("DDB_BACKOFF_BASE_SECONDS", "0.05"))
+DDB_BACKOFF_MAX_SECONDS = float(os.getenv("DDB_BACKOFF_MAX_SECONDS", "2"))
+DDB_THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
+# Page size bounds for get_dicom_metadata's cursor pagination
+METADATA_DEFAULT_PAGE_LIMIT = 100
+METADATA_MAX_PAGE_LIMIT = 1000
+
+# DynamoDB resource (cached per thread by the client registry)
 def get_dynamodb_resource():
-    return boto3.resource(
-        "dynamodb",
-        region_name=os.getenv("AWS_REGION")    
-    )
+    return get_resource("dynamodb", region_name=os.getenv("AWS_REGION"))
+
+def get_dicom_table(dynamodb_resource=None):
+    dynamodb_resource = dynamodb_resource or get_dynamodb_resource()
+    return dynamodb_resource.Table(DICOM_DYNAMO_TABLE)
+
+def data_version_state(user_id):
+    """get_data_version_state with the calling thread's table, for run_io: resources aren't shared between threads"""
+    return get_data_version_state(get_dicom_table(), user_id)
+
+def record_type_key(data_type, file_key=""):
+    """Sort key of a record in the record type index"""
+    return f"{data_type}#{file_key}"
+
+def with_record_type_key(item):
+    """Stamp RecordTypeKey on an item (DataType and FileKey must already be set) so it shows up in the index"""
+    item["RecordTypeKey"] = record_type_key(item["DataType"], item["FileKey"])
+    return item
+
+def encode_cursor(last_evaluated_key):
+    """Turn a LastEvaluatedKey into an opaque, URL-safe cursor string"""
+    if not last_evaluated_key:
+        return None
+    raw = json.dumps(last_evaluated_key, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor, key_attributes):
+    """The LastEvaluatedKey in a cursor, ValueError unless it is exactly these key attributes with string values"""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(key, dict) or set(key) != set(key_attributes) or not all(isinstance(value, str) for value in key.values()):
+        raise ValueError("Not a key of this query")
+    return key
+
+def build_metadata_query(user_id, record_type, file_key=""):
+    """Query arguments for one record type of a user, optionally under a FileKey prefix"""
+    if DICOM_RECORD_TYPE_INDEX:
+        return {
+            "IndexName": DICOM_RECORD_TYPE_INDEX,
+            "KeyConditionExpression": Key('UserId').eq(user_id) & Key("RecordTypeKey").begins_with(record_type_key(record_type, file_key))
+        }
+
+    if file_key == "":
+        return {
+            "KeyConditionExpression": Key('UserId').eq(user_id),
+            "FilterExpression": Attr('DataType').eq(record_type)
+        }
+    return {
+        "KeyConditionExpression": Key('UserId').eq(user_id) & Key("FileKey").begins_with(file_key),
+        "FilterExpression": Attr('DataType').eq(record_type)
+    }
+
+def iter_query_pages(table, query_kwargs, exclusive_start_key=None):
+    """Yield the Items of every page of a query, following LastEvaluatedKey until the end"""
+    while True:
+        if exclusive_start_key:
+            response = table.query(**query_kwargs, ExclusiveStartKey=exclusive_start_key)
+        else:
+            response = table.query(**query_kwargs)
+        yield response.get("Items", [])
+
+        exclusive_start_key = response.get("LastEvaluatedKey")
+        if not exclusive_start_key:
+            return
+
+class DynamoJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder that also writes DynamoDB string/number sets (rollup UID lists) as sorted arrays"""
+    def default(self, o):
+        if isinstance(o, (set, frozenset)):
+            return sorted(o)
+        return super().default(o)
+
+def stream_json_array(pages):
+    # Written item by item so the whole result never has to sit in memory
+    yield "["
+    first = True
+    for items in pages:
+        for item in items:
+            yield ("" if first else ",") + json.dumps(item, cls=DynamoJSONEncoder)
+            first = False
+    yield "]"
+
+def stream_ndjson(pages):
+    for items in pages:
+        for item in items:
+            yield json.dumps(item, cls=DynamoJSONEncoder) + "\n"
+
+# Same as above for async page iterators (ASGI responses)
+async def astream_json_array(pages):
+    yield "["
+    first = True
+    async for items in pages:
+        for item in items:
+            yield ("" if first else ",") + json.dumps(item, cls=DynamoJSONEncoder)
+            first = False
+    yield "]"
+
+async def astream_ndjson(pages):
+    async for items in pages:
+        for item in items:
+            yield json.dumps(item, cls=DynamoJSONEncoder) + "\n"
+
+# fields=... on get_dicom_metadata. Attributes that are always returned, whatever was asked for
+METADATA_ALWAYS_PROJECTED = ("FileKey", "DataType")
+METADATA_MAX_FIELDS = 100
+_FIELD_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+def metadata_projection(fields):
+    """
+    ProjectionExpression arguments for a comma-separated list of attribute names. DICOM keywords (StudyDate) are
+    mapped to the tags the records are stored under (00080020), ThumbnailUrl to the ThumbnailKey it is signed from.
+    Returns None when the list is unusable.
+    """
+    # dicom_service imports this module, so it can't be imported at the top
+    from .dicom_service import DICOM_TAGS
+
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if not names or len(names) > METADATA_MAX_FIELDS or not all(_FIELD_NAME.match(name) for name in names):
+        return None
+
+    attributes = list(METADATA_ALWAYS_PROJECTED)
+    for name in names:
+        attribute = "ThumbnailKey" if name == "ThumbnailUrl" else DICOM_TAGS.get(name, name)
+        if attribute not in attributes:
+            attributes.append(attribute)
+    # Placeholders for every name: tags start with a digit and plenty of keywords are reserved words
+    return {
+        "ProjectionExpression": ", ".join(f"#f{i}" for i in range(len(attributes))),
+        "ExpressionAttributeNames": {f"#f{i}": attribute for i, attribute in enumerate(attributes)},
+    }
+
+def parse_metadata_request(request):
+    """
+    Validates get_dicom_metadata's query parameters.
+    Returns (params, None), or (None, error response) when they are unusable.
+    """
+    user_id = request.GET.get("userId") # Get UserId from the URL query parameters
+    record_type = request.GET.get("recordType")  # e.g., "patient, "series", "study" or "instance"
+    file_key = request.GET.get("fileKey", "")  # Optional, used to filter results
+    limit = request.GET.get("limit")
+    cursor = request.GET.get("cursor")
+    stream = request.GET.get("stream")
+    fields = request.GET.get("fields")
+
+    if not user_id or not record_type:
+        return None, JsonResponse({"error": "Missing required parameters: userId and/or recordType"}, status=400)
+
+    if stream and stream not in ("json", "ndjson"):
+        return None, JsonResponse({"error": "stream must be either 'json' or 'ndjson'"}, status=400)
+
+    params = {"user_id": user_id, "query_kwargs": build_metadata_query(user_id, record_type, file_key), "stream": stream, "paged": False}
+    if fields:
+        projection = metadata_projection(fields)
+        if projection is None:
+            return None, JsonResponse({"error": f"fields must be a comma-separated list of at most {METADATA_MAX_FIELDS} attribute names"}, status=400)
+        params["query_kwargs"].update(projection)
+    if not stream and (limit or cursor):
+        try:
+            page_limit = min(int(limit or METADATA_DEFAULT_PAGE_LIMIT), METADATA_MAX_PAGE_LIMIT)
+            if page_limit < 1:
+                raise ValueError
+            # Queries on the index page by the index key as well as the table key
+            key_attributes = ("UserId", "FileKey", "RecordTypeKey") if "IndexName" in params["query_kwargs"] else ("UserId", "FileKey")
+            exclusive_start_key = decode_cursor(cursor, key_attributes) if cursor else None
+        except Exception:
+            return None, JsonResponse({"error": "Invalid limit or cursor"}, status=400)
+
+        if exclusive_start_key and exclusive_start_key.get("UserId") != user_id:
+            return None, JsonResponse({"error": "Invalid limit or cursor"}, status=400)
+
+        params["paged"] = True
+        params["query_kwargs"]["Limit"] = page_limit
+        if exclusive_start_key:
+            params["query_kwargs"]["ExclusiveStartKey"] = exclusive_start_key
+    return params, None
+
+def query_metadata_page(query_kwargs, exclusive_start_key=None):
+    """One query call, returns (items, LastEvaluatedKey)"""
+    dicom_data_table = get_dicom_table()
+    with timed("get_dicom_metadata", "query"):
+        if exclusive_start_key:
+            response = dicom_data_table.query(**query_kwargs, ExclusiveStartKey=exclusive_start_key)
+        else:
+            response = dicom_data_table.query(**query_kwargs)
+    return add_thumbnail_urls(response.get("Items", [])), response.get("LastEvaluatedKey")
+
+def query_all_metadata(query_kwargs):
+    items = []
+    with timed("get_dicom_metadata", "query"):
+        for page_items in iter_query_pages(get_dicom_table(), query_kwargs):
+            items.extend(page_items)
+    return add_thumbnail_urls(items)
+
+def metadata_page_response(items, last_evaluated_key):
+    # Without the index, Limit is applied before the filter, so a page can hold fewer items (even none)
+    # and still have a next cursor
+    return JsonResponse({
+        "Items": items,
+        "NextCursor": encode_cursor(last_evaluated_key)
+    }, encoder=DynamoJSONEncoder)
+
+def streaming_metadata_response(pages, stream):
+    pages = (add_thumbnail_urls(items) for items in pages)
+    if stream == "ndjson":
+        return StreamingHttpResponse(stream_ndjson(pages), content_type="application/x-ndjson")
+    return StreamingHttpResponse(stream_json_array(pages), content_type="application/json")
 
 @csrf_exempt
 def get_dicom_metadata(request):
+    """
+    Returns a user's records of one type.
+    - default: every page, as a JSON array
+    - limit/cursor: one page, as {"Items": [...], "NextCursor": ...}
+    - stream=json|ndjson: every page, written to the response as it is read
+    - fields=StudyDate,Modality,...: only these attributes (plus FileKey and DataType) of each record
+    """
     try:
-        user_id = request.GET.get("userId") # Get UserId from the URL query parameters
-        record_type = request.GET.get("recordType")  # e.g., "patient, "series", "study" or "instance"
-        file_key = request.GET.get("fileKey", "")  # Optional, used to filter results
-
-        if not user_id or not record_type:
-            return JsonResponse({"error": "Missing required parameters: userId and/or recordType"}, status=400)
-        
-        dynamodb_resource = get_dynamodb_resource()
-        dicom_data_table = dynamodb_resource.Table("dicomFileMetadataTable")
-
-        if file_key == "":
-            response = dicom_data_table.query(
-                KeyConditionExpression=Key('UserId').eq(user_id),
-                FilterExpression=Attr('DataType').eq(record_type)
-            )
+        params, error_response = parse_metadata_request(request)
+        if error_response:
+            return error_response
+        query_kwargs = params["query_kwargs"]
+
+        # One consistent GetItem instead of the whole query when the client's copy is still current
+        version, settled = get_data_version_state(get_dicom_table(), params["user_id"])
+        etag = metadata_etag(params["user_id"], version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+
+        if params["stream"]:
+            return with_validators(streaming_metadata_response(iter_query_pages(get_dicom_table(), query_kwargs), params["stream"]), etag)
+
+        body = cached_body(etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        if params["paged"]:
+            response = metadata_page_response(*query_metadata_page(query_kwargs))
         else:
-            response = dicom_data_table.query(
-                KeyConditionExpression=Key('UserId').eq(user_id) & Key("FileKey").begins_with(file_key),
-                FilterExpression=Attr('DataType').eq(record_type)
-            )
+            response = JsonResponse(query_all_metadata(query_kwargs), safe=False, encoder=DynamoJSONEncoder)
+        cache_body(etag, response.content)
+        return with_validators(response, etag)
+
+    except Exception as e:
+        logger.exception("Failed to get DICOM data: %s", e)
+        return JsonResponse({"error": f"Failed to get DICOM data: {str(e)}"}, status=500)
+
+async def aiter_query_pages(query_kwargs):
+    """Async iter_query_pages: the next page is already being fetched while the current one is consumed"""
+    next_page = asyncio.ensure_future(run_io(query_metadata_page, query_kwargs))
+    try:
+        while next_page is not None:
+            items, last_evaluated_key = await next_page
+            next_page = asyncio.ensure_future(run_io(query_metadata_page, query_kwargs, last_evaluated_key)) if last_evaluated_key else None
+            yield items
+    finally:
+        # Client went away mid-stream
+        if next_page is not None:
+            next_page.cancel()
+
+@csrf_exempt
+async def get_dicom_metadata_async(request):
+    """get_dicom_metadata for the ASGI server, the DynamoDB calls run on the I/O threads"""
+    try:
+        params, error_response = parse_metadata_request(request)
+        if error_response:
+            return error_response
+        query_kwargs = params["query_kwargs"]
+
+        version, settled = await run_io(data_version_state, params["user_id"])
+        etag = metadata_etag(params["user_id"], version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+
+        if params["stream"]:
+            if params["stream"] == "ndjson":
+                response = StreamingHttpResponse(astream_ndjson(aiter_query_pages(query_kwargs)), content_type="application/x-ndjson")
+            else:
+                response = StreamingHttpResponse(astream_json_array(aiter_query_pages(query_kwargs)), content_type="application/json")
+            return with_validators(response, etag)
 
-        items = response['Items']
-        return JsonResponse(items, safe=False)
+        # The cache backend may do network I/O too (memcached, redis...)
+        body = await run_io(cached_body, etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        if params["paged"]:
+            response = metadata_page_response(*await run_io(query_metadata_page, query_kwargs))
+        else:
+            items = []
+            async for page_items in aiter_query_pages(query_kwargs):
+                items.extend(page_items)
+            response = JsonResponse(items, safe=False, encoder=DynamoJSONEncoder)
+        await run_io(cache_body, etag, response.content)
+        return with_validators(response, etag)
 
     except Exception as e:
-        print(f"Failed to get DICOM data: {str(e)}")
-        return JsonResponse({"error": f"Failed to get DICOM data: {str(e)}"}, status=500)
\ No newline at end of file
+        logger.exception("Failed to get DICOM data: %s", e)
+        return JsonResponse({"error": f"Failed to get DICOM data: {str(e)}"}, status=500)
+
+def _backoff_sleep(attempt):
+    # "Full jitter" backoff so parallel batches that got throttled together don't retry together
+    time.sleep(random.uniform(0, min(DDB_BACKOFF_MAX_SECONDS, DDB_BACKOFF_BASE_SECONDS * (2 ** attempt))))
+
+def _write_batch(client, table_name, write_requests):
+    """Send one batch (<= 25 requests), retrying UnprocessedItems and throttling until done or out of attempts."""
+    summary = {"Written": 0, "RetriedItems": 0, "ThrottledRequests": 0, "FailedRequests": []}
+    pending = write_requests
+
+    for attempt in range(DDB_BATCH_WRITE_MAX_ATTEMPTS):
+        if attempt > 0:
+            summary["RetriedItems"] += len(pending)
+            _backoff_sleep(attempt)
+
+        try:
+            response = client.batch_write_item(RequestItems={table_name: pending})
+        except ClientError as e:
+            # When every item in the batch is throttled DynamoDB fails the whole call instead
+            if e.response.get("Error", {}).get("Code") not in DDB_THROTTLING_ERRORS:
+                raise
+            summary["ThrottledRequests"] += 1
+            continue
+
+        unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+        summary["Written"] += len(pending) - len(unprocessed)
+        if not unprocessed:
+            return summary
+        pending = unprocessed
+
+    summary["FailedRequests"] = pending
+    return summary
+
+def batch_write_requests(table_name, write_requests, dynamodb_resource=None, max_workers=DDB_BATCH_WRITE_CONCURRENCY):
+    """
+    Write a list of BatchWriteItem requests ({"PutRequest": ...} / {"DeleteRequest": ...}) in 25-item
+    batches, running up to max_workers batches at once.
+    Returns a summary of written, retried and throttled requests plus any that never went through.
+    """
+    summary = {"Written": 0, "RetriedItems": 0, "ThrottledRequests": 0, "FailedRequests": []}
+    if not write_requests:
+        return summary
+
+    dynamodb_resource = dynamodb_resource or get_dynamodb_resource()
+    # The resource's client takes plain Python values (the same ones put_item takes)
+    client = dynamodb_resource.meta.client
+    batches = [write_requests[i:i + DDB_BATCH_WRITE_SIZE] for i in range(0, len(write_requests), DDB_BATCH_WRITE_SIZE)]
+
+    if max_workers <= 1 or len(batches) == 1:
+        batch_summaries = [_write_batch(client, table_name, batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            batch_summaries = list(executor.map(lambda batch: _write_batch(client, table_name, batch), batches))
+
+    for batch_summary in batch_summaries:
+        summary["Written"] += batch_summary["Written"]
+        summary["RetriedItems"] += batch_summary["RetriedItems"]
+        summary["ThrottledRequests"] += batch_summary["ThrottledRequests"]
+        summary["FailedRequests"].extend(batch_summary["FailedRequests"])
+    if summary["RetriedItems"]:
+        inc_counter("dynamodb_batch_retried_items_total", summary["RetriedItems"], table=table_name)
+    return summary
+
+def batch_put_items(table_name, items, key_attributes=("UserId", "FileKey"), dynamodb_resource=None, max_workers=DDB_BATCH_WRITE_CONCURRENCY):
+    """Put items through batch_write_requests. Items sharing a key are collapsed (last one wins) since a batch can't contain duplicates."""
+    unique_items = {}
+    for item in items:
+        unique_items[tuple(item[attr] for attr in key_attributes)] = item
+    write_requests = [{"PutRequest": {"Item": item}} for item in unique_items.values()]
+    return batch_write_requests(table_name, write_requests, dynamodb_resource=dynamodb_resource, max_workers=max_workers)
+
+# BatchGetItem reads at most 100 keys per call
+DDB_BATCH_GET_SIZE = 100
+
+def batch_get_items(table_name, keys, attributes=None, dynamodb_resource=None):
+    """
+    The items that exist for a list of keys, fetched 100 keys per BatchGetItem call (retrying UnprocessedKeys).
+    attributes limits what is read; the key attributes are always included. Keys that still couldn't be read
+    after DDB_BATCH_WRITE_MAX_ATTEMPTS are logged and left out, as if they didn't exist.
+    """
+    if not keys:
+        return []
+    client = (dynamodb_resource or get_dynamodb_resource()).meta.client
+    request_template = {}
+    if attributes:
+        names = {f"#p{i}": attribute for i, attribute in enumerate(dict.fromkeys(["UserId", "FileKey", *attributes]))}
+        request_template = {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+    items = []
+    for i in range(0, len(keys), DDB_BATCH_GET_SIZE):
+        pending = keys[i:i + DDB_BATCH_GET_SIZE]
+        for attempt in range(DDB_BATCH_WRITE_MAX_ATTEMPTS):
+            if attempt > 0:
+                _backoff_sleep(attempt)
+            try:
+                response = client.batch_get_item(RequestItems={table_name: {**request_template, "Keys": pending}})
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in DDB_THROTTLING_ERRORS:
+                    raise
+                continue
+            items.extend(response.get("Responses", {}).get(table_name, []))
+            pending = response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+            if not pending:
+                break
+        if pending:
+            logger.warning("%d keys of %s could not be read", len(pending), table_name)
+    return items
@@ -0,0 +1,318 @@
+import io
+import pydicom
+from decimal import Decimal
+from .ddb_service import with_record_type_key, get_dicom_table, batch_get_items
+
+# This module turns DICOM headers into the metadata records we store. It is shared by every ingest path
+# (upload_dicom, the S3 event worker, ...).
+
+# DICOM Tag mapping dictionary
+DICOM_TAGS = {
+    # Patient Information
+    "PatientID": "00100020",
+    "PatientName": "00100010",
+    "PatientSex": "00100040",
+    "PatientAge": "00101010",
+    "PatientWeight": "00101030",
+    "PatientBirthDate": "00100030",                # Date of birth (YYYYMMDD)
+    "PatientSize": "00101020",                     # Height in meters
+    "EthnicGroup": "00102160",                     # Ethnic background (e.g. ASIAN, HISPANIC)
+    "OtherPatientIDs": "00101000",                 # Legacy or secondary IDs
+    "OtherPatientNames": "00101001",               # Aliases or alternative names
+    "PatientComments": "00104000",                 # Free-text comments (technician/radiologist)
+    "AdditionalPatientHistory": "001021B0",        # Medical history entered by operator
+    "PregnancyStatus": "001021C0",                 # DICOM-coded pregnancy state
+    "PatientAddress": "00101040",                  # Street address (rarely used)
+    "CountryOfResidence": "00102150",              # Often for epidemiological tracking
+    "RegionOfResidence": "00102152",               # Optional regional info
+    "PatientTelephoneNumbers": "00102154",         # Phone contact
+    "ResponsiblePerson": "00102201",               # Guardian/responsible adult
+    "ResponsiblePersonRole": "00102202",           # Relationship to patient
+    "ResponsibleOrganization": "00102203",         # Employer, clinic, guardian org
+
+    # Study Information
+    "StudyID": "00200010",
+    "StudyDate": "00080020",
+    "StudyDescription": "00081030",
+    "StudyInstanceUID": "0020000D",
+    "AccessionNumber": "00080050",
+    "StudyTime": "00080030",
+    "ReferringPhysicianName": "00080090",
+
+    # Series Information
+    "SeriesInstanceUID": "0020000E",
+    "SeriesNumber": "00200011",
+    "SeriesDescription": "0008103E",
+    "Modality": "00080060",
+    "BodyPartExamined": "00180015",
+
+    # Instance Information
+    "SOPInstanceUID": "00080018",
+    "InstanceNumber": "00200013",
+    "PixelSpacing": "00280030",
+    "SliceThickness": "00180050",
+    "ImagePositionPatient": "00200032",
+    "ImageOrientationPatient": "00200037",
+    "FrameOfReferenceUID": "00200052",
+    "WindowCenter": "00281050",
+    "WindowWidth": "00281051",
+    "BitsAllocated": "00280100",
+    "BitsStored": "00280101",
+    "Columns": "00280011",
+    "Rows": "00280010",
+    "PhotometricInterpretation": "00280004",
+    "SOPClassUID": "00080016",
+    "NumberOfFrames": "00280008",
+
+    # Equipment & Acquisition Information
+    "Manufacturer": "00080070",
+    "ManufacturerModelName": "00081090",
+    "SoftwareVersions": "00181020",
+    "ContrastBolusAgent": "00180010",
+    "ScanOptions": "00180022",
+    "KVP": "00180060",
+    "ExposureTime": "00181150",
+    "XRayTubeCurrent": "00181151",
+    "ConvolutionKernel": "00181210"
+}
+
+def get_dicom_value(dicom_data, attribute, default="Unknown"):
+    """Safely fetches a DICOM attribute as a string."""
+    value = getattr(dicom_data, attribute, default)
+    if value is None or value == '':
+        return default
+    return str(value)
+
+def convert_to_dicom_tags(metadata_dict):
+    """Convert attribute names to DICOM tags in metadata dictionary."""
+    tagged_metadata = {}
+    
+    for key, value in metadata_dict.items():
+        # If the key has a corresponding DICOM tag, use the tag as the key
+        if key in DICOM_TAGS:
+            tagged_metadata[DICOM_TAGS[key]] = value
+        else:
+            # Keep non-DICOM fields as-is (like UserId, FileKey, etc.)
+            tagged_metadata[key] = value
+    
+    return tagged_metadata
+
+def numToDecimal(metadata):
+    """Convert numeric values to Decimal to store in DynamoDB"""
+    for key, value in metadata.items():
+        if isinstance(value, str) and value.replace(".", "", 1).isdigit():
+            metadata[key] = Decimal(value)
+    return metadata
+
+def validate_dicom_file(file_obj):
+    try:
+        current_pos = file_obj.tell()
+        file_obj.seek(0)
+
+        # Read with force=True to allow non-standard but valid DICOMs
+        dataset = pydicom.dcmread(file_obj, force=True)
+
+        # Check essential attributes
+        required_attrs = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+        missing_attrs = [attr for attr in required_attrs if not hasattr(dataset, attr)]
+
+        if missing_attrs:
+            file_obj.seek(current_pos)
+            return False, f"Missing required DICOM attributes: {', '.join(missing_attrs)}"
+
+        file_obj.seek(current_pos)
+        return True, dataset
+
+    except Exception as e:
+        file_obj.seek(current_pos)
+        return False, f"DICOM validation error: {str(e)}"
+
+def read_dicom_header(file_obj):
+    """Parse a DICOM file up to (not including) its PixelData, returns (dataset, has_pixel_data)."""
+    size = getattr(file_obj, "size", None)
+    if size is None:
+        file_obj.seek(0, io.SEEK_END)
+        size = file_obj.tell()
+
+    file_obj.seek(0)
+    dataset = pydicom.dcmread(file_obj, force=True, stop_before_pixels=True)
+
+    # When dcmread stops at PixelData it rewinds to the start of that element, so if anything is
+    # left unread the file carries pixel data. Without PixelData it reads all the way to the end.
+    has_pixel_data = file_obj.tell() < size
+    file_obj.seek(0)
+    return dataset, has_pixel_data
+
+def parse_dicom_header_bytes(data, is_complete):
+    """
+    Parse a header from the first bytes of a file (a ranged GET, the start of an upload stream...).
+    Returns (dataset, has_pixel_data), or None when the header doesn't fit in data yet and more bytes are needed.
+    is_complete says data is the whole file.
+    """
+    buffer = io.BytesIO(data)
+    try:
+        dataset = pydicom.dcmread(buffer, force=True, stop_before_pixels=True)
+    except Exception:
+        if is_complete:
+            raise
+        return None
+
+    # Stopped at PixelData inside our bytes, so everything before it (the whole header) was read
+    if buffer.tell() < len(data):
+        return dataset, True
+    if is_complete:
+        return dataset, False
+    return None
+
+# Validate whether all datasets have the same StudyInstanceUID, SeriesInstanceUID, and PatientID
+def validate_dicom_consistency(datasets):
+    if not datasets:
+        return False, "No files provided"
+    
+    # Use the first dataset to get reference values
+    first_ds = datasets[0]
+    study_uid = getattr(first_ds, "StudyInstanceUID", None)
+    patient_id = getattr(first_ds, "PatientID", None)
+    series_uid = getattr(first_ds, "SeriesInstanceUID", None)
+    
+    if not study_uid or not patient_id or not series_uid:
+        return False, "First file missing StudyInstanceUID, SeriesInstanceUID, or PatientID"
+    
+    # Check all other datasets
+    inconsistencies = []
+    
+    for i, ds in enumerate(datasets[1:], 1):
+        if getattr(ds, "StudyInstanceUID", None) != study_uid:
+            inconsistencies.append(f"File {i+1}: Different StudyInstanceUID")
+        
+        if getattr(ds, "PatientID", None) != patient_id:
+            inconsistencies.append(f"File {i+1}: Different PatientID")
+
+        if getattr(ds, "SeriesInstanceUID", None) != series_uid:
+            inconsistencies.append(f"File {i+1}: Different SeriesInstanceUID")
+    
+    if inconsistencies:
+        return False, f"Files show inconsistencies: {'; '.join(inconsistencies)}"
+    
+    return True, {"StudyInstanceUID": study_uid, "PatientID": patient_id}
+
+def build_base_metadata(first_instance_dicom_data, user_id, timestamp):
+    """Metadata shared by every record of an upload, taken from its first instance"""
+    # Base metadata with attribute names for the "study" and "instance" data types (will be converted to tags later)
+    base_metadata = {
+        "UserId": user_id,
+        "UploadTimestamp": timestamp,
+
+        # Patient Information
+        "PatientID": get_dicom_value(first_instance_dicom_data, "PatientID"),
+        "PatientName": get_dicom_value(first_instance_dicom_data, "PatientName"),
+        "PatientSex": get_dicom_value(first_instance_dicom_data, "PatientSex"),
+        "PatientAge": get_dicom_value(first_instance_dicom_data, "PatientAge"),
+        "PatientWeight": get_dicom_value(first_instance_dicom_data, "PatientWeight"),
+
+        # Study Information
+        "StudyID": get_dicom_value(first_instance_dicom_data, "StudyID"),
+        "StudyDate": get_dicom_value(first_instance_dicom_data, "StudyDate"),
+        "StudyDescription": get_dicom_value(first_instance_dicom_data, "StudyDescription"),
+        "StudyInstanceUID": get_dicom_value(first_instance_dicom_data, "StudyInstanceUID"),
+        "AccessionNumber": get_dicom_value(first_instance_dicom_data, "AccessionNumber"),
+        "StudyTime": get_dicom_value(first_instance_dicom_data, "StudyTime", "120000"),
+
+        # Equipment & Acquisition Information
+        "Manufacturer": get_dicom_value(first_instance_dicom_data, "Manufacturer"),
+        "ManufacturerModelName": get_dicom_value(first_instance_dicom_data, "ManufacturerModelName"),
+        "SoftwareVersions": get_dicom_value(first_instance_dicom_data, "SoftwareVersions"),
+        "ContrastBolusAgent": get_dicom_value(first_instance_dicom_data, "ContrastBolusAgent"),
+        "ScanOptions": get_dicom_value(first_instance_dicom_data, "ScanOptions"),
+        "KVP": get_dicom_value(first_instance_dicom_data, "KVP"),
+        "ExposureTime": get_dicom_value(first_instance_dicom_data, "ExposureTime"),
+        "XRayTubeCurrent": get_dicom_value(first_instance_dicom_data, "XRayTubeCurrent"),
+        "ConvolutionKernel": get_dicom_value(first_instance_dicom_data, "ConvolutionKernel")
+    }
+    return base_metadata
+
+# Hex SHA-256 of the stored file, on instance records written by upload_dicom
+INSTANCE_CHECKSUM_ATTRIBUTE = "ContentSHA256"
+
+def instance_s3_key(user_id, dicom_ds):
+    patient_id = get_dicom_value(dicom_ds, "PatientID")
+    study_instance_uid = get_dicom_value(dicom_ds, "StudyInstanceUID")
+    series_instance_uid = get_dicom_value(dicom_ds, "SeriesInstanceUID")
+    sop_instance_uid = get_dicom_value(dicom_ds, "SOPInstanceUID")
+    return f"{user_id}/{patient_id}/{study_instance_uid}/{series_instance_uid}/{sop_instance_uid}.dcm"
+
+def stored_instance_checksums(user_id, file_keys):
+    """{FileKey: ContentSHA256 or None} of those keys that already have an instance record (one BatchGetItem per 100)"""
+    table = get_dicom_table()
+    keys = [{"UserId": user_id, "FileKey": file_key} for file_key in dict.fromkeys(file_keys)]
+    items = batch_get_items(table.name, keys, attributes=["DataType", INSTANCE_CHECKSUM_ATTRIBUTE])
+    return {item["FileKey"]: item.get(INSTANCE_CHECKSUM_ATTRIBUTE) for item in items if item.get("DataType") == "instance"}
+
+def build_instance_metadata(dicom_ds, base_metadata, s3_key, has_pixel_data, total_size_bytes, content_sha256=None):
+    """Final (tagged, DynamoDB-ready) instance record for one parsed header"""
+    # Extract all the required tags (still using attribute names for reading)
+    patient_id = get_dicom_value(dicom_ds, "PatientID")
+    study_instance_uid = get_dicom_value(dicom_ds, "StudyInstanceUID")
+    series_instance_uid = get_dicom_value(dicom_ds, "SeriesInstanceUID")
+    sop_instance_uid = get_dicom_value(dicom_ds, "SOPInstanceUID")
+    composite_sort_key = f"{study_instance_uid}#{series_instance_uid}#{sop_instance_uid}"
+
+    # Instance metadata with attribute names (will be converted to tags)
+    instance_metadata = {
+        **base_metadata,
+        "FileKey": s3_key,
+        "CompositeSortKey": composite_sort_key,
+
+        # Patient Information (overwrite with instance-specific values)
+        "PatientID": patient_id,
+        "PatientName": get_dicom_value(dicom_ds, "PatientName"),
+        "PatientSex": get_dicom_value(dicom_ds, "PatientSex"),
+        "PatientAge": get_dicom_value(dicom_ds, "PatientAge"),
+        "PatientWeight": get_dicom_value(dicom_ds, "PatientWeight"),
+
+        # Study Information
+        "StudyID": get_dicom_value(dicom_ds, "StudyID"),
+        "StudyDate": get_dicom_value(dicom_ds, "StudyDate"),
+        "StudyDescription": get_dicom_value(dicom_ds, "StudyDescription"),
+        "StudyInstanceUID": study_instance_uid,
+        "AccessionNumber": get_dicom_value(dicom_ds, "AccessionNumber"),
+
+        # Series Information
+        "SeriesInstanceUID": series_instance_uid,
+        "SeriesNumber": get_dicom_value(dicom_ds, "SeriesNumber", "1"),
+        "SeriesDescription": get_dicom_value(dicom_ds, "SeriesDescription"),
+        "Modality": get_dicom_value(dicom_ds, "Modality", "OT"),
+        "BodyPartExamined": get_dicom_value(dicom_ds, "BodyPartExamined"),
+
+        # Instance Information
+        "SOPInstanceUID": sop_instance_uid,
+        "InstanceNumber": get_dicom_value(dicom_ds, "InstanceNumber", "1"),
+        "PixelSpacing": get_dicom_value(dicom_ds, "PixelSpacing", "0.5\\0.5"),
+        "SliceThickness": get_dicom_value(dicom_ds, "SliceThickness", "1.0"),
+        "ImagePositionPatient": get_dicom_value(dicom_ds, "ImagePositionPatient", "0\\0\\0"),
+        "ImageOrientationPatient": get_dicom_value(dicom_ds, "ImageOrientationPatient", "1\\0\\0\\0\\1\\0"),
+        "FrameOfReferenceUID": get_dicom_value(dicom_ds, "FrameOfReferenceUID"),
+        "WindowCenter": get_dicom_value(dicom_ds, "WindowCenter", "40"),
+        "WindowWidth": get_dicom_value(dicom_ds, "WindowWidth", "400"),
+        "BitsAllocated": get_dicom_value(dicom_ds, "BitsAllocated", "16"),
+        "BitsStored": get_dicom_value(dicom_ds, "BitsStored", "12"),
+        "Columns": get_dicom_value(dicom_ds, "Columns", "512"),
+        "Rows": get_dicom_value(dicom_ds, "Rows", "512"),
+        "PhotometricInterpretation": get_dicom_value(dicom_ds, "PhotometricInterpretation", "MONOCHROME2"),
+        "SOPClassUID": get_dicom_value(dicom_ds, "SOPClassUID", "1.2.840.10008.5.1.4.1.1.2"),
+        "NumberOfFrames": int(getattr(dicom_ds, "NumberOfFrames", 1)),
+
+        # Extra metadata
+        "TotalSizeBytes": total_size_bytes,
+        "SliceIndex": int(get_dicom_value(dicom_ds, "InstanceNumber", "1")),
+        "DataType": "instance",
+        "HasPixelData": has_pixel_data
+    }
+    if content_sha256:
+        # Lets a re-upload of the same SOPInstanceUID tell an identical file from a changed one
+        instance_metadata[INSTANCE_CHECKSUM_ATTRIBUTE] = content_sha256
+
+    # Convert attribute names to DICOM tags
+    tagged_instance_metadata = convert_to_dicom_tags(instance_metadata)
+    final_instance_metadata = with_record_type_key(numToDecimal(tagged_instance_metadata))
+    return final_instance_metadata
@@ -0,0 +1,569 @@
+import logging
+import os
+import hashlib
+from datetime import datetime
+from decimal import Decimal
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from .dicom_service import (
+    get_dicom_value, convert_to_dicom_tags, numToDecimal, parse_dicom_header_bytes,
+    build_base_metadata, build_instance_metadata, instance_s3_key
+)
+from .ddb_service import record_type_key, get_dicom_table, batch_put_items, batch_get_items
+from .stats_service import record_upload_in_stats
+from .s3_service import get_s3_client, user_id_from_staging_key
+from .transfer_policy import copy_transfer_config
+from .metrics import inc_counter
+from .thumbnail_service import store_series_thumbnail
+from .metadata_cache import bump_data_version
+from .search_service import index_study, search_fields, SEARCH_FIELDS_ATTRIBUTE
+
+logger = logging.getLogger(__name__)
+
+# Headers are read with ranged GETs: start small (most headers are a few KB) and grow until PixelData shows up
+INGEST_HEADER_RANGE_BYTES = int(os.getenv("DICOM_INGEST_HEADER_RANGE_BYTES", str(64 * 1024)))
+INGEST_MAX_HEADER_BYTES = int(os.getenv("DICOM_INGEST_MAX_HEADER_BYTES", str(16 * 1024 * 1024)))
+INGEST_CONCURRENCY = int(os.getenv("DICOM_INGEST_CONCURRENCY", "8"))
+
+# This module writes the records that summarize stored instances (series, study, patient) and, for the
+# direct-to-S3 path, turns S3 ObjectCreated events into those records.
+
+# Rollup attributes kept as DynamoDB string sets so new UIDs can be ADDed without reading the record first
+ROLLUP_SET_ATTRIBUTES = ("SOPInstanceUIDList", "SeriesInstanceUIDList", "StudyInstanceUIDList")
+
+def _is_validation_error(e):
+    return e.response.get("Error", {}).get("Code") == "ValidationException"
+
+def convert_rollup_lists_to_sets(table, key):
+    """
+    Records written before the rollups used UpdateItem hold their UID lists as plain lists, which ADD can't touch.
+    Turn them into string sets in place (a no-op for attributes that already are sets).
+    """
+    names = {f"#s{i}": attribute for i, attribute in enumerate(ROLLUP_SET_ATTRIBUTES)}
+    item = table.get_item(Key=key, ProjectionExpression=", ".join(names), ExpressionAttributeNames=names).get("Item", {})
+    for attribute in ROLLUP_SET_ATTRIBUTES:
+        value = item.get(attribute)
+        if not isinstance(value, list):
+            continue
+        try:
+            if value:
+                update_expression, values = "SET #a = :set", {":set": set(value), ":list": "L"}
+            else:
+                # There is no such thing as an empty set in DynamoDB, ADD will create it
+                update_expression, values = "REMOVE #a", {":list": "L"}
+            table.update_item(
+                Key=key,
+                UpdateExpression=update_expression,
+                # Only if nobody converted it in the meantime
+                ConditionExpression="attribute_type(#a, :list)",
+                ExpressionAttributeNames={"#a": attribute},
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+
+# A guarded rollup write checks each of its SOPInstanceUIDs with contains(), this many keep the condition well
+# inside DynamoDB's 4 KB expression limit (larger batches are merged in several writes)
+ROLLUP_GUARD_MAX_UIDS = int(os.getenv("DICOM_ROLLUP_GUARD_MAX_UIDS", "100"))
+
+def update_rollup(table, key, set_fields, snapshot_fields, add_fields, guard=None):
+    """
+    One UpdateItem for a rollup record: SET set_fields, set snapshot_fields only if they are missing (the first
+    upload wins), ADD add_fields (numbers or sets). With guard=(attribute, uids) the update only goes through if
+    none of uids are in that set yet, otherwise it raises ConditionalCheckFailedException and writes nothing.
+    Returns the updated attributes as they were before the update (empty for a new record), which costs no extra
+    read capacity.
+    """
+    names = {}
+    values = {}
+    set_clauses = []
+    add_clauses = []
+
+    def placeholder(prefix, attribute, value):
+        index = len(names)
+        names[f"#{prefix}{index}"] = attribute
+        values[f":{prefix}{index}"] = value
+        return f"#{prefix}{index}", f":{prefix}{index}"
+
+    for attribute, value in set_fields.items():
+        name, val = placeholder("s", attribute, value)
+        set_clauses.append(f"{name} = {val}")
+    for attribute, value in snapshot_fields.items():
+        name, val = placeholder("f", attribute, value)
+        set_clauses.append(f"{name} = if_not_exists({name}, {val})")
+    for attribute, value in add_fields.items():
+        name, val = placeholder("a", attribute, value)
+        add_clauses.append(f"{name} {val}")
+
+    update_expression = "SET " + ", ".join(set_clauses)
+    if add_clauses:
+        update_expression += " ADD " + ", ".join(add_clauses)
+
+    update_kwargs = {
+        "Key": key,
+        "UpdateExpression": update_expression,
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+        "ReturnValues": "UPDATED_OLD",
+    }
+    if guard and guard[1]:
+        guard_attribute, guard_uids = guard
+        names["#g"] = guard_attribute
+        clauses = []
+        for index, uid in enumerate(guard_uids):
+            values[f":g{index}"] = uid
+            clauses.append(f"contains(#g, :g{index})")
+        update_kwargs["ConditionExpression"] = f"attribute_not_exists(#g) OR NOT ({' OR '.join(clauses)})"
+    try:
+        response = table.update_item(**update_kwargs)
+    except ClientError as e:
+        # ADD on a UID list stored as a list (older records)
+        if not _is_validation_error(e):
+            raise
+        convert_rollup_lists_to_sets(table, key)
+        response = table.update_item(**update_kwargs)
+    return response.get("Attributes", {})
+
+def _stored_sop_uids(table, key):
+    item = table.get_item(
+        Key=key, ProjectionExpression="#s", ExpressionAttributeNames={"#s": "SOPInstanceUIDList"}, ConsistentRead=True,
+    ).get("Item", {})
+    return set(item.get("SOPInstanceUIDList") or ())
+
+def merge_instances(table, key, set_fields, snapshot_fields, sop_uids, uploaded_size, instance_sizes=None, add_fields=None):
+    """
+    ADD instances (and add_fields) to a series or study rollup. Each write is guarded so it only goes through if the
+    record has none of its SOPInstanceUIDs yet; when it has some (a re-upload, a retried commit) the write is redone
+    without them after reading the record's UID set, so counts only ever grow by new instances. Their bytes are taken
+    back out of uploaded_size when instance_sizes (SOPInstanceUID -> size) is known.
+    Returns (record before the merge as update_rollup returns it, new instances, bytes added).
+    """
+    pending = sorted(sop_uids)
+    chunks = [pending[i:i + ROLLUP_GUARD_MAX_UIDS] for i in range(0, len(pending), ROLLUP_GUARD_MAX_UIDS)] or [[]]
+    previous = None
+    new_instances = 0
+    added_size = Decimal(0)
+    for index, chunk in enumerate(chunks):
+        # The first write carries the whole upload's bytes, the instances the record already had are taken back
+        size = uploaded_size if index == 0 else Decimal(0)
+        chunk_add_fields = dict(add_fields or {}) if index == 0 else {}
+        while True:
+            fields = {**chunk_add_fields, "NumberOfInstances": len(chunk), "TotalStudySizeBytes": size}
+            if chunk:
+                fields["SOPInstanceUIDList"] = set(chunk)
+            try:
+                old = update_rollup(table, key, set_fields, snapshot_fields, fields, guard=("SOPInstanceUIDList", chunk))
+                break
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                    raise
+                stored = _stored_sop_uids(table, key)
+                if instance_sizes:
+                    size -= Decimal(sum(instance_sizes.get(sop, 0) for sop in chunk if sop in stored))
+                chunk = [sop for sop in chunk if sop not in stored]
+        if previous is None:
+            previous = old
+        new_instances += len(chunk)
+        added_size += size
+    return previous, new_instances, added_size
+
+def _tagged(metadata):
+    return numToDecimal(convert_to_dicom_tags(metadata))
+
+def write_study_rollups(table, user_id, first_instance_dicom_data, base_metadata, sop_uid_list, series_uid_set, uploaded_size_bytes, timestamp,
+                        instance_sizes=None):
+    """
+    Merge newly stored instances of one series into the series, study and patient records, and into the
+    user's stats aggregate. first_instance_dicom_data is any header of the batch (used for the snapshot fields).
+    Each record is a single UpdateItem, so concurrent uploads to the same study can't overwrite each other.
+    Instances the records already had aren't counted again (see merge_instances), nor their bytes with instance_sizes
+    (SOPInstanceUID -> size), so merging the same instances twice (a retried commit) changes nothing.
+    Returns the series record's FileKey if this created the series (see store_series_thumbnail), else None.
+    """
+    patient_id = get_dicom_value(first_instance_dicom_data, "PatientID")
+    study_instance_uid = get_dicom_value(first_instance_dicom_data, "StudyInstanceUID")
+    series_instance_uid = get_dicom_value(first_instance_dicom_data, "SeriesInstanceUID")
+    sop_uid_set = set(sop_uid_list)
+    uploaded_size = Decimal(str(uploaded_size_bytes))
+
+    # Snapshot fields shared by series and study records, taken from the first upload that created the record
+    snapshot_metadata = {
+        **{k: v for k, v in base_metadata.items() if k not in ("UserId", "UploadTimestamp")},
+        "StudyName": get_dicom_value(first_instance_dicom_data, "StudyDescription"),
+        "StudyUIDHash": hashlib.sha1(study_instance_uid.encode()).hexdigest(),
+
+        # Series Information from first file (snapshot)
+        "SeriesInstanceUID": get_dicom_value(first_instance_dicom_data, "SeriesInstanceUID"),
+        "SeriesNumber": get_dicom_value(first_instance_dicom_data, "SeriesNumber", "1"),
+        "SeriesDescription": get_dicom_value(first_instance_dicom_data, "SeriesDescription"),
+        "Modality": get_dicom_value(first_instance_dicom_data, "Modality", "OT"),
+        "BodyPartExamined": get_dicom_value(first_instance_dicom_data, "BodyPartExamined"),
+    }
+    # --- Series record ---
+    series_s3_key = f"{user_id}/{patient_id}/{study_instance_uid}/{series_instance_uid}/"
+    series_key = {"UserId": user_id, "FileKey": series_s3_key}
+    previous_series, _, _ = merge_instances(
+        table, series_key,
+        set_fields={"UploadTimestamp": timestamp, "DataType": "series"},
+        snapshot_fields={**_tagged(dict(snapshot_metadata)), "RecordTypeKey": record_type_key("series", series_s3_key)},
+        sop_uids=sop_uid_set, uploaded_size=uploaded_size, instance_sizes=instance_sizes,
+    )
+
+    # --- Study record ---
+    study_s3_key = f"{user_id}/{patient_id}/{study_instance_uid}/"
+    study_key = {"UserId": user_id, "FileKey": study_s3_key}
+    study_snapshot = {
+        **snapshot_metadata,
+        "ReferringPhysicianName": get_dicom_value(first_instance_dicom_data, "ReferringPhysicianName"),
+    }
+    study_search_fields = search_fields(study_snapshot)
+    previous_study, new_instances, added_size = merge_instances(
+        table, study_key,
+        set_fields={"UploadTimestamp": timestamp, "DataType": "study"},
+        snapshot_fields={
+            **_tagged(study_snapshot),
+            SEARCH_FIELDS_ATTRIBUTE: study_search_fields,
+            "RecordTypeKey": record_type_key("study", study_s3_key),
+        },
+        sop_uids=sop_uid_set, uploaded_size=uploaded_size, instance_sizes=instance_sizes,
+        add_fields={"SeriesInstanceUIDList": set(series_uid_set)},
+    )
+
+    # Keep the user's stats aggregate in step with counter updates instead of recomputing it on every dashboard load
+    is_new_study = not previous_study
+    try:
+        record_upload_in_stats(
+            user_id,
+            new_instances=new_instances,
+            added_size_bytes=added_size,
+            study_size_bytes=Decimal(str(previous_study.get("TotalStudySizeBytes", 0))) + added_size,
+            upload_ts=timestamp,
+            previous_upload_ts=previous_study.get("UploadTimestamp"),
+            is_new_study=is_new_study,
+        )
+    except Exception as e:
+        logger.exception("Failed to update the stats aggregate for %s: %s", user_id, e)
+
+    # Searchable fields are snapshots too, so only the upload that created the study indexes it
+    if is_new_study:
+        index_study(table, user_id, {SEARCH_FIELDS_ATTRIBUTE: study_search_fields, "FileKey": study_s3_key})
+
+    # --- Patient record ---
+    patient_s3_key = f"{user_id}/{patient_id}/"  # Base path for patient files
+    patient_snapshot = {"PatientID": patient_id}
+    # Optional: birthdate, region, contact info, etc.
+    for key in (
+        "PatientName", "PatientSex", "PatientAge", "PatientWeight",
+        "PatientBirthDate", "EthnicGroup", "PatientSize", "PatientComments",
+        "PatientAddress", "CountryOfResidence", "RegionOfResidence",
+        "PatientTelephoneNumbers", "ResponsiblePerson", "ResponsiblePersonRole"
+    ):
+        patient_snapshot[key] = get_dicom_value(first_instance_dicom_data, key)
+
+    update_rollup(
+        table, {"UserId": user_id, "FileKey": patient_s3_key},
+        set_fields={"UploadTimestamp": timestamp, "DataType": "patient"},
+        snapshot_fields={**_tagged(patient_snapshot), "RecordTypeKey": record_type_key("patient", patient_s3_key)},
+        add_fields={"StudyInstanceUIDList": {study_instance_uid}},
+    )
+
+    # Cached metadata reads of this user are stale from here on
+    bump_data_version(table, user_id)
+
+    # The rollup write only hands back the attributes it updated, so the upload that creates the series renders its thumbnail
+    return None if previous_series else series_s3_key
+
+def parent_key(file_key):
+    """FileKey of the record a series, study or instance record rolls up into (UIDs never contain "/")"""
+    return file_key.rstrip("/").rsplit("/", 1)[0] + "/"
+
+def _take_out_of_rollup(table, key, guard_attribute, guard_uid, instance_count, size_bytes, sop_uids=(), series_uid=None):
+    """
+    Take instances back out of a series or study record, the reverse of what write_study_rollups added. Only if the
+    record still lists guard_uid in guard_attribute, so a retried delete, or instances a session stored that were
+    never rolled up, change nothing. Returns whether the record changed.
+    """
+    names = {"#n": "NumberOfInstances", "#size": "TotalStudySizeBytes", "#guard": guard_attribute}
+    values = {":n": -instance_count, ":size": -Decimal(str(size_bytes)), ":guard": guard_uid}
+    delete_clauses = []
+    if sop_uids:
+        names["#sops"] = "SOPInstanceUIDList"
+        values[":sops"] = set(sop_uids)
+        delete_clauses.append("#sops :sops")
+    if series_uid:
+        names["#series"] = "SeriesInstanceUIDList"
+        values[":series"] = {series_uid}
+        delete_clauses.append("#series :series")
+
+    update_kwargs = {
+        "Key": key,
+        "UpdateExpression": "ADD #n :n, #size :size" + (" DELETE " + ", ".join(delete_clauses) if delete_clauses else ""),
+        "ConditionExpression": "contains(#guard, :guard)",
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+    }
+    try:
+        try:
+            table.update_item(**update_kwargs)
+        except ClientError as e:
+            # DELETE on a UID list stored as a list (older records)
+            if not _is_validation_error(e):
+                raise
+            convert_rollup_lists_to_sets(table, key)
+            table.update_item(**update_kwargs)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+def _study_before(table, study_key):
+    return table.get_item(Key=study_key, ProjectionExpression="FileKey, TotalStudySizeBytes", ConsistentRead=True).get("Item")
+
+def remove_series_from_rollups(table, user_id, series):
+    """
+    Take a deleted series record's instances out of its study record. Returns the study as it was before (FileKey
+    and TotalStudySizeBytes), None if the study didn't hold the series.
+    """
+    study_key = {"UserId": user_id, "FileKey": parent_key(series["FileKey"])}
+    study = _study_before(table, study_key)
+    series_uid = series["FileKey"].rstrip("/").rsplit("/", 1)[1]
+    sop_uids = series.get("SOPInstanceUIDList") or ()
+    if study is None or not _take_out_of_rollup(
+        table, study_key, "SeriesInstanceUIDList", series_uid,
+        int(series.get("NumberOfInstances", 0)), series.get("TotalStudySizeBytes", 0), sop_uids=sop_uids, series_uid=series_uid,
+    ):
+        return None
+    return study
+
+def remove_instance_from_rollups(table, user_id, instance_file_key, sop_uid, size_bytes):
+    """
+    Take a deleted instance out of its series and study records. Returns the study as it was before (FileKey and
+    TotalStudySizeBytes), None if the instance wasn't rolled up.
+    """
+    series_key = {"UserId": user_id, "FileKey": parent_key(instance_file_key)}
+    study_key = {"UserId": user_id, "FileKey": parent_key(series_key["FileKey"])}
+    if not _take_out_of_rollup(table, series_key, "SOPInstanceUIDList", sop_uid, 1, size_bytes, sop_uids=[sop_uid]):
+        return None
+    study = _study_before(table, study_key)
+    if study is None or not _take_out_of_rollup(table, study_key, "SOPInstanceUIDList", sop_uid, 1, size_bytes, sop_uids=[sop_uid]):
+        return None
+    return study
+
+def remove_study_from_patient(table, user_id, study_file_key):
+    """Drop a deleted study's UID from its patient record"""
+    patient_key = {"UserId": user_id, "FileKey": parent_key(study_file_key)}
+    study_uid = study_file_key.rstrip("/").rsplit("/", 1)[1]
+    update_kwargs = {
+        "Key": patient_key,
+        "UpdateExpression": "DELETE StudyInstanceUIDList :study",
+        "ConditionExpression": "contains(StudyInstanceUIDList, :uid)",
+        "ExpressionAttributeValues": {":study": {study_uid}, ":uid": study_uid},
+    }
+    try:
+        try:
+            table.update_item(**update_kwargs)
+        except ClientError as e:
+            if not _is_validation_error(e):
+                raise
+            convert_rollup_lists_to_sets(table, patient_key)
+            table.update_item(**update_kwargs)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+
+def parse_s3_event_records(event):
+    """The objects created in an S3 event notification, as {"bucket", "key", "size"} dicts"""
+    objects = []
+    for record in event.get("Records", []):
+        if record.get("eventSource") != "aws:s3" or not record.get("eventName", "").startswith("ObjectCreated:"):
+            continue
+        s3_info = record["s3"]
+        objects.append({
+            "bucket": s3_info["bucket"]["name"],
+            # Keys in notifications are URL encoded (a space arrives as "+")
+            "key": unquote_plus(s3_info["object"]["key"]),
+            "size": s3_info["object"].get("size"),
+        })
+    return objects
+
+def read_header_from_s3(s3, bucket, key, size):
+    """Parse an object's header with ranged GETs instead of downloading it, returns (dataset, has_pixel_data)"""
+    data = b""
+    range_end = INGEST_HEADER_RANGE_BYTES
+    while True:
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(data)}-{range_end - 1}")
+        data += response["Body"].read()
+
+        is_complete = len(data) >= size
+        parsed = parse_dicom_header_bytes(data, is_complete)
+        if parsed is not None:
+            return parsed
+        if is_complete or range_end >= INGEST_MAX_HEADER_BYTES:
+            raise ValueError(f"No DICOM header found in the first {len(data)} bytes")
+        range_end = min(range_end * 4, INGEST_MAX_HEADER_BYTES)
+
+def _read_staged_object(s3, obj):
+    """Read a staged object's header and work out its canonical key. Returns None for objects that are already gone."""
+    bucket, key = obj["bucket"], obj["key"]
+    size = obj.get("size")
+    try:
+        if size is None:
+            size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        dicom_ds, has_pixel_data = read_header_from_s3(s3, bucket, key, size)
+    except ClientError as e:
+        # Redelivered event for an object we already ingested (the staged copy is deleted last)
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+
+    for attribute in ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"):
+        if not getattr(dicom_ds, attribute, None):
+            raise ValueError(f"Missing {attribute}")
+
+    user_id = user_id_from_staging_key(key)
+    canonical_key = instance_s3_key(user_id, dicom_ds)
+    return {
+        "bucket": bucket, "key": key, "size": size, "user_id": user_id,
+        "dataset": dicom_ds, "has_pixel_data": has_pixel_data, "canonical_key": canonical_key,
+    }
+
+def _copy_to_canonical_key(s3, instance):
+    # Server-side copy, the bytes never pass through us. Big objects are copied in parts sized for them.
+    s3.copy(
+        {"Bucket": instance["bucket"], "Key": instance["key"]}, instance["bucket"], instance["canonical_key"],
+        Config=copy_transfer_config(instance["size"]),
+    )
+    return instance
+
+def _drop_staged_copy(s3, instance):
+    try:
+        s3.delete_object(Bucket=instance["bucket"], Key=instance["key"])
+    except Exception as e:
+        logger.warning("Failed to delete staged object %s: %s", instance["key"], e)
+
+def already_stored_keys(table, instances):
+    """Canonical keys of these instances that already have an instance record (one BatchGetItem per 100)"""
+    keys = list({(instance["user_id"], instance["canonical_key"]): None for instance in instances})
+    items = batch_get_items(table.name, [{"UserId": user_id, "FileKey": file_key} for user_id, file_key in keys], attributes=["DataType"])
+    return {(item["UserId"], item["FileKey"]) for item in items if item.get("DataType") == "instance"}
+
+def ingest_s3_objects(objects):
+    """
+    Turn objects uploaded straight to the staging prefix into stored instances: copy each one to its canonical key,
+    write its instance record and merge it into the series/study/patient records, then drop the staged copy.
+    Instances that already have a record (re-uploads) aren't copied or written again, only their staged copy goes.
+    Returns {"Ingested": [canonical keys], "Skipped": [keys], "Duplicates": [canonical keys], "Failed": [{"key", "error"}]}.
+    """
+    s3 = get_s3_client()
+    table = get_dicom_table()
+    timestamp = datetime.utcnow().isoformat()
+    summary = {"Ingested": [], "Skipped": [], "Duplicates": [], "Failed": []}
+
+    staged_objects = []
+    for obj in objects:
+        # Copies to canonical keys raise events too if the notification isn't filtered on the prefix, ignore them
+        if user_id_from_staging_key(obj["key"]) is None:
+            summary["Skipped"].append(obj["key"])
+        else:
+            staged_objects.append(obj)
+
+    read = []
+    with ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY) as executor:
+        futures = [(obj, executor.submit(_read_staged_object, s3, obj)) for obj in staged_objects]
+        for obj, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning("Failed to ingest s3://%s/%s: %s", obj["bucket"], obj["key"], e)
+                summary["Failed"].append({"key": obj["key"], "error": str(e)})
+                continue
+            if result is None:
+                summary["Skipped"].append(obj["key"])
+            else:
+                read.append(result)
+
+        stored_keys = already_stored_keys(table, read) if read else set()
+        new_instances = []
+        for instance in read:
+            if (instance["user_id"], instance["canonical_key"]) in stored_keys:
+                _drop_staged_copy(s3, instance)
+                summary["Duplicates"].append(instance["canonical_key"])
+            else:
+                new_instances.append(instance)
+        if summary["Duplicates"]:
+            inc_counter("dicom_skipped_duplicate_instances_total", len(summary["Duplicates"]))
+
+        staged = []
+        futures = [(instance, executor.submit(_copy_to_canonical_key, s3, instance)) for instance in new_instances]
+        for instance, future in futures:
+            try:
+                staged.append(future.result())
+            except Exception as e:
+                logger.warning("Failed to copy %s to %s: %s", instance["key"], instance["canonical_key"], e)
+                summary["Failed"].append({"key": instance["key"], "error": str(e)})
+
+    # Rollups are per series, like a regular upload request
+    series_groups = {}
+    for instance in staged:
+        series_key = instance["canonical_key"].rsplit("/", 1)[0]
+        series_groups.setdefault(series_key, []).append(instance)
+
+    for instances in series_groups.values():
+        user_id = instances[0]["user_id"]
+        first_instance_dicom_data = instances[0]["dataset"]
+        base_metadata = build_base_metadata(first_instance_dicom_data, user_id, timestamp)
+
+        total_size_bytes = 0
+        items = []
+        for instance in instances:
+            total_size_bytes += instance["size"]
+            items.append(build_instance_metadata(
+                instance["dataset"], base_metadata, instance["canonical_key"], instance["has_pixel_data"], total_size_bytes
+            ))
+        write_summary = batch_put_items(table.name, items)
+        unwritten_keys = {request["PutRequest"]["Item"]["FileKey"] for request in write_summary["FailedRequests"]}
+
+        written = []
+        for instance in instances:
+            if instance["canonical_key"] in unwritten_keys:
+                summary["Failed"].append({"key": instance["key"], "error": "Metadata could not be written to DynamoDB"})
+            else:
+                written.append(instance)
+        if not written:
+            continue
+
+        instance_sizes = {get_dicom_value(instance["dataset"], "SOPInstanceUID"): instance["size"] for instance in written}
+        try:
+            thumbnail_series_key = write_study_rollups(
+                table, user_id, first_instance_dicom_data, base_metadata,
+                list(instance_sizes),
+                {get_dicom_value(instance["dataset"], "SeriesInstanceUID") for instance in written},
+                sum(instance_sizes.values()),
+                timestamp,
+                instance_sizes=instance_sizes,
+            )
+        except Exception as e:
+            logger.exception("Failed to write rollups for %s: %s", user_id, e)
+            summary["Failed"].extend({"key": instance["key"], "error": str(e)} for instance in written)
+            continue
+        if thumbnail_series_key:
+            store_series_thumbnail(
+                table.name, user_id, thumbnail_series_key,
+                [(instance["dataset"], instance["canonical_key"], instance["has_pixel_data"], instance["size"]) for instance in written],
+                bucket=written[0]["bucket"],
+            )
+        inc_counter("dicom_uploaded_instances_total", len(written))
+        inc_counter("dicom_uploaded_bytes_total", sum(instance["size"] for instance in written))
+
+        # Only now is the staged copy redundant; until here a redelivered event can redo the whole thing
+        for instance in written:
+            _drop_staged_copy(s3, instance)
+            summary["Ingested"].append(instance["canonical_key"])
+            logger.info("Ingested instance", extra={"sampled": True, "file_key": instance["canonical_key"], "size": instance["size"]})
+
+    if summary["Failed"]:
+        inc_counter("dicom_failed_instances_total", len(summary["Failed"]))
+    return summary
@@ -0,0 +1,106 @@
+import os
+import time
+import hashlib
+import logging
+from decimal import Decimal
+from django.core.cache import caches
+from django.http import HttpResponse
+from .s3_service import PRESIGNED_URL_MIN_REMAINING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# A user's records only change when they upload or delete, so every write bumps a per-user version number and
+# metadata reads are keyed on it: clients revalidate with If-None-Match and get a 304, and full responses can be
+# served from the Django cache without touching the user's records. Old versions are never invalidated
+# explicitly, their keys just stop being asked for and expire.
+
+# Item in the user's partition holding the version, like "#stats" it can't collide with an S3 key prefix
+DATA_VERSION_FILE_KEY = "#version"
+
+METADATA_CACHE_ENABLED = os.getenv("METADATA_CACHE_ENABLED", "true").lower() == "true"
+METADATA_CACHE_ALIAS = os.getenv("METADATA_CACHE_ALIAS", "default")
+# Responses carry presigned thumbnail URLs, which are only guaranteed PRESIGNED_URL_MIN_REMAINING_SECONDS of
+# life. ETags and cache entries roll over at that interval, so a cached or revalidated copy never holds dead URLs.
+METADATA_ETAG_EPOCH_SECONDS = PRESIGNED_URL_MIN_REMAINING_SECONDS
+METADATA_CACHE_SECONDS = min(int(os.getenv("METADATA_CACHE_SECONDS", "300")), METADATA_ETAG_EPOCH_SECONDS)
+# Reads through the record type index can miss a write for a moment after it. For this long after a bump, reads
+# get no ETag and aren't cached, otherwise a stale list would be pinned to the new version.
+METADATA_SETTLE_SECONDS = float(os.getenv("METADATA_SETTLE_SECONDS", "5"))
+
+def data_version_key(user_id):
+    return {"UserId": user_id, "FileKey": DATA_VERSION_FILE_KEY}
+
+def get_data_version_state(table, user_id):
+    """
+    (version, settled): the user's current data version (0 if they never wrote anything since versions were
+    introduced), and whether its last bump is old enough for the index to have caught up
+    """
+    item = table.get_item(Key=data_version_key(user_id), ConsistentRead=True).get("Item")
+    if not item:
+        return 0, True
+    settled = time.time() - float(item.get("BumpedAt", 0)) >= METADATA_SETTLE_SECONDS
+    return int(item["DataVersion"]), settled
+
+def get_data_version(table, user_id):
+    return get_data_version_state(table, user_id)[0]
+
+def bump_data_version(table, user_id):
+    """Call after changing a user's records. Failures are logged, not raised: the write itself went through."""
+    try:
+        table.update_item(
+            Key=data_version_key(user_id),
+            UpdateExpression="ADD DataVersion :one SET BumpedAt = :now",
+            ExpressionAttributeValues={":one": 1, ":now": Decimal(str(round(time.time(), 3)))},
+        )
+    except Exception as e:
+        logger.exception("Failed to bump the data version of %s: %s", user_id, e)
+
+def metadata_etag(user_id, version, request, settled=True):
+    """
+    ETag of a metadata read: the endpoint, the user's version, the query parameters and the current URL epoch.
+    None for reads right after a write (not settled), those are neither cached nor revalidated.
+    """
+    if not settled:
+        return None
+    params = "&".join(f"{key}={value}" for key, value in sorted(request.GET.items()))
+    epoch = int(time.time() // METADATA_ETAG_EPOCH_SECONDS)
+    # The path keeps endpoints that take the same parameters (search, workspace...) from sharing tags and bodies
+    digest = hashlib.sha1(f"{request.path}|{user_id}|{version}|{epoch}|{params}".encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(request, etag):
+    if etag is None:
+        return False
+    if_none_match = request.headers.get("If-None-Match", "")
+    # Weak comparison; proxies may have added W/ to what we sent
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")) or if_none_match.strip() == "*"
+
+def not_modified_response(etag):
+    response = HttpResponse(status=304)
+    return with_validators(response, etag)
+
+def with_validators(response, etag):
+    if etag is None:
+        response["Cache-Control"] = "no-store"
+        return response
+    response["ETag"] = etag
+    # Browsers keep the body but revalidate every time, which is a cheap 304 until the user's data changes
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+def cached_body(etag):
+    if not METADATA_CACHE_ENABLED or etag is None:
+        return None
+    try:
+        return caches[METADATA_CACHE_ALIAS].get(f"metadata:{etag}")
+    except Exception as e:
+        logger.warning("Metadata cache read failed: %s", e)
+        return None
+
+def cache_body(etag, body):
+    if not METADATA_CACHE_ENABLED or etag is None:
+        return
+    try:
+        caches[METADATA_CACHE_ALIAS].set(f"metadata:{etag}", body, METADATA_CACHE_SECONDS)
+    except Exception as e:
+        logger.warning("Metadata cache write failed: %s", e)
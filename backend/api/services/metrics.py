@@ -0,0 +1,177 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from django.http import HttpResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# In-process metrics in the Prometheus text format, served at /api/metrics. Each worker process keeps its own
+# numbers (scrape every worker, or sum them on the Prometheus side), no extra dependency needed.
+
+# Seconds. Covers a cached token check (sub-millisecond) up to a multi-GB study upload.
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Error codes botocore retries as throttling
+AWS_THROTTLING_ERRORS = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+    "ProvisionedThroughputExceededException", "RequestLimitExceeded", "SlowDown", "TooManyRequestsException",
+}
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+METRIC_HELP = {
+    "api_phase_duration_seconds": ("histogram", "Time spent in each phase of an API view"),
+    "api_request_duration_seconds": ("histogram", "Total time to answer a request, by URL name and status"),
+    "auth_verifications_total": ("counter", "Token verifications by outcome (cached, verified, rejected)"),
+    "dicom_uploaded_bytes_total": ("counter", "Bytes of DICOM instances stored"),
+    "dicom_uploaded_instances_total": ("counter", "DICOM instances stored"),
+    "dicom_failed_instances_total": ("counter", "DICOM instances that could not be stored"),
+    "dicom_skipped_duplicate_instances_total": ("counter", "Uploaded DICOM instances skipped because they were already stored"),
+    "dicom_deleted_records_total": ("counter", "Records removed by deletes"),
+    "s3_part_retries_total": ("counter", "Upload parts/objects sent to S3 again after a failed or mismatched attempt"),
+    "dynamodb_batch_retried_items_total": ("counter", "BatchWriteItem items sent again after coming back unprocessed"),
+    "aws_requests_total": ("counter", "AWS API calls that got a response, retries included in a single call"),
+    "aws_retries_total": ("counter", "Retries botocore made for AWS API calls"),
+    "aws_throttled_responses_total": ("counter", "Throttling errors returned by AWS (before any retry)"),
+    "aws_request_errors_total": ("counter", "AWS API calls that failed after all retries"),
+}
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc_counter(name, value=1, **labels):
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = (name, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(PHASE_BUCKETS) + 2)
+        for i, bound in enumerate(PHASE_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(PHASE_BUCKETS)] += 1
+        histogram[-1] += seconds
+
+@contextmanager
+def timed(view, phase):
+    """with timed("upload_dicom", "parse"): ... records the block's duration, even when it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("api_phase_duration_seconds", time.perf_counter() - start, view=view, phase=phase)
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+def render_metrics():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+
+    lines = []
+    for name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+        metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (metric_name, labels), value in sorted(counters.items()):
+            if metric_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (metric_name, labels), histogram in sorted(histograms.items()):
+            if metric_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(PHASE_BUCKETS, histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            cumulative += histogram[len(PHASE_BUCKETS)]
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def metrics_view(request):
+    # Optional shared secret, for when the route is reachable from outside the VPC
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- botocore event hooks, registered on every client/resource by aws_clients ---
+
+def _operation_labels(event_name):
+    # e.g. "needs-retry.dynamodb.BatchWriteItem"
+    parts = event_name.split(".")
+    return {"service": parts[1] if len(parts) > 1 else "", "operation": parts[2] if len(parts) > 2 else ""}
+
+def _on_needs_retry(event_name, response=None, **kwargs):
+    if response is not None:
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in AWS_THROTTLING_ERRORS:
+            inc_counter("aws_throttled_responses_total", **_operation_labels(event_name), code=error_code)
+    # Returning None leaves the retry decision to botocore
+
+def _on_after_call(event_name, parsed=None, **kwargs):
+    labels = _operation_labels(event_name)
+    inc_counter("aws_requests_total", **labels)
+    retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        inc_counter("aws_retries_total", retries, **labels)
+
+def _on_after_call_error(event_name, exception=None, **kwargs):
+    inc_counter("aws_request_errors_total", **_operation_labels(event_name))
+
+def instrument_client(client):
+    events = client.meta.events
+    events.register("needs-retry", _on_needs_retry, unique_id="metrics-needs-retry")
+    events.register("after-call", _on_after_call, unique_id="metrics-after-call")
+    events.register("after-call-error", _on_after_call_error, unique_id="metrics-after-call-error")
+    return client
+
+class RequestMetricsMiddleware:
+    """Total request time per URL name and status code"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, start):
+        match = getattr(request, "resolver_match", None)
+        url_name = (match.url_name if match else None) or "unmatched"
+        observe("api_request_duration_seconds", time.perf_counter() - start, view=url_name, status=response.status_code)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, start)
+        return response
@@ -1,12 +1,59 @@
-import boto3
+import logging
 import os
+import time
+import threading
+from collections import OrderedDict
 from botocore.exceptions import NoCredentialsError
+from .aws_clients import get_client
+
+logger = logging.getLogger(__name__)
 
 S3_BUCKET = os.getenv("AWS_STORAGE_BUCKET_NAME", "yantra-healthcare-imaging")
 S3_REGION = os.getenv("AWS_S3_REGION", "us-east-1")
 
+# Signed GET URLs are cached per key and handed out again until they get within PRESIGNED_URL_MIN_REMAINING_SECONDS
+# of expiring, so a viewer reopening a series gets the same URLs (and the browser cache keeps working) without us
+# signing them again.
+PRESIGNED_GET_URL_EXPIRATION = int(os.getenv("PRESIGNED_GET_URL_EXPIRATION", "1800"))
+PRESIGNED_URL_MIN_REMAINING_SECONDS = int(os.getenv("PRESIGNED_URL_MIN_REMAINING_SECONDS", "300"))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "20000"))
+
+# (bucket, key, expiration) -> (url, expires_at), least recently used first
+_presigned_urls = OrderedDict()
+_presigned_urls_lock = threading.Lock()
+
 def get_s3_client():
-    return boto3.client("s3", region_name=S3_REGION)
+    return get_client("s3", region_name=S3_REGION)
+
+def presigned_get_url(file_key, expiration=PRESIGNED_GET_URL_EXPIRATION, bucket=S3_BUCKET):
+    """Signed GET URL for a key, from the cache when the cached one still has enough time left"""
+    cache_key = (bucket, file_key, expiration)
+    now = time.time()
+    with _presigned_urls_lock:
+        entry = _presigned_urls.get(cache_key)
+        if entry is not None and entry[1] - now > PRESIGNED_URL_MIN_REMAINING_SECONDS:
+            _presigned_urls.move_to_end(cache_key)
+            return entry[0]
+
+    # Signing is local (no request to S3), no need to hold the lock for it
+    url = get_s3_client().generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": file_key}, ExpiresIn=expiration
+    )
+    if PRESIGNED_URL_CACHE_SIZE > 0 and expiration > PRESIGNED_URL_MIN_REMAINING_SECONDS:
+        with _presigned_urls_lock:
+            _presigned_urls[cache_key] = (url, now + expiration)
+            _presigned_urls.move_to_end(cache_key)
+            while len(_presigned_urls) > PRESIGNED_URL_CACHE_SIZE:
+                _presigned_urls.popitem(last=False)
+    return url
+
+def presigned_get_urls(file_keys, expiration=PRESIGNED_GET_URL_EXPIRATION):
+    """presigned_get_url for many keys, returns {key: url}"""
+    return {file_key: presigned_get_url(file_key, expiration) for file_key in file_keys}
+
+def clear_presigned_url_cache():
+    with _presigned_urls_lock:
+        _presigned_urls.clear()
 
 def generate_and_return_presigned_url(filename, user_id, patient_id, expiration=1800):
     """
@@ -20,7 +67,7 @@ def generate_and_return_presigned_url(filename, user_id, patient_id, expiration=
     # the file
 
     object_key = f"{user_id}/{patient_id_str}/{filename}"
-    print(object_key)
+    logger.debug("Presigning %s", object_key)
 
     s3_client = get_s3_client()
 
@@ -35,14 +82,69 @@ def generate_and_return_presigned_url(filename, user_id, patient_id, expiration=
         return None
 
 def generate_pre_signed_url_with_file_key(file_key):
-    expiration=1800
-    s3_client = get_s3_client()
     try:
-        pre_signed_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": S3_BUCKET, "Key": file_key},
+        return presigned_get_url(file_key)
+    except NoCredentialsError:
+        return None
+
+# Direct-to-S3 uploads: the browser PUTs files into a staging prefix and the ingest worker
+# (manage.py ingest_s3_events) moves them to their final key once it has read their header.
+# The bucket needs a CORS rule allowing PUT from the frontend's origin and exposing the ETag header.
+DIRECT_UPLOAD_STAGING_PREFIX = os.getenv("DICOM_INGEST_STAGING_PREFIX", "incoming/")
+DIRECT_UPLOAD_URL_EXPIRATION = int(os.getenv("DIRECT_UPLOAD_URL_EXPIRATION", "3600"))
+DIRECT_UPLOAD_MULTIPART_THRESHOLD = int(os.getenv("DIRECT_UPLOAD_MULTIPART_THRESHOLD_BYTES", str(64 * 1024 * 1024)))
+DIRECT_UPLOAD_MIN_PART_SIZE = int(os.getenv("DIRECT_UPLOAD_PART_SIZE_BYTES", str(16 * 1024 * 1024)))
+S3_MAX_PARTS = 10000
+
+def direct_upload_staging_key(user_id, upload_id, index, filename):
+    # Only the base name is kept (folder uploads send relative paths), the index keeps same-named files apart
+    safe_name = os.path.basename(str(filename).replace("\\", "/")) or "instance.dcm"
+    return f"{DIRECT_UPLOAD_STAGING_PREFIX}{user_id}/{upload_id}/{index:05d}-{safe_name}"
+
+def user_id_from_staging_key(key):
+    """The user a staged object belongs to, None if the key isn't in the staging area"""
+    if not key.startswith(DIRECT_UPLOAD_STAGING_PREFIX):
+        return None
+    parts = key[len(DIRECT_UPLOAD_STAGING_PREFIX):].split("/")
+    return parts[0] if len(parts) >= 3 and parts[0] else None
+
+def generate_presigned_put_url(object_key, expiration=DIRECT_UPLOAD_URL_EXPIRATION):
+    s3_client = get_s3_client()
+    return s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": S3_BUCKET, "Key": object_key, "ContentType": "application/dicom"},
+        ExpiresIn=expiration,
+    )
+
+def create_presigned_multipart_upload(object_key, size, expiration=DIRECT_UPLOAD_URL_EXPIRATION):
+    """Start a multipart upload and presign a PUT URL for each of its parts"""
+    s3_client = get_s3_client()
+    part_size = max(DIRECT_UPLOAD_MIN_PART_SIZE, -(-size // S3_MAX_PARTS))
+    part_count = max(1, -(-size // part_size))
+
+    upload = s3_client.create_multipart_upload(Bucket=S3_BUCKET, Key=object_key, ContentType="application/dicom")
+    part_urls = [
+        s3_client.generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": S3_BUCKET, "Key": object_key, "UploadId": upload["UploadId"], "PartNumber": part_number},
             ExpiresIn=expiration,
         )
-        return pre_signed_url
-    except NoCredentialsError:
-        return None
\ No newline at end of file
+        for part_number in range(1, part_count + 1)
+    ]
+    return {"uploadId": upload["UploadId"], "partSize": part_size, "partUrls": part_urls}
+
+def complete_multipart_upload(object_key, upload_id, parts):
+    s3_client = get_s3_client()
+    return s3_client.complete_multipart_upload(
+        Bucket=S3_BUCKET,
+        Key=object_key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": sorted(
+            ({"PartNumber": int(part["PartNumber"]), "ETag": part["ETag"]} for part in parts),
+            key=lambda part: part["PartNumber"]
+        )},
+    )
+
+def abort_multipart_upload(object_key, upload_id):
+    s3_client = get_s3_client()
+    return s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=object_key, UploadId=upload_id)
@@ -0,0 +1,195 @@
+import os
+import re
+import logging
+from boto3.dynamodb.conditions import Key, Attr
+from .ddb_service import get_dicom_table, build_metadata_query, iter_query_pages, batch_put_items, batch_write_requests
+from .dicom_service import DICOM_TAGS
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Study search index, kept in the user's own partition like "#stats". Every study gets one entry per prefix of
+# each token of its searchable fields (#search#t#<prefix>#<study date>#<study key>) and one keyed by its date
+# (#search#d#<date>#<study key>), each carrying the fields a result row shows. A search reads one prefix's entries
+# (or a date range) backwards, newest study first, and stops once it has a page, however many studies match. Entries
+# have no RecordTypeKey, so they stay out of the record type index. They're written when a study is created, removed
+# with it, and `manage.py rebuild_search_index` rebuilds them from the study records (needed after changes to the
+# key layout: entries written under another one are never read or removed).
+
+SEARCH_INDEX_PREFIX = "#search#"
+SEARCH_TERM_PREFIX = "#search#t#"
+SEARCH_DATE_PREFIX = "#search#d#"
+SEARCH_DATA_TYPE = "search"
+SEARCH_FIELDS = ("PatientName", "PatientID", "AccessionNumber", "StudyDescription", "Modality", "StudyDate")
+# Raw strings of SEARCH_FIELDS on study records: the tagged attributes went through numToDecimal, which drops the
+# leading zeros of IDs like "00123"
+SEARCH_FIELDS_ATTRIBUTE = "SearchFields"
+
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "200"))
+SEARCH_MAX_QUERY_TOKENS = 10
+SEARCH_MAX_TOKEN_LENGTH = 64
+# Prefixes up to this long get their own entries, longer query tokens are looked up by their first this many
+# characters and checked against the entries' tokens
+SEARCH_MAX_PREFIX_LENGTH = 12
+
+_TOKEN_SPLIT = re.compile(r"[^0-9a-z]+")
+_DATE = re.compile(r"^\d{8}$")
+
+def tokenize(text):
+    """Lowercase alphanumeric runs: "Doe^John" -> ["doe", "john"], "ACC-0042" -> ["acc", "0042"]"""
+    tokens = []
+    for token in _TOKEN_SPLIT.split(str(text or "").lower()):
+        token = token[:SEARCH_MAX_TOKEN_LENGTH]
+        if token and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+def search_fields(metadata):
+    """The searchable fields of untagged metadata (PatientName: ...), as plain strings"""
+    fields = {}
+    for field in SEARCH_FIELDS:
+        value = str(metadata.get(field) or "")
+        # get_dicom_value's placeholder for missing attributes, not worth a token
+        fields[field] = "" if value == "Unknown" else value
+    return fields
+
+def study_search_fields(study_record):
+    """The searchable fields of a study record, from its raw copy or, for records older than that, its tags"""
+    if SEARCH_FIELDS_ATTRIBUTE in study_record:
+        return search_fields(study_record[SEARCH_FIELDS_ATTRIBUTE])
+    fields = search_fields({field: study_record.get(DICOM_TAGS[field]) for field in SEARCH_FIELDS})
+    # The key holds the PatientID as it was uploaded (<user>/<patient>/<study>/)
+    fields["PatientID"] = study_record["FileKey"].rstrip("/").split("/", 1)[1].rsplit("/", 1)[0]
+    return fields
+
+def search_entry_keys(study_record):
+    """FileKeys of a study's index entries, derived from the record so they can be removed without a lookup"""
+    fields = study_search_fields(study_record)
+    study_key = study_record["FileKey"]
+    study_date = fields["StudyDate"] if _DATE.match(fields["StudyDate"]) else ""
+    tokens = sorted({token for value in fields.values() for token in tokenize(value)})
+    prefixes = sorted({token[:length] for token in tokens for length in range(1, min(len(token), SEARCH_MAX_PREFIX_LENGTH) + 1)})
+    keys = [f"{SEARCH_TERM_PREFIX}{prefix}#{study_date}#{study_key}" for prefix in prefixes]
+    keys.append(f"{SEARCH_DATE_PREFIX}{study_date}#{study_key}")
+    return keys, tokens, fields
+
+def search_entries(user_id, study_record):
+    keys, tokens, fields = search_entry_keys(study_record)
+    study_key = study_record["FileKey"]
+    entry = {
+        "UserId": user_id,
+        "DataType": SEARCH_DATA_TYPE,
+        "StudyKey": study_key,
+        "PatientKey": study_key.rstrip("/").rsplit("/", 1)[0] + "/",
+        "Tokens": tokens,
+        **fields,
+    }
+    return [{**entry, "FileKey": key} for key in keys]
+
+def index_study(table, user_id, study_record):
+    """Add a study to the user's search index. Failures are logged, the rebuild command catches up."""
+    try:
+        summary = batch_put_items(table.name, search_entries(user_id, study_record))
+        if summary["FailedRequests"]:
+            logger.warning("%d search entries of %s were not written", len(summary["FailedRequests"]), study_record["FileKey"])
+    except Exception as e:
+        logger.exception("Failed to index %s for search: %s", study_record.get("FileKey"), e)
+
+def unindex_studies(table, user_id, study_records):
+    """Remove deleted studies from the search index. Failures are logged, the rebuild command catches up."""
+    delete_requests = [
+        {"DeleteRequest": {"Key": {"UserId": user_id, "FileKey": key}}}
+        for study_record in study_records for key in search_entry_keys(study_record)[0]
+    ]
+    if not delete_requests:
+        return
+    try:
+        summary = batch_write_requests(table.name, delete_requests)
+        if summary["FailedRequests"]:
+            logger.warning("%d search entries of %s were not deleted", len(summary["FailedRequests"]), user_id)
+    except Exception as e:
+        logger.exception("Failed to remove deleted studies of %s from the search index: %s", user_id, e)
+
+def rebuild_search_index(user_id):
+    """Drop a user's index entries and recreate them from the study records, returns the number of studies"""
+    table = get_dicom_table()
+    existing_query = {
+        "KeyConditionExpression": Key("UserId").eq(user_id) & Key("FileKey").begins_with(SEARCH_INDEX_PREFIX),
+        "ProjectionExpression": "UserId, FileKey",
+    }
+    stale = [
+        {"DeleteRequest": {"Key": {"UserId": item["UserId"], "FileKey": item["FileKey"]}}}
+        for page_items in iter_query_pages(table, existing_query) for item in page_items
+    ]
+    batch_write_requests(table.name, stale)
+
+    entries = []
+    studies = 0
+    for page_items in iter_query_pages(table, build_metadata_query(user_id, "study")):
+        for study_record in page_items:
+            entries.extend(search_entries(user_id, study_record))
+            studies += 1
+    summary = batch_put_items(table.name, entries)
+    if summary["FailedRequests"]:
+        raise RuntimeError(f"{len(summary['FailedRequests'])} search entries of {user_id} could not be written")
+    return studies
+
+def _matches_all(entry, tokens):
+    # Every query token has to prefix one of the study's tokens ("jo do" finds "Doe^John")
+    return all(any(token.startswith(query_token) for token in entry.get("Tokens", [])) for query_token in tokens)
+
+def search_studies(user_id, text="", modalities=(), date_from=None, date_to=None, limit=SEARCH_DEFAULT_LIMIT):
+    """
+    Studies of a user matching every token of text (as prefixes), optionally only these modalities and study
+    dates (YYYYMMDD, inclusive). Returns (results, has_more), newest study first.
+    """
+    tokens = tokenize(text)[:SEARCH_MAX_QUERY_TOKENS]
+    if tokens:
+        # The longest token is usually the most selective, the others are checked on what it returns
+        prefix = f"{SEARCH_TERM_PREFIX}{max(tokens, key=len)[:SEARCH_MAX_PREFIX_LENGTH]}#"
+    else:
+        prefix = SEARCH_DATE_PREFIX
+    # Entries sort by date within a prefix, so the date range is part of the key condition ("$" sorts right after
+    # the "#" ending a date, "~" after every date)
+    low = f"{prefix}{date_from or ''}"
+    high = f"{prefix}{date_to}$" if date_to else f"{prefix}~"
+    query_kwargs = {
+        "KeyConditionExpression": Key("UserId").eq(user_id) & Key("FileKey").between(low, high),
+        "ScanIndexForward": False,
+        # One more than a page tells whether there is more
+        "Limit": limit + 1,
+    }
+    if modalities:
+        query_kwargs["FilterExpression"] = Attr("Modality").is_in(list(modalities))
+
+    # A study has one entry per prefix, so every entry read is another study
+    results = []
+    has_more = False
+    with timed("search_studies", "query"):
+        for page_items in iter_query_pages(get_dicom_table(), query_kwargs):
+            for entry in page_items:
+                if not _matches_all(entry, tokens):
+                    continue
+                if len(results) >= limit:
+                    has_more = True
+                    break
+                results.append({"FileKey": entry["StudyKey"], "PatientKey": entry["PatientKey"], **{field: entry.get(field, "") for field in SEARCH_FIELDS}})
+            if has_more:
+                break
+    return results, has_more
+
+def parse_search_request(request):
+    """search_studies keyword arguments from a request, or raises ValueError with the message for the client"""
+    modalities = [m.strip().upper() for m in request.GET.get("modality", "").split(",") if m.strip()]
+    date_from = request.GET.get("dateFrom") or None
+    date_to = request.GET.get("dateTo") or None
+    if any(date and not _DATE.match(date) for date in (date_from, date_to)):
+        raise ValueError("dateFrom and dateTo must be YYYYMMDD")
+    try:
+        limit = min(int(request.GET.get("limit", SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+    except ValueError:
+        raise ValueError("limit must be a number")
+    if limit < 1:
+        raise ValueError("limit must be a number")
+    return {"text": request.GET.get("q", ""), "modalities": modalities, "date_from": date_from, "date_to": date_to, "limit": limit}
@@ -1,58 +1,316 @@
+import logging
+import threading
 from django.views.decorators.csrf import csrf_exempt
-import boto3
-import os
 from datetime import datetime
 from collections import defaultdict
 from decimal import Decimal
 from django.http import JsonResponse
-from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from .ddb_service import get_dicom_table, iter_query_pages, build_metadata_query
+from .aws_clients import run_io, submit_io
+from .metrics import timed
 
-# Initialize DynamoDB
-dynamodb = boto3.resource('dynamodb', region_name=os.getenv('AWS_REGION'))
-table = dynamodb.Table(os.getenv('DICOM_DYNAMO_TABLE'))
+logger = logging.getLogger(__name__)
 
-@csrf_exempt
-def get_stats(request):
-    user_id = request.GET.get("userId")
-    print(f"UserId HERERERERER: {user_id}")
-    response = table.query(
-        KeyConditionExpression=Key('UserId').eq(user_id)
-    )
-    items = response.get('Items', [])
+# Per-user aggregate record. It lives in the user's partition under a FileKey that can never collide with an S3
+# key prefix, and it has no RecordTypeKey so it stays out of the record type index.
+STATS_FILE_KEY = "#stats"
+STATS_DATA_TYPE = "stats"
+
+# Users whose missing aggregate is being built in the background
+_rebuilds_in_flight = set()
+_rebuilds_lock = threading.Lock()
 
-    print(items)
+def stats_key(user_id):
+    return {"UserId": user_id, "FileKey": STATS_FILE_KEY}
+
+def upload_month(upload_ts):
+    """"YYYY-MM" bucket of an UploadTimestamp, None if it can't be parsed"""
+    if not upload_ts:
+        return None
+    try:
+        return datetime.fromisoformat(upload_ts.replace('Z', '+00:00')).strftime("%Y-%m")
+    except Exception as e:
+        logger.warning("Bad timestamp: %s, error: %s", upload_ts, e)
+        return None
+
+def study_records(user_id, attributes):
+    """
+    The user's study records. Only those are read when reads go through the record type index; before it is
+    backfilled the partition has to be filtered down to them (every record is read, with a consistent read at least).
+    Either way this doesn't belong on the request path, see schedule_stats_rebuild.
+    """
+    names = {f"#a{i}": attribute for i, attribute in enumerate(("FileKey", *attributes))}
+    query_kwargs = {
+        **build_metadata_query(user_id, "study"),
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+    if "IndexName" not in query_kwargs:
+        query_kwargs["ConsistentRead"] = True
+    studies = []
+    for page_items in iter_query_pages(get_dicom_table(), query_kwargs):
+        studies.extend(page_items)
+    return studies
+
+def compute_stats_from_records(user_id):
+    """Recompute a user's aggregate from the study records (what get_stats used to do on every call)"""
+    studies = study_records(user_id, ("NumberOfInstances", "TotalStudySizeBytes", "UploadTimestamp"))
+
+    # Instances are counted through the study rollups rather than the instance records: records written by an
+    # upload session that isn't committed yet have no rollup, and the commit adds them to the aggregate itself
+    total_instances = sum(int(item.get("NumberOfInstances", 0)) for item in studies)
 
-    total_instances = 0
-    total_studies = 0
     total_study_size_bytes = Decimal(0)
     largest_study_size_bytes = Decimal(0)
     latest_upload_timestamp = None
     monthly_study_counts = defaultdict(int)
 
-    for item in items:
-        data_type = item.get('DataType')
-        if data_type == 'instance':
-            total_instances += 1
-        elif data_type == 'study':
-            total_studies += 1
-
-            # Study Size
-            size = Decimal(item.get('TotalStudySizeBytes', 0))
-            total_study_size_bytes += size
-            largest_study_size_bytes = max(largest_study_size_bytes, size)
-
-            # Upload Timestamp
-            upload_ts = item.get('UploadTimestamp')
-            if upload_ts:
-                try:
-                    ts = datetime.fromisoformat(upload_ts.replace('Z', '+00:00'))
-                    if latest_upload_timestamp is None or ts > latest_upload_timestamp:
-                        latest_upload_timestamp = ts
-
-                    month_key = ts.strftime("%Y-%m")
-                    monthly_study_counts[month_key] += 1
-                except Exception as e:
-                    print(f"Bad timestamp: {upload_ts}, error: {e}")
+    for item in studies:
+        # Study Size
+        size = Decimal(item.get('TotalStudySizeBytes', 0))
+        total_study_size_bytes += size
+        largest_study_size_bytes = max(largest_study_size_bytes, size)
+
+        # Upload Timestamp
+        upload_ts = item.get('UploadTimestamp')
+        month_key = upload_month(upload_ts)
+        if month_key:
+            monthly_study_counts[month_key] += 1
+            if latest_upload_timestamp is None or upload_ts > latest_upload_timestamp:
+                latest_upload_timestamp = upload_ts
+
+    aggregate = {
+        **stats_key(user_id),
+        "DataType": STATS_DATA_TYPE,
+        "TotalInstances": total_instances,
+        "TotalStudies": len(studies),
+        "TotalStudySizeBytes": total_study_size_bytes,
+        "LargestStudySizeBytes": largest_study_size_bytes,
+        "MonthlyStudyCounts": dict(monthly_study_counts),
+    }
+    if latest_upload_timestamp:
+        aggregate["MostRecentUpload"] = latest_upload_timestamp
+    return aggregate
+
+def _is_error(e, code):
+    return e.response.get("Error", {}).get("Code") == code
+
+def rebuild_stats(user_id, only_if_missing=False):
+    """
+    Recompute and store a user's aggregate from scratch. With only_if_missing the aggregate is only created, never
+    overwritten: if an upload created it meanwhile this returns None.
+    """
+    table = get_dicom_table()
+    aggregate = compute_stats_from_records(user_id)
+    if not only_if_missing:
+        table.put_item(Item=aggregate)
+        return aggregate
+    try:
+        table.put_item(Item=aggregate, ConditionExpression="attribute_not_exists(FileKey)")
+    except ClientError as e:
+        if not _is_error(e, "ConditionalCheckFailedException"):
+            raise
+        return None
+    return aggregate
+
+def _rebuild_missing_stats(user_id):
+    try:
+        rebuild_stats(user_id, only_if_missing=True)
+    except Exception as e:
+        logger.exception("Failed to rebuild the stats aggregate of %s: %s", user_id, e)
+    finally:
+        with _rebuilds_lock:
+            _rebuilds_in_flight.discard(user_id)
+
+def schedule_stats_rebuild(user_id):
+    """
+    Build a missing aggregate on the I/O threads, at most one at a time per user. Only users whose records predate
+    the aggregates get here; `manage.py rebuild_stats` builds them all up front.
+    """
+    with _rebuilds_lock:
+        if user_id in _rebuilds_in_flight:
+            return
+        _rebuilds_in_flight.add(user_id)
+    try:
+        submit_io(_rebuild_missing_stats, user_id)
+    except Exception:
+        with _rebuilds_lock:
+            _rebuilds_in_flight.discard(user_id)
+        raise
+
+def _add_to_monthly_count(user_id, month_key, delta):
+    table = get_dicom_table()
+    try:
+        table.update_item(
+            Key=stats_key(user_id),
+            UpdateExpression="ADD MonthlyStudyCounts.#month :delta",
+            ExpressionAttributeNames={"#month": month_key},
+            ExpressionAttributeValues={":delta": delta},
+        )
+    except ClientError as e:
+        # A nested ADD needs the map itself to exist
+        if not _is_error(e, "ValidationException"):
+            raise
+        try:
+            table.update_item(
+                Key=stats_key(user_id),
+                UpdateExpression="SET MonthlyStudyCounts = :months",
+                ConditionExpression="attribute_not_exists(MonthlyStudyCounts)",
+                ExpressionAttributeValues={":months": {month_key: delta}},
+            )
+        except ClientError as e:
+            if not _is_error(e, "ConditionalCheckFailedException"):
+                raise
+            # Someone else created the map in the meantime
+            _add_to_monthly_count(user_id, month_key, delta)
+
+def _raise_largest_study_size(user_id, study_size_bytes):
+    table = get_dicom_table()
+    try:
+        table.update_item(
+            Key=stats_key(user_id),
+            UpdateExpression="SET LargestStudySizeBytes = :size",
+            ConditionExpression="attribute_not_exists(LargestStudySizeBytes) OR LargestStudySizeBytes < :size",
+            ExpressionAttributeValues={":size": Decimal(str(study_size_bytes))},
+        )
+    except ClientError as e:
+        if not _is_error(e, "ConditionalCheckFailedException"):
+            raise
+
+def _create_stats(user_id, new_instances, added_size_bytes, study_size_bytes, upload_ts, is_new_study):
+    """
+    A user's first aggregate, holding just this upload. Returns False if another request created it first.
+    Exact for new users; users with older records get theirs from `manage.py rebuild_stats` (or the rebuild
+    load_stats schedules) instead.
+    """
+    month_key = upload_month(upload_ts)
+    aggregate = {
+        **stats_key(user_id),
+        "DataType": STATS_DATA_TYPE,
+        "TotalInstances": new_instances,
+        "TotalStudies": 1 if is_new_study else 0,
+        "TotalStudySizeBytes": Decimal(str(added_size_bytes)),
+        "LargestStudySizeBytes": Decimal(str(study_size_bytes)),
+        "MonthlyStudyCounts": {month_key: 1} if month_key and is_new_study else {},
+        "MostRecentUpload": upload_ts,
+    }
+    try:
+        get_dicom_table().put_item(Item=aggregate, ConditionExpression="attribute_not_exists(FileKey)")
+    except ClientError as e:
+        if not _is_error(e, "ConditionalCheckFailedException"):
+            raise
+        return False
+    return True
+
+def record_upload_in_stats(user_id, new_instances, added_size_bytes, study_size_bytes, upload_ts, previous_upload_ts=None, is_new_study=False):
+    """
+    Apply one upload to the user's aggregate with atomic counter/map updates.
+    previous_upload_ts is the study's UploadTimestamp before this upload, used to move it to its new month.
+    """
+    table = get_dicom_table()
+    try:
+        table.update_item(
+            Key=stats_key(user_id),
+            UpdateExpression="ADD TotalInstances :instances, TotalStudies :studies, TotalStudySizeBytes :size SET MostRecentUpload = :ts",
+            # The aggregate must already exist, otherwise these would be the only numbers in it
+            ConditionExpression="attribute_exists(FileKey)",
+            ExpressionAttributeValues={
+                ":instances": new_instances,
+                ":studies": 1 if is_new_study else 0,
+                ":size": Decimal(str(added_size_bytes)),
+                ":ts": upload_ts,
+            },
+        )
+    except ClientError as e:
+        if not _is_error(e, "ConditionalCheckFailedException"):
+            raise
+        # First upload of a new user. If another request created the aggregate meanwhile, add this one to it.
+        if not _create_stats(user_id, new_instances, added_size_bytes, study_size_bytes, upload_ts, is_new_study):
+            record_upload_in_stats(user_id, new_instances, added_size_bytes, study_size_bytes, upload_ts, previous_upload_ts, is_new_study)
+        return
+
+    new_month = upload_month(upload_ts)
+    old_month = None if is_new_study else upload_month(previous_upload_ts)
+    if new_month != old_month:
+        if old_month:
+            _add_to_monthly_count(user_id, old_month, -1)
+        if new_month:
+            _add_to_monthly_count(user_id, new_month, 1)
+
+    _raise_largest_study_size(user_id, study_size_bytes)
+
+def refresh_largest_study_size(user_id, deleted_study_keys, study_sizes):
+    """
+    Recompute LargestStudySizeBytes from the remaining studies. The index can still hold the studies a delete just
+    removed or shrank, so those are left out or taken at the size given in study_sizes (FileKey -> new size).
+    """
+    deleted_study_keys = set(deleted_study_keys)
+    remaining_largest = max((Decimal(str(size)) for size in study_sizes.values()), default=Decimal(0))
+    for item in study_records(user_id, ("TotalStudySizeBytes",)):
+        if item["FileKey"] in deleted_study_keys or item["FileKey"] in study_sizes:
+            continue
+        remaining_largest = max(remaining_largest, Decimal(str(item.get("TotalStudySizeBytes", 0))))
+    get_dicom_table().update_item(
+        Key=stats_key(user_id),
+        UpdateExpression="SET LargestStudySizeBytes = :size",
+        ExpressionAttributeValues={":size": remaining_largest},
+    )
+
+def _refresh_largest_study_size_quietly(user_id, deleted_study_keys, study_sizes):
+    try:
+        refresh_largest_study_size(user_id, deleted_study_keys, study_sizes)
+    except Exception as e:
+        logger.exception("Failed to refresh the largest study size of %s: %s", user_id, e)
+
+def record_deletion_in_stats(user_id, deleted_instances, deleted_size_bytes, deleted_studies, shrunk_study=None):
+    """
+    Apply a deletion to the user's aggregate, with the same numbers the study rollups lost (so a rebuild from
+    them agrees). deleted_studies are the removed study records, shrunk_study the study a series or instance was
+    deleted from, as it was before (only FileKey, TotalStudySizeBytes and UploadTimestamp are used).
+    """
+    table = get_dicom_table()
+    try:
+        response = table.update_item(
+            Key=stats_key(user_id),
+            UpdateExpression="ADD TotalInstances :instances, TotalStudies :studies, TotalStudySizeBytes :size",
+            ConditionExpression="attribute_exists(FileKey)",
+            ExpressionAttributeValues={
+                ":instances": -deleted_instances,
+                ":studies": -len(deleted_studies),
+                ":size": -Decimal(str(deleted_size_bytes)),
+            },
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as e:
+        if not _is_error(e, "ConditionalCheckFailedException"):
+            raise
+        # No aggregate yet: the records no longer include what was deleted, whoever builds it won't count it
+        schedule_stats_rebuild(user_id)
+        return
+
+    month_deltas = defaultdict(int)
+    for study in deleted_studies:
+        month_key = upload_month(study.get("UploadTimestamp"))
+        if month_key:
+            month_deltas[month_key] -= 1
+    for month_key, delta in month_deltas.items():
+        _add_to_monthly_count(user_id, month_key, delta)
+
+    # A max can't be decremented. Only when the largest study itself went away or shrank do we look at the other
+    # studies, and not while the client waits.
+    largest = Decimal(str(response["Attributes"].get("LargestStudySizeBytes", 0)))
+    affected_studies = [*deleted_studies, *([shrunk_study] if shrunk_study else [])]
+    if any(Decimal(str(study.get("TotalStudySizeBytes", 0))) >= largest for study in affected_studies):
+        study_sizes = {}
+        if shrunk_study:
+            study_sizes[shrunk_study["FileKey"]] = Decimal(str(shrunk_study.get("TotalStudySizeBytes", 0))) - Decimal(str(deleted_size_bytes))
+        submit_io(_refresh_largest_study_size_quietly, user_id, [study["FileKey"] for study in deleted_studies], study_sizes)
+
+def format_stats(aggregate):
+    total_studies = int(aggregate.get("TotalStudies", 0))
+    total_study_size_bytes = Decimal(str(aggregate.get("TotalStudySizeBytes", 0)))
+    largest_study_size_bytes = Decimal(str(aggregate.get("LargestStudySizeBytes", 0)))
 
     avg_study_size_mb = (
         float(total_study_size_bytes) / total_studies / (1024**2)
@@ -60,11 +318,43 @@ def get_stats(request):
     )
     largest_study_size_mb = float(largest_study_size_bytes) / (1024**2)
 
-    return JsonResponse({
-        "totalInstances": total_instances,
+    return {
+        "totalInstances": int(aggregate.get("TotalInstances", 0)),
         "totalStudies": total_studies,
         "averageStudySizeMB": round(avg_study_size_mb, 2),
         "largestStudySizeMB": round(largest_study_size_mb, 2),
-        "mostRecentUpload": latest_upload_timestamp.isoformat() if latest_upload_timestamp else None,
-        "monthlyStudyCounts": dict(monthly_study_counts)
-    })
+        "mostRecentUpload": aggregate.get("MostRecentUpload"),
+        # Months whose studies were all deleted are dropped instead of showing up as 0
+        "monthlyStudyCounts": {month: int(count) for month, count in sorted(aggregate.get("MonthlyStudyCounts", {}).items()) if count > 0}
+    }
+
+def load_stats(user_id):
+    table = get_dicom_table()
+    with timed("get_stats", "query"):
+        aggregate = table.get_item(Key=stats_key(user_id)).get("Item")
+    if aggregate is None:
+        # Users who haven't uploaded since aggregates were introduced: theirs is built in the background,
+        # an empty one is shown until then
+        schedule_stats_rebuild(user_id)
+        aggregate = {}
+    return aggregate
+
+@csrf_exempt
+def get_stats(request):
+    user_id = request.GET.get("userId")
+    logger.debug("Stats requested for %s", user_id)
+
+    if not user_id:
+        return JsonResponse({"error": "Missing required parameter: userId"}, status=400)
+
+    return JsonResponse(format_stats(load_stats(user_id)))
+
+@csrf_exempt
+async def get_stats_async(request):
+    """get_stats for the ASGI server, the DynamoDB calls run on the I/O threads"""
+    user_id = request.GET.get("userId")
+
+    if not user_id:
+        return JsonResponse({"error": "Missing required parameter: userId"}, status=400)
+
+    return JsonResponse(format_stats(await run_io(load_stats, user_id)))
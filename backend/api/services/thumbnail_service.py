@@ -0,0 +1,189 @@
+import io
+import os
+import math
+import zlib
+import struct
+import logging
+import numpy as np
+import pydicom
+from botocore.exceptions import ClientError
+from pydicom.pixels import pixel_array, apply_color_lut
+from .aws_clients import get_resource
+from .s3_service import S3_BUCKET, get_s3_client, presigned_get_url
+from .metadata_cache import bump_data_version
+
+logger = logging.getLogger(__name__)
+
+# Series thumbnails, rendered once per series: the middle instance of the first upload is decoded, windowed and
+# shrunk to a small PNG stored next to the instances (<series prefix>thumbnail.png). Series and study records
+# point to it with ThumbnailKey, and get_dicom_metadata hands out presigned URLs for it, so study lists don't have
+# to fetch any DICOM. Uploads render it after their records are written, and only for series that have none yet.
+
+THUMBNAILS_ENABLED = os.getenv("DICOM_THUMBNAILS_ENABLED", "true").lower() == "true"
+THUMBNAIL_MAX_SIZE = int(os.getenv("DICOM_THUMBNAIL_MAX_SIZE", "256"))  # longest edge, in pixels
+# Instances bigger than this (long multi-frame cines...) aren't downloaded just for a thumbnail
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv("DICOM_THUMBNAIL_MAX_SOURCE_BYTES", str(64 * 1024 * 1024)))
+THUMBNAIL_URL_EXPIRATION = int(os.getenv("DICOM_THUMBNAIL_URL_EXPIRATION", "3600"))
+THUMBNAIL_FILENAME = "thumbnail.png"
+
+def thumbnail_key_for(instance_key):
+    """<user>/<patient>/<study>/<series>/<sop>.dcm -> <user>/<patient>/<study>/<series>/thumbnail.png"""
+    return f"{instance_key.rsplit('/', 1)[0]}/{THUMBNAIL_FILENAME}"
+
+def _first_value(value, default=None):
+    # Window center/width can be multi-valued (several presets), the first one is the default
+    if value is None or value == "":
+        return default
+    if isinstance(value, pydicom.multival.MultiValue):
+        return float(value[0]) if len(value) else default
+    return float(value)
+
+def _instance_number(dataset):
+    try:
+        return int(getattr(dataset, "InstanceNumber", 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def pick_representative(candidates):
+    """The middle instance (by InstanceNumber) of (dataset, s3_key, has_pixel_data, size) tuples that have pixels"""
+    with_pixels = sorted((c for c in candidates if c[2] and c[3] <= THUMBNAIL_MAX_SOURCE_BYTES), key=lambda c: _instance_number(c[0]))
+    if not with_pixels:
+        return None
+    return with_pixels[len(with_pixels) // 2]
+
+def downsample(pixels, max_size):
+    """Block-average down to at most max_size on the longest edge (rows, cols[, channels])"""
+    factor = math.ceil(max(pixels.shape[0], pixels.shape[1]) / max_size)
+    if factor <= 1:
+        return pixels.astype(np.float32)
+    rows = pixels.shape[0] // factor * factor
+    cols = pixels.shape[1] // factor * factor
+    # Edges that don't fill a whole block are dropped, at most factor - 1 pixels
+    blocks = pixels[:rows, :cols].reshape(rows // factor, factor, cols // factor, factor, *pixels.shape[2:])
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def window_to_uint8(pixels, center, width):
+    """DICOM linear VOI windowing (PS3.3 C.11.2.1.2) of float pixels to 0..255"""
+    width = max(width, 1)
+    scaled = (pixels - (center - 0.5 - (width - 1) / 2)) * (255 / max(width - 1, 1))
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+def render_thumbnail_pixels(dataset):
+    """8-bit pixels of the middle frame of a full dataset, windowed and downsampled: (rows, cols) or (rows, cols, 3)"""
+    frames = int(getattr(dataset, "NumberOfFrames", 1) or 1)
+    pixels = pixel_array(dataset, index=frames // 2 if frames > 1 else None)
+    photometric = str(getattr(dataset, "PhotometricInterpretation", "MONOCHROME2")).upper()
+
+    if photometric == "PALETTE COLOR":
+        pixels = apply_color_lut(pixels, dataset)
+        photometric = "RGB"
+
+    if pixels.ndim == 3:
+        # pydicom already converted YBR to RGB; 16-bit color is rare, scale it down to 8 bits
+        small = downsample(pixels, THUMBNAIL_MAX_SIZE)
+        if pixels.dtype.itemsize > 1:
+            small = small / (small.max() or 1) * 255
+        return np.clip(small, 0, 255).astype(np.uint8)
+
+    # Rescale after downsampling, it is linear and the array is much smaller by then
+    small = downsample(pixels, THUMBNAIL_MAX_SIZE)
+    slope = _first_value(getattr(dataset, "RescaleSlope", None), 1.0)
+    intercept = _first_value(getattr(dataset, "RescaleIntercept", None), 0.0)
+    if slope != 1.0 or intercept != 0.0:
+        small = small * slope + intercept
+
+    center = _first_value(getattr(dataset, "WindowCenter", None))
+    width = _first_value(getattr(dataset, "WindowWidth", None))
+    if center is None or width is None or width <= 0:
+        # No window in the header: stretch the values we actually have
+        low, high = float(small.min()), float(small.max())
+        center, width = (low + high) / 2, max(high - low, 1)
+
+    image = window_to_uint8(small, center, width)
+    if photometric == "MONOCHROME1":
+        image = 255 - image  # MONOCHROME1 is displayed inverted
+    return image
+
+def encode_png(image):
+    """Minimal PNG encoder for 8-bit grayscale or RGB arrays, so we don't need an imaging library"""
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+    # Every scanline starts with its filter type (0 = none), zlib does the actual compression
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+        + chunk(b"IEND", b"")
+    )
+
+def create_series_thumbnail(candidates, bucket=S3_BUCKET):
+    """
+    Render and store the thumbnail of a series from the instances just stored in it, given as
+    (dataset, s3_key, has_pixel_data, size) tuples. Returns the thumbnail key, or None when there is nothing to
+    render or rendering failed (thumbnails are never worth failing an upload for).
+    """
+    if not THUMBNAILS_ENABLED:
+        return None
+    representative = pick_representative(candidates)
+    if representative is None:
+        return None
+
+    _, s3_key, _, _ = representative
+    s3 = get_s3_client()
+    try:
+        body = s3.get_object(Bucket=bucket, Key=s3_key)["Body"].read()
+        dataset = pydicom.dcmread(io.BytesIO(body), force=True)
+        png = encode_png(render_thumbnail_pixels(dataset))
+        thumbnail_key = thumbnail_key_for(s3_key)
+        s3.put_object(
+            Bucket=bucket, Key=thumbnail_key, Body=png, ContentType="image/png",
+            CacheControl=f"private, max-age={THUMBNAIL_URL_EXPIRATION}",
+        )
+        return thumbnail_key
+    except Exception as e:
+        # e.g. a compressed transfer syntax without its decoder plugin installed
+        logger.warning("Could not render a thumbnail from %s: %s", s3_key, e)
+        return None
+
+def store_series_thumbnail(table_name, user_id, series_file_key, candidates, bucket=S3_BUCKET):
+    """
+    Render a series' thumbnail from instances just stored in it (see create_series_thumbnail) and point the series
+    record, and its study's if that has none yet, to it. Never raises, meant to run after the upload's response.
+    Takes the table's name, not a Table: it runs on another thread than the request, which has its own resource.
+    """
+    try:
+        table = get_resource("dynamodb", region_name=os.getenv("AWS_REGION")).Table(table_name)
+        thumbnail_key = create_series_thumbnail(candidates, bucket=bucket)
+        if thumbnail_key is None:
+            return None
+        study_file_key = series_file_key.rstrip("/").rsplit("/", 1)[0] + "/"
+        for file_key in (series_file_key, study_file_key):
+            try:
+                table.update_item(
+                    Key={"UserId": user_id, "FileKey": file_key},
+                    UpdateExpression="SET ThumbnailKey = if_not_exists(ThumbnailKey, :thumbnail)",
+                    # Deleted in the meantime: don't bring back a record holding nothing but the thumbnail
+                    ConditionExpression="attribute_exists(FileKey)",
+                    ExpressionAttributeValues={":thumbnail": thumbnail_key},
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                    raise
+        bump_data_version(table, user_id)
+        return thumbnail_key
+    except Exception as e:
+        logger.exception("Failed to store the thumbnail of %s: %s", series_file_key, e)
+        return None
+
+def add_thumbnail_urls(items):
+    """Presigned ThumbnailUrl for records that have a ThumbnailKey (signing is local, no request to S3)"""
+    for item in items:
+        thumbnail_key = item.get("ThumbnailKey")
+        if thumbnail_key:
+            item["ThumbnailUrl"] = presigned_get_url(thumbnail_key, THUMBNAIL_URL_EXPIRATION)
+    return items
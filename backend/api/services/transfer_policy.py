@@ -0,0 +1,107 @@
+import os
+import time
+import base64
+import hashlib
+import threading
+from collections import namedtuple
+from boto3.s3.transfer import TransferConfig
+from .s3_service import S3_MAX_PARTS
+
+# Size-based S3 transfer settings. A 500KB CT slice and a 900MB enhanced multi-frame or whole-slide instance
+# shouldn't be sent the same way: small files want small parts (little buffering, the last part goes early),
+# big ones want bigger parts and more of them in flight. The tiers below are picked from the file's size, or for
+# streamed uploads from the size its header announces (Rows x Columns x frames ...).
+
+MB = 1024 * 1024
+
+TransferPolicy = namedtuple("TransferPolicy", ["part_size", "part_concurrency"])
+
+# (files up to this many bytes, part size, parts of one file sent at once); the last tier takes everything bigger
+TRANSFER_POLICY_TIERS = (
+    (int(os.getenv("DICOM_TRANSFER_LARGE_FILE_BYTES", str(64 * MB))), int(os.getenv("DICOM_TRANSFER_SMALL_PART_BYTES", str(8 * MB))), 2),
+    (int(os.getenv("DICOM_TRANSFER_HUGE_FILE_BYTES", str(1024 * MB))), int(os.getenv("DICOM_TRANSFER_LARGE_PART_BYTES", str(16 * MB))), 4),
+    (None, int(os.getenv("DICOM_TRANSFER_HUGE_PART_BYTES", str(32 * MB))), 4),
+)
+S3_MIN_PART_SIZE = 5 * MB  # S3 rejects smaller parts (except the last one)
+
+def policy_for_size(size):
+    """Part size and per-file part concurrency for a file of about this many bytes (None: unknown, smallest tier)"""
+    for max_size, part_size, part_concurrency in TRANSFER_POLICY_TIERS:
+        if max_size is None or size is None or size <= max_size:
+            # Still within S3's part count, whatever the size
+            part_size = max(S3_MIN_PART_SIZE, part_size, -(-(size or 0) // S3_MAX_PARTS))
+            return TransferPolicy(part_size, part_concurrency)
+
+def copy_transfer_config(size):
+    """boto3 managed transfer settings (s3.copy/upload_fileobj) for an object of this size"""
+    policy = policy_for_size(size)
+    return TransferConfig(
+        multipart_threshold=TRANSFER_POLICY_TIERS[0][0],
+        multipart_chunksize=policy.part_size,
+        max_concurrency=policy.part_concurrency,
+    )
+
+def _int_value(dataset, keyword, default):
+    try:
+        return int(getattr(dataset, keyword, default) or default)
+    except (TypeError, ValueError):
+        return default
+
+def estimated_instance_size(dataset, header_bytes, has_pixel_data):
+    """
+    Size of an instance from its header: the header plus the uncompressed pixel data. An upper bound for
+    compressed transfer syntaxes, which is fine for picking a part size.
+    """
+    if not has_pixel_data:
+        return header_bytes
+    pixel_bytes = (
+        _int_value(dataset, "Rows", 0) * _int_value(dataset, "Columns", 0) * _int_value(dataset, "SamplesPerPixel", 1)
+        * -(-_int_value(dataset, "BitsAllocated", 8) // 8) * _int_value(dataset, "NumberOfFrames", 1)
+    )
+    return header_bytes + pixel_bytes
+
+def part_checksum(data):
+    """Base64 SHA-256 of a part, what S3 expects in ChecksumSHA256 and answers with"""
+    return base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+
+def multipart_checksum(part_checksums):
+    """The checksum S3 gives a completed multipart object: SHA-256 of the parts' digests, suffixed with the part count"""
+    digest = hashlib.sha256(b"".join(base64.b64decode(checksum) for checksum in part_checksums)).digest()
+    return f"{base64.b64encode(digest).decode('ascii')}-{len(part_checksums)}"
+
+
+class TransferBudget:
+    """
+    Shared by the files of one request: caps the bytes held for parts queued for/being sent to S3, and optionally
+    the rate they're sent at (0 = no limit). A part bigger than the whole budget is let through on its own.
+    """
+
+    def __init__(self, max_bytes_in_flight, bytes_per_second=0):
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.bytes_per_second = bytes_per_second
+        self.bytes_in_flight = 0
+        self.condition = threading.Condition()
+        self.rate_lock = threading.Lock()
+        self.next_send_at = 0.0
+
+    def acquire(self, size):
+        with self.condition:
+            while self.bytes_in_flight and self.bytes_in_flight + size > self.max_bytes_in_flight:
+                self.condition.wait()
+            self.bytes_in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.bytes_in_flight -= size
+            self.condition.notify_all()
+
+    def throttle(self, size):
+        """Wait for this part's turn under the rate limit"""
+        if not self.bytes_per_second:
+            return
+        with self.rate_lock:
+            now = time.monotonic()
+            send_at = max(self.next_send_at, now)
+            self.next_send_at = send_at + size / self.bytes_per_second
+        if send_at > now:
+            time.sleep(send_at - now)
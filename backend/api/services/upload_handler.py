@@ -0,0 +1,324 @@
+import logging
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from .s3_service import get_s3_client
+from .aws_clients import submit_io
+from .dicom_service import parse_dicom_header_bytes, instance_s3_key, stored_instance_checksums
+from .transfer_policy import (
+    TransferBudget, policy_for_size, estimated_instance_size, part_checksum, multipart_checksum
+)
+from .metrics import inc_counter
+
+logger = logging.getLogger(__name__)
+
+# Upload handler for upload_dicom: instead of spooling every file to memory/temp files before the view runs, each
+# file is forwarded to S3 while the request body is still being read. Only the parsed header is kept. Files
+# smaller than one part (most single-frame slices) go in a single PUT once they're read, bigger ones are streamed
+# into a multipart upload as soon as their first part is full. Part size and how many parts of a file go at once depend on the file's size (see transfer_policy), the
+# parts of all files of a request share one budget, so peak memory per request is about
+# DICOM_STREAM_MAX_BYTES_IN_FLIGHT plus one part, whatever the size of the study or its instances.
+# Every part carries its SHA-256, S3 rejects a part whose bytes don't match and we check the completed object's.
+
+DICOM_STREAM_UPLOAD_CONCURRENCY = int(os.getenv("DICOM_STREAM_UPLOAD_CONCURRENCY", "4"))
+DICOM_STREAM_MAX_BYTES_IN_FLIGHT = int(os.getenv("DICOM_STREAM_MAX_BYTES_IN_FLIGHT", str(128 * 1024 * 1024)))
+# Upload bandwidth of one request towards S3, 0 = no limit
+DICOM_STREAM_MAX_BYTES_PER_SECOND = int(os.getenv("DICOM_STREAM_MAX_BYTES_PER_SECOND", "0"))
+DICOM_STREAM_PART_ATTEMPTS = int(os.getenv("DICOM_STREAM_PART_ATTEMPTS", "3"))
+# A file whose header (everything before PixelData) doesn't fit in this many bytes is rejected
+DICOM_STREAM_MAX_HEADER_BYTES = int(os.getenv("DICOM_STREAM_MAX_HEADER_BYTES", str(16 * 1024 * 1024)))
+# Files whose SOPInstanceUID is already stored are hashed but not sent to S3 again (re-uploads of whole folders)
+DICOM_UPLOAD_DEDUP_ENABLED = os.getenv("DICOM_UPLOAD_DEDUP_ENABLED", "true").lower() == "true"
+
+
+class StreamedDicomFile(UploadedFile):
+    """What ends up in request.FILES: the parsed header and where the bytes went, not the bytes themselves"""
+
+    def __init__(self, name, content_type, size, charset, dataset, has_pixel_data, s3_key, upload_id, part_futures, error,
+                 content_sha256=None, duplicate=False, put_future=None):
+        super().__init__(None, name, content_type, size, charset)
+        self.dataset = dataset
+        self.has_pixel_data = has_pixel_data
+        self.s3_key = s3_key
+        self.upload_id = upload_id
+        self.part_futures = part_futures
+        self.error = error
+        self.completed = False
+        self.content_sha256 = content_sha256
+        # Already stored with the same content, nothing was uploaded for it
+        self.duplicate = duplicate
+        # Small files: the PUT of the whole object, instead of an upload id and parts
+        self.put_future = put_future
+
+
+class S3StreamingUploadHandler(FileUploadHandler):
+    """
+    Streams every uploaded file to S3 under its canonical key. Multipart uploads are left open until the view calls
+    complete(), and small files that went in one PUT are deleted again unless complete() was called for them, so a
+    request that fails validation doesn't leave objects in S3. Call close() when done, it aborts/deletes whatever
+    wasn't completed.
+    """
+
+    def __init__(self, request, user_id, bucket):
+        super().__init__(request)
+        self.user_id = user_id
+        self.bucket = bucket
+        self.s3 = get_s3_client()
+        self.executor = ThreadPoolExecutor(max_workers=DICOM_STREAM_UPLOAD_CONCURRENCY)
+        # Bounds the bytes held in memory while parts wait for/are in an upload thread, across all files
+        self.budget = TransferBudget(DICOM_STREAM_MAX_BYTES_IN_FLIGHT, DICOM_STREAM_MAX_BYTES_PER_SECOND)
+        self.content_length = None
+        self.files = []
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # No file of the request can be bigger than the request, whatever its header says
+        self.content_length = content_length
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.buffer = bytearray()
+        self.next_parse_at = 0
+        self.dataset = None
+        self.has_pixel_data = False
+        self.s3_key = None
+        self.upload_id = None
+        self.part_futures = []
+        self.put_future = None
+        self.part_size, part_concurrency = policy_for_size(None)
+        self.file_parts_in_flight = threading.BoundedSemaphore(part_concurrency)
+        self.error = None
+        self.sha256 = hashlib.sha256()
+        self.stored = False
+        self.stored_checksum = None
+        self.stored_lookup = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.error:
+            return None
+        self.sha256.update(raw_data)
+        if self.stored:
+            return None
+        self.buffer += raw_data
+
+        if self.dataset is None:
+            # Re-parse only when the buffer has doubled, so headers spanning many chunks don't get parsed once per chunk
+            if len(self.buffer) >= self.next_parse_at:
+                self._parse_header(is_complete=False)
+            if self.dataset is None:
+                if not self.error and len(self.buffer) > DICOM_STREAM_MAX_HEADER_BYTES:
+                    self._fail(f"No DICOM header found in the first {DICOM_STREAM_MAX_HEADER_BYTES} bytes")
+                return None
+            if self.stored:
+                return None
+
+        if len(self.buffer) >= self.part_size and self._resolve_stored():
+            return None
+        while len(self.buffer) >= self.part_size:
+            # Only files with at least one full part are worth a multipart upload
+            if self.upload_id is None and not self._start_multipart_upload():
+                return None
+            self._send_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return None
+
+    def file_complete(self, file_size):
+        if not self.error and self.dataset is None:
+            self._parse_header(is_complete=True)
+        if not self.error:
+            self._resolve_stored()
+        content_sha256 = self.sha256.hexdigest()
+        if self.stored and not self.error and self.stored_checksum and self.stored_checksum != content_sha256:
+            # Same SOPInstanceUID, different bytes: not ours to silently overwrite
+            self._fail("An instance with this SOPInstanceUID is already stored with different content, delete it first to replace it")
+        if not self.error and not self.stored:
+            if self.upload_id is None:
+                self._send_object(bytes(self.buffer))
+            elif self.buffer:
+                self._send_part(bytes(self.buffer))  # the last part may be smaller than the minimum
+        self.buffer = bytearray()
+
+        streamed_file = StreamedDicomFile(
+            self.file_name, self.content_type, file_size, self.charset,
+            self.dataset, self.has_pixel_data, self.s3_key, self.upload_id, self.part_futures, self.error,
+            content_sha256=content_sha256, duplicate=self.stored and not self.error, put_future=self.put_future,
+        )
+        self.files.append(streamed_file)
+        return streamed_file
+
+    def upload_interrupted(self):
+        self.close()
+
+    def _fail(self, error):
+        self.error = error
+        self.buffer = bytearray()
+
+    def _parse_header(self, is_complete):
+        try:
+            parsed = parse_dicom_header_bytes(bytes(self.buffer), is_complete)
+        except Exception as e:
+            self._fail(str(e))
+            return
+        if parsed is None:
+            self.next_parse_at = len(self.buffer) * 2
+            return
+
+        self.dataset, self.has_pixel_data = parsed
+        self.s3_key = instance_s3_key(self.user_id, self.dataset)
+        self._choose_policy()
+        if DICOM_UPLOAD_DEDUP_ENABLED:
+            # Runs while the rest of the file comes in, nothing is sent to S3 before the answer is in
+            self.stored_lookup = submit_io(stored_instance_checksums, self.user_id, [self.s3_key])
+
+    def _start_multipart_upload(self):
+        try:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.s3_key, ContentType="application/dicom", ChecksumAlgorithm="SHA256"
+            )["UploadId"]
+            return True
+        except Exception as e:
+            self._fail(f"S3 upload failed: {e}")
+            return False
+
+    def _choose_policy(self):
+        # Multi-frame instances of hundreds of MB get bigger parts and more of them in flight than a single slice
+        expected_size = estimated_instance_size(self.dataset, len(self.buffer), self.has_pixel_data)
+        if self.content_length:
+            expected_size = min(expected_size, self.content_length)
+        self.part_size, part_concurrency = policy_for_size(expected_size)
+        self.file_parts_in_flight = threading.BoundedSemaphore(part_concurrency)
+
+    def _resolve_stored(self):
+        """Wait for the file's stored instance lookup, if any. True if the file is already stored (nothing to send)."""
+        lookup, self.stored_lookup = self.stored_lookup, None
+        if lookup is not None:
+            try:
+                stored = lookup.result()
+            except Exception as e:
+                # Uploading it again is always safe
+                logger.warning("Could not look up whether %s is stored: %s", self.s3_key, e)
+                stored = {}
+            if self.s3_key in stored:
+                # Checked against the stored checksum (when there is one) once the whole file went through the hash
+                self.stored = True
+                self.stored_checksum = stored[self.s3_key]
+                self.buffer = bytearray()
+        return self.stored
+
+    def _submit(self, upload, data, *args):
+        # Every transfer holds a slot of its file's part concurrency and its bytes in the request's budget
+        file_parts_in_flight = self.file_parts_in_flight
+        file_parts_in_flight.acquire()
+        self.budget.acquire(len(data))
+        try:
+            return self.executor.submit(self._run_transfer, upload, data, file_parts_in_flight, *args)
+        except Exception:
+            self.budget.release(len(data))
+            file_parts_in_flight.release()
+            raise
+
+    def _run_transfer(self, upload, data, file_parts_in_flight, *args):
+        try:
+            return upload(data, *args)
+        finally:
+            self.budget.release(len(data))
+            file_parts_in_flight.release()
+
+    def _send_part(self, data):
+        part_number = len(self.part_futures) + 1
+        self.part_futures.append(self._submit(self._upload_part, data, self.s3_key, self.upload_id, part_number))
+
+    def _send_object(self, data):
+        self.put_future = self._submit(self._put_object, data, self.s3_key)
+
+    def _send_verified(self, description, data, send):
+        """send(checksum) with retries, checking the checksum S3 answers with against the one of the bytes we sent"""
+        checksum = part_checksum(data)
+        for attempt in range(1, DICOM_STREAM_PART_ATTEMPTS + 1):
+            self.budget.throttle(len(data))
+            try:
+                response = send(checksum)
+                if response.get("ChecksumSHA256", checksum) != checksum:
+                    raise ValueError(f"S3 stored {description} with checksum {response['ChecksumSHA256']}, expected {checksum}")
+                return response, checksum
+            except Exception as e:
+                # The bytes are still in memory, sending them again is cheap next to failing the whole file
+                if attempt == DICOM_STREAM_PART_ATTEMPTS:
+                    raise
+                inc_counter("s3_part_retries_total")
+                logger.warning("Sending %s failed (attempt %d), retrying: %s", description, attempt, e)
+
+    def _upload_part(self, data, s3_key, upload_id, part_number):
+        response, checksum = self._send_verified(f"part {part_number} of {s3_key}", data, lambda checksum: self.s3.upload_part(
+            Bucket=self.bucket, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=data,
+            ChecksumAlgorithm="SHA256", ChecksumSHA256=checksum,
+        ))
+        return {"PartNumber": part_number, "ETag": response["ETag"], "ChecksumSHA256": checksum}
+
+    def _put_object(self, data, s3_key):
+        self._send_verified(s3_key, data, lambda checksum: self.s3.put_object(
+            Bucket=self.bucket, Key=s3_key, Body=data, ContentType="application/dicom",
+            ChecksumAlgorithm="SHA256", ChecksumSHA256=checksum,
+        ))
+
+    def _complete_file(self, streamed_file):
+        if streamed_file.put_future is not None:
+            try:
+                streamed_file.put_future.result()
+                streamed_file.completed = True
+            except Exception as e:
+                streamed_file.error = f"S3 upload failed: {e}"
+            return
+        try:
+            parts = [future.result() for future in streamed_file.part_futures]
+            response = self.s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=streamed_file.s3_key, UploadId=streamed_file.upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+            expected = multipart_checksum([part["ChecksumSHA256"] for part in parts])
+            if response.get("ChecksumSHA256", expected) != expected:
+                # Already assembled, so not something close() can abort
+                streamed_file.upload_id = None
+                self.s3.delete_object(Bucket=self.bucket, Key=streamed_file.s3_key)
+                raise ValueError(f"object checksum {response['ChecksumSHA256']} doesn't match its parts ({expected})")
+            streamed_file.completed = True
+        except Exception as e:
+            streamed_file.error = f"S3 upload failed: {e}"
+
+    def complete(self, files):
+        """Finish the uploads of these files; the ones that fail get their error set"""
+        pending = [f for f in files if not f.error and not f.completed and not f.duplicate]
+        list(self.executor.map(self._complete_file, pending))
+
+    def close(self):
+        """Abort (or delete) every upload that wasn't completed and stop the upload threads"""
+        # An upload cut off mid-file never reached file_complete
+        interrupted = self.upload_id and not any(f.upload_id == self.upload_id for f in self.files)
+        for streamed_file in self.files:
+            if streamed_file.put_future is not None and not streamed_file.completed:
+                # Stored by its PUT (or about to be) unless it never started or failed, not something to abort
+                put_future, streamed_file.put_future = streamed_file.put_future, None
+                if put_future.cancel() or put_future.exception() is not None:
+                    continue
+                try:
+                    self.s3.delete_object(Bucket=self.bucket, Key=streamed_file.s3_key)
+                except Exception as e:
+                    logger.warning("Failed to remove uncompleted upload of %s: %s", streamed_file.s3_key, e)
+            if streamed_file.upload_id and not streamed_file.completed:
+                for future in streamed_file.part_futures:
+                    future.cancel()
+                try:
+                    self.s3.abort_multipart_upload(Bucket=self.bucket, Key=streamed_file.s3_key, UploadId=streamed_file.upload_id)
+                except Exception as e:
+                    logger.warning("Failed to abort upload of %s: %s", streamed_file.s3_key, e)
+                streamed_file.upload_id = None
+        if interrupted:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.s3_key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.warning("Failed to abort upload of %s: %s", self.s3_key, e)
+            self.upload_id = None
+        self.executor.shutdown(wait=True)
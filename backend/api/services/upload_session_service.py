@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import uuid
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key, Attr
+from .ddb_service import get_dicom_table, iter_query_pages
+from .dicom_service import DICOM_TAGS, build_base_metadata
+from .ingest_service import read_header_from_s3, write_study_rollups
+from .s3_service import S3_BUCKET, get_s3_client
+from .aws_clients import submit_io
+from .thumbnail_service import store_series_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Resumable uploads of big studies: a session is opened, instances arrive in batches (any order, each one
+# acknowledged once and replayed if sent again), and the series/study/patient rollups are only written when the
+# session is committed. Sessions and acknowledgements live in the user's partition like "#stats":
+#   #upload#<session id>               status, study, counters, acknowledged batch ids
+#   #upload#<session id>#<batch id>    the response the batch got, replayed when it is retried
+# Instance records written by a session carry its id, the commit reads them back to build the rollups, so an
+# instance stored by a batch that died before being acknowledged is still counted.
+
+UPLOAD_SESSION_PREFIX = "#upload#"
+UPLOAD_SESSION_DATA_TYPE = "upload_session"
+UPLOAD_SESSION_ID_ATTRIBUTE = "UploadSessionId"
+# Per-file size on session instance records (TotalSizeBytes is a running total over the request)
+INSTANCE_SIZE_ATTRIBUTE = "FileSizeBytes"
+# Sessions stop accepting batches after this; ExpiresAt can be the table's TTL attribute to clean them up
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_BATCH_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class UploadSessionError(Exception):
+    """Raised for requests that don't fit the session's state, carries the HTTP status to answer with"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def session_key(user_id, session_id):
+    return {"UserId": user_id, "FileKey": f"{UPLOAD_SESSION_PREFIX}{session_id}"}
+
+def batch_key(user_id, session_id, batch_id):
+    return {"UserId": user_id, "FileKey": f"{UPLOAD_SESSION_PREFIX}{session_id}#{batch_id}"}
+
+def is_valid_batch_id(batch_id):
+    return bool(_BATCH_ID.match(batch_id or ""))
+
+def _is_conditional_failure(e):
+    return e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+def create_session(user_id):
+    session_id = uuid.uuid4().hex
+    now = int(time.time())
+    get_dicom_table().put_item(Item={
+        **session_key(user_id, session_id),
+        "DataType": UPLOAD_SESSION_DATA_TYPE,
+        "Status": "open",
+        "CreatedAt": datetime.utcnow().isoformat(),
+        "ExpiresAt": now + UPLOAD_SESSION_TTL_SECONDS,
+        "InstanceCount": 0,
+        "UploadedBytes": 0,
+    })
+    return load_session(user_id, session_id)
+
+def load_session(user_id, session_id):
+    """The session record, None if there is no such session"""
+    if not re.match(r"^[0-9a-f]{32}$", session_id or ""):
+        return None
+    return get_dicom_table().get_item(Key=session_key(user_id, session_id), ConsistentRead=True).get("Item")
+
+def require_open_session(user_id, session_id):
+    session = load_session(user_id, session_id)
+    if session is None:
+        raise UploadSessionError("No such upload session", 404)
+    if session["Status"] != "open":
+        raise UploadSessionError(f"The upload session is {session['Status']}", 409)
+    if int(session["ExpiresAt"]) < time.time():
+        raise UploadSessionError("The upload session has expired, open a new one", 410)
+    return session
+
+def bind_study(user_id, session_id, patient_id, study_instance_uid):
+    """A session holds one study: the first batch sets it, later batches have to match"""
+    try:
+        get_dicom_table().update_item(
+            Key=session_key(user_id, session_id),
+            UpdateExpression="SET PatientID = if_not_exists(PatientID, :p), StudyInstanceUID = if_not_exists(StudyInstanceUID, :s)",
+            ConditionExpression="attribute_not_exists(StudyInstanceUID) OR (StudyInstanceUID = :s AND PatientID = :p)",
+            ExpressionAttributeValues={":p": patient_id, ":s": study_instance_uid},
+        )
+    except ClientError as e:
+        if _is_conditional_failure(e):
+            raise UploadSessionError("All batches of a session must belong to the same patient and study", 400)
+        raise
+
+def _plain_numbers(values):
+    # Counts come back from DynamoDB as Decimals
+    return {key: int(value) if isinstance(value, Decimal) else value for key, value in values.items()}
+
+def get_batch_ack(user_id, session_id, batch_id):
+    item = get_dicom_table().get_item(Key=batch_key(user_id, session_id, batch_id), ConsistentRead=True).get("Item")
+    return _plain_numbers(item["Response"]) if item else None
+
+def acknowledge_batch(user_id, session_id, batch_id, response, instance_records, uploaded_bytes):
+    """
+    Store a fully stored batch's response and add it to the session's progress. Returns the response to send.
+    instance_records are the instance records the batch wrote, rolled up here if the commit may have missed them.
+    """
+    table = get_dicom_table()
+    try:
+        table.put_item(
+            Item={**batch_key(user_id, session_id, batch_id), "DataType": UPLOAD_SESSION_DATA_TYPE, "Response": response},
+            ConditionExpression="attribute_not_exists(FileKey)",
+        )
+    except ClientError as e:
+        if not _is_conditional_failure(e):
+            raise
+        # The same batch was sent twice at once and the other request got there first
+        return get_batch_ack(user_id, session_id, batch_id)
+
+    try:
+        table.update_item(
+            Key=session_key(user_id, session_id),
+            UpdateExpression="ADD InstanceCount :n, UploadedBytes :b, AcknowledgedBatches :batch",
+            ConditionExpression="#status = :open",
+            ExpressionAttributeNames={"#status": "Status"},
+            ExpressionAttributeValues={":n": len(instance_records), ":b": uploaded_bytes, ":batch": {batch_id}, ":open": "open"},
+        )
+    except ClientError as e:
+        if not _is_conditional_failure(e):
+            raise
+        # The commit started while this batch was uploading and may have read the session's instances before these
+        # were written. Rolling them up here is safe either way: the rollups merge on the SOP instance UIDs, so the
+        # ones the commit did read aren't counted twice. The ack stays, a retry of the batch is replayed.
+        logger.info("Batch %s of upload session %s arrived during the commit, rolling it up", batch_id, session_id)
+        _roll_up_late_batch(table, user_id, instance_records)
+    return response
+
+def _roll_up_late_batch(table, user_id, instance_records):
+    by_series = {}
+    for record in instance_records:
+        by_series.setdefault(record[DICOM_TAGS["SeriesInstanceUID"]], []).append(record)
+    timestamp = datetime.utcnow().isoformat()
+    for records in by_series.values():
+        _commit_series(table, user_id, records, timestamp)
+
+def session_progress(session):
+    return {
+        "sessionId": session["FileKey"].removeprefix(UPLOAD_SESSION_PREFIX),
+        "status": session["Status"],
+        "studyInstanceUID": session.get("StudyInstanceUID"),
+        "acknowledgedBatches": sorted(session.get("AcknowledgedBatches", ())),
+        "instanceCount": int(session.get("InstanceCount", 0)),
+        "uploadedBytes": int(session.get("UploadedBytes", 0)),
+        "expiresAt": int(session["ExpiresAt"]),
+        **({"result": _plain_numbers(session["Result"])} if "Result" in session else {}),
+    }
+
+def _session_instances(user_id, session_id, study_prefix):
+    """The instance records this session stored, with what the rollups need"""
+    names = {
+        "#fk": "FileKey", "#sid": UPLOAD_SESSION_ID_ATTRIBUTE, "#size": INSTANCE_SIZE_ATTRIBUTE, "#px": "HasPixelData",
+        "#sop": DICOM_TAGS["SOPInstanceUID"], "#series": DICOM_TAGS["SeriesInstanceUID"], "#num": DICOM_TAGS["InstanceNumber"],
+    }
+    query_kwargs = {
+        "KeyConditionExpression": Key("UserId").eq(user_id) & Key("FileKey").begins_with(study_prefix),
+        "FilterExpression": Attr(UPLOAD_SESSION_ID_ATTRIBUTE).eq(session_id),
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+    instances = []
+    for page_items in iter_query_pages(get_dicom_table(), query_kwargs):
+        instances.extend(page_items)
+    return instances
+
+def _instance_number(record):
+    try:
+        return Decimal(str(record.get(DICOM_TAGS["InstanceNumber"], "")))
+    except InvalidOperation:
+        return Decimal(0)
+
+def _commit_series(table, user_id, records, timestamp):
+    """Rollups for one series of the session, from one instance header read back from S3"""
+    s3 = get_s3_client()
+    # The middle instance: its header gives the snapshot fields and its pixels the thumbnail
+    records = sorted(records, key=lambda record: (_instance_number(record), record["FileKey"]))
+    representative = records[len(records) // 2]
+    size = int(representative.get(INSTANCE_SIZE_ATTRIBUTE, 0))
+    dataset, has_pixel_data = read_header_from_s3(s3, S3_BUCKET, representative["FileKey"], size)
+
+    # With the per-instance sizes, rolling up a series a second time (the commit died before recording it as
+    # committed) adds nothing to the sizes, counts or stats
+    instance_sizes = {record[DICOM_TAGS["SOPInstanceUID"]]: int(record.get(INSTANCE_SIZE_ATTRIBUTE, 0)) for record in records}
+    thumbnail_series_key = write_study_rollups(
+        table, user_id, dataset, build_base_metadata(dataset, user_id, timestamp),
+        list(instance_sizes),
+        {record[DICOM_TAGS["SeriesInstanceUID"]] for record in records},
+        sum(instance_sizes.values()),
+        timestamp,
+        instance_sizes=instance_sizes,
+    )
+    if thumbnail_series_key:
+        submit_io(store_series_thumbnail, table.name, user_id, thumbnail_series_key, [(dataset, representative["FileKey"], has_pixel_data, size)])
+
+def commit_session(user_id, session_id):
+    """
+    Write the rollups of everything the session stored and close it. Safe to call again after a failure: series
+    that were already rolled up are remembered on the session and skipped, and one that was rolled up but not
+    remembered yet is merged again without being counted twice.
+    """
+    table = get_dicom_table()
+    session = load_session(user_id, session_id)
+    if session is None:
+        raise UploadSessionError("No such upload session", 404)
+    if session["Status"] == "committed":
+        return session_progress(session)
+    if not session.get("StudyInstanceUID"):
+        raise UploadSessionError("Nothing was uploaded in this session", 400)
+
+    # No more batches from here on
+    table.update_item(
+        Key=session_key(user_id, session_id),
+        UpdateExpression="SET #status = :committing",
+        ConditionExpression="#status IN (:open, :committing)",
+        ExpressionAttributeNames={"#status": "Status"},
+        ExpressionAttributeValues={":committing": "committing", ":open": "open"},
+    )
+
+    study_prefix = f"{user_id}/{session['PatientID']}/{session['StudyInstanceUID']}/"
+    by_series = {}
+    for record in _session_instances(user_id, session_id, study_prefix):
+        by_series.setdefault(record["FileKey"].rsplit("/", 1)[0] + "/", []).append(record)
+
+    committed_series = set(session.get("CommittedSeries", ()))
+    timestamp = datetime.utcnow().isoformat()
+    for series_prefix, records in sorted(by_series.items()):
+        if series_prefix in committed_series:
+            continue
+        _commit_series(table, user_id, records, timestamp)
+        table.update_item(
+            Key=session_key(user_id, session_id),
+            UpdateExpression="ADD CommittedSeries :series",
+            ExpressionAttributeValues={":series": {series_prefix}},
+        )
+
+    result = {"studyKey": study_prefix, "seriesCount": len(by_series), "instanceCount": sum(len(records) for records in by_series.values())}
+    table.update_item(
+        Key=session_key(user_id, session_id),
+        UpdateExpression="SET #status = :committed, #result = :result",
+        ExpressionAttributeNames={"#status": "Status", "#result": "Result"},
+        ExpressionAttributeValues={":committed": "committed", ":result": result},
+    )
+    return session_progress(load_session(user_id, session_id))
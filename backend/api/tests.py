@@ -1,3 +1,1324 @@
-from django.test import TestCase
+import io
+import os
+import base64
+import hashlib
+import gzip
+import asyncio
+import threading
+import json
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import boto3
+import jwt
+import numpy as np
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from boto3.dynamodb.conditions import Key
+from urllib.parse import urlencode
+
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from api.services import auth_service, aws_clients, ddb_service, metadata_cache, s3_service, stats_service, transfer_policy
+from api.services.ingest_service import merge_instances, update_rollup
+from api.services.ddb_service import DICOM_DYNAMO_TABLE, DICOM_RECORD_TYPE_INDEX_NAME, batch_put_items, batch_write_requests, encode_cursor, get_dicom_table
+from api.services.s3_service import S3_BUCKET
+from api.services.stats_service import compute_stats_from_records, get_stats, stats_key
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+USER_ID = "user1"
+AUTH_HEADER = {"HTTP_AUTHORIZATION": "Bearer token"}
+
+def make_dicom(patient_id="P1", study_uid=None, series_uid=None, count=1, sop_uid=None, pixel_offset=0, size=32, frames=1,
+               study_date="20250101", modality="CT"):
+    """count CT instances (size x size pixels) of one series, as uploaded files. Returns (files, study UID, series UID)"""
+    study_uid = study_uid or generate_uid()
+    series_uid = series_uid or generate_uid()
+    files = []
+    for i in range(count):
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        file_meta.MediaStorageSOPInstanceUID = sop_uid or generate_uid()
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.PatientID = patient_id
+        ds.PatientName = "Doe^John"
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.Modality = modality
+        ds.StudyDate = study_date
+        ds.StudyDescription = "Chest CT"
+        ds.InstanceNumber = i + 1
+        ds.Rows = ds.Columns = size
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        if frames > 1:
+            ds.NumberOfFrames = frames
+        ds.PixelData = ((np.arange(size * size * frames, dtype=np.uint16) + pixel_offset) % 4096).tobytes()
+
+        buffer = io.BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        files.append(SimpleUploadedFile(f"{ds.SOPInstanceUID}.dcm", buffer.getvalue(), content_type="application/dicom"))
+    return files, study_uid, series_uid
+
+def run_now(func, *args, **kwargs):
+    """submit_io stand-in: background work (thumbnails) runs before the view returns, inside the mock"""
+    func(*args, **kwargs)
+
+
+@skipUnless(mock_aws, "moto is not installed")
+class MotoTestCase(SimpleTestCase):
+    """
+    A fresh moto account per test, with the metadata table (and its index) and the bucket created. Reads filter the
+    partition like a deployment that hasn't been backfilled yet, IndexReadsMixin switches them to the index.
+    """
+
+    def setUp(self):
+        patches = [
+            mock.patch.dict(os.environ, {
+                "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_REGION": "us-east-1",
+                "AWS_DEFAULT_REGION": "us-east-1", "AWS_STORAGE_BUCKET_NAME": S3_BUCKET,
+            }),
+            mock.patch.object(metadata_cache, "METADATA_SETTLE_SECONDS", 0),
+            mock.patch("api.views.upload.submit_io", run_now),
+            mock.patch("api.services.upload_session_service.submit_io", run_now),
+            mock.patch("api.services.stats_service.submit_io", run_now),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        aws_clients.reset_clients()
+        self.addCleanup(aws_clients.reset_clients)
+        caches["default"].clear()
+        stats_service._rebuilds_in_flight.clear()
+
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=S3_BUCKET)
+        boto3.client("dynamodb", region_name="us-east-1").create_table(
+            TableName=DICOM_DYNAMO_TABLE,
+            KeySchema=[{"AttributeName": "UserId", "KeyType": "HASH"}, {"AttributeName": "FileKey", "KeyType": "RANGE"}],
+            AttributeDefinitions=[
+                {"AttributeName": "UserId", "AttributeType": "S"},
+                {"AttributeName": "FileKey", "AttributeType": "S"},
+                {"AttributeName": "RecordTypeKey", "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexes=[{
+                "IndexName": DICOM_RECORD_TYPE_INDEX_NAME,
+                "KeySchema": [{"AttributeName": "UserId", "KeyType": "HASH"}, {"AttributeName": "RecordTypeKey", "KeyType": "RANGE"}],
+                "Projection": {"ProjectionType": "ALL"},
+            }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.table = get_dicom_table()
+        self.factory = RequestFactory()
+
+    def upload(self, files):
+        from api.views.upload import upload_dicom
+        for f in files:
+            f.seek(0)
+        with mock.patch("api.views.upload.cognito_token_verification", return_value=USER_ID):
+            response = upload_dicom(self.factory.post("/api/upload-dicom", {"files": files}, **AUTH_HEADER))
+        return response.status_code, json.loads(response.content)
+
+    def record(self, file_key):
+        return self.table.get_item(Key={"UserId": USER_ID, "FileKey": file_key}, ConsistentRead=True).get("Item")
+
+    def delete(self, file_key):
+        from api.views.delete import delete_data_by_file_key
+        response = delete_data_by_file_key(self.factory.delete(f"/api/delete-data-by-file-key?{urlencode({'userId': USER_ID, 'fileKey': file_key})}"))
+        return response.status_code, json.loads(response.content)
+
+    def stats(self):
+        return json.loads(get_stats(self.factory.get("/api/stats", {"userId": USER_ID})).content)
+
+
+class IndexReadsMixin:
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(ddb_service, "DICOM_RECORD_TYPE_INDEX", DICOM_RECORD_TYPE_INDEX_NAME)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
+class CognitoTokenCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.jwk = {**json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key())), "kid": "kid-1"}
+        self.fetch = mock.patch.object(auth_service, "get_cognito_public_keys", return_value=[self.jwk]).start()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.dict(auth_service._jwks_cache, {"keys": {}, "fetched_at": None, "last_attempt": None}).start()
+        self.addCleanup(auth_service._verified_tokens.clear)
+        auth_service._verified_tokens.clear()
+
+    def token(self, sub="user1", kid="kid-1", expires_in=3600):
+        claims = {"sub": sub, "iss": auth_service.COGNITO_ISSUER, "exp": int(time.time()) + expires_in}
+        return jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": kid})
+
+    def test_key_set_is_fetched_once(self):
+        for sub in ("a", "b", "c"):
+            self.assertEqual(auth_service.cognito_token_verification(self.token(sub)), sub)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_verified_token_skips_the_signature_check(self):
+        token = self.token()
+        self.assertEqual(auth_service.cognito_token_verification(token), "user1")
+        with mock.patch.object(auth_service.jwt, "decode") as decode:
+            self.assertEqual(auth_service.cognito_token_verification(token), "user1")
+        decode.assert_not_called()
+
+    def test_expired_token_is_rejected(self):
+        self.assertIs(auth_service.cognito_token_verification(self.token(expires_in=-10)), Exception)
+
+    def test_unknown_kids_refetch_at_most_once_per_interval(self):
+        auth_service.cognito_token_verification(self.token())
+        auth_service._jwks_cache["last_attempt"] -= auth_service.JWKS_MIN_REFRESH_INTERVAL_SECONDS + 1
+        for _ in range(3):
+            self.assertIsNone(auth_service.cognito_token_verification(self.token(kid="made-up")))
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_stale_key_is_served_while_refreshing(self):
+        auth_service.cognito_token_verification(self.token())
+        auth_service._jwks_cache["fetched_at"] -= auth_service.JWKS_CACHE_TTL_SECONDS + 1
+        auth_service._jwks_cache["last_attempt"] -= auth_service.JWKS_MIN_REFRESH_INTERVAL_SECONDS + 1
+
+        with mock.patch.object(auth_service.threading, "Thread") as thread:
+            self.assertEqual(auth_service.cognito_token_verification(self.token("b")), "b")
+            self.assertEqual(auth_service.cognito_token_verification(self.token("c")), "c")
+        thread.assert_called_once()
+        # The refresh thread never ran, so the lock it was handed is still held
+        auth_service._jwks_refresh_lock.release()
+
+
+class BatchWriteTests(MotoTestCase):
+
+    def items(self, count):
+        return [{"UserId": USER_ID, "FileKey": f"{USER_ID}/item-{i:03d}", "DataType": "instance"} for i in range(count)]
+
+    def test_unprocessed_items_are_retried(self):
+        client = ddb_service.get_dynamodb_resource().meta.client
+        real_batch_write_item = client.batch_write_item
+        calls = []
+
+        def first_call_leaves_two(RequestItems):
+            requests = RequestItems[DICOM_DYNAMO_TABLE]
+            calls.append(len(requests))
+            if len(calls) == 1:
+                real_batch_write_item(RequestItems={DICOM_DYNAMO_TABLE: requests[2:]})
+                return {"UnprocessedItems": {DICOM_DYNAMO_TABLE: requests[:2]}}
+            return real_batch_write_item(RequestItems=RequestItems)
+
+        with mock.patch.object(client, "batch_write_item", side_effect=first_call_leaves_two), \
+                mock.patch.object(ddb_service, "_backoff_sleep"):
+            summary = batch_put_items(DICOM_DYNAMO_TABLE, self.items(10), max_workers=1)
+
+        self.assertEqual(calls, [10, 2])
+        self.assertEqual(summary["Written"], 10)
+        self.assertEqual(summary["RetriedItems"], 2)
+        self.assertEqual(summary["FailedRequests"], [])
+        self.assertEqual(self.table.scan(Select="COUNT")["Count"], 10)
+
+    def test_requests_never_processed_are_surfaced(self):
+        client = ddb_service.get_dynamodb_resource().meta.client
+
+        def never_processed(RequestItems):
+            return {"UnprocessedItems": RequestItems}
+
+        with mock.patch.object(client, "batch_write_item", side_effect=never_processed), \
+                mock.patch.object(ddb_service, "_backoff_sleep"), \
+                mock.patch.object(ddb_service, "DDB_BATCH_WRITE_MAX_ATTEMPTS", 3):
+            summary = batch_write_requests(DICOM_DYNAMO_TABLE, [{"PutRequest": {"Item": item}} for item in self.items(3)], max_workers=1)
+
+        self.assertEqual(summary["Written"], 0)
+        self.assertEqual(summary["RetriedItems"], 6)
+        self.assertEqual(len(summary["FailedRequests"]), 3)
+
+    def test_items_sharing_a_key_are_written_once(self):
+        items = self.items(30) + [{"UserId": USER_ID, "FileKey": f"{USER_ID}/item-000", "DataType": "study"}]
+        summary = batch_put_items(DICOM_DYNAMO_TABLE, items)
+
+        self.assertEqual(summary["Written"], 30)
+        self.assertEqual(self.record(f"{USER_ID}/item-000")["DataType"], "study")
+
+
+class MetadataPaginationTests(MotoTestCase):
+
+    def get(self, **params):
+        from api.services.ddb_service import get_dicom_metadata
+        response = get_dicom_metadata(self.factory.get("/api/get-dicom-metadata", {"userId": USER_ID, "recordType": "study", **params}))
+        return response.status_code, json.loads(response.content)
+
+    def test_cursor_walks_every_page(self):
+        for _ in range(5):
+            status, _ = self.upload(make_dicom()[0])
+            self.assertEqual(status, 200)
+
+        file_keys = []
+        status, page = self.get(limit=2)
+        pages = 1
+        while True:
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(page["Items"]), 2)
+            file_keys.extend(item["FileKey"] for item in page["Items"])
+            if not page["NextCursor"]:
+                break
+            status, page = self.get(limit=2, cursor=page["NextCursor"])
+            pages += 1
+
+        self.assertGreaterEqual(pages, 3)
+        self.assertEqual(len(file_keys), 5)
+        self.assertEqual(len(set(file_keys)), 5)
+        status, everything = self.get()
+        self.assertEqual(sorted(item["FileKey"] for item in everything), sorted(file_keys))
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.get(limit=2, cursor="not-a-cursor")[0], 400)
+        for key in ([USER_ID], 7, {"UserId": USER_ID}, {"UserId": "someone-else", "FileKey": "x", "RecordTypeKey": "study#x"}):
+            self.assertEqual(self.get(limit=2, cursor=encode_cursor(key))[0], 400, key)
+
+
+class IndexedMetadataPaginationTests(IndexReadsMixin, MetadataPaginationTests):
+    pass
+
+
+class RecordTypeIndexTests(MotoTestCase):
+
+    def test_reads_filter_until_the_index_is_switched_on(self):
+        self.assertNotIn("IndexName", ddb_service.build_metadata_query(USER_ID, "study"))
+        with mock.patch.object(ddb_service, "DICOM_RECORD_TYPE_INDEX", DICOM_RECORD_TYPE_INDEX_NAME):
+            self.assertEqual(ddb_service.build_metadata_query(USER_ID, "study")["IndexName"], DICOM_RECORD_TYPE_INDEX_NAME)
+
+    def test_backfill_makes_older_records_visible_in_the_index(self):
+        self.upload(make_dicom()[0])
+        # A study written before RecordTypeKey existed
+        self.table.put_item(Item={"UserId": USER_ID, "FileKey": f"{USER_ID}/P9/old-study/", "DataType": "study"})
+
+        def indexed_studies():
+            with mock.patch.object(ddb_service, "DICOM_RECORD_TYPE_INDEX", DICOM_RECORD_TYPE_INDEX_NAME):
+                return sorted(item["FileKey"] for item in self.table.query(**ddb_service.build_metadata_query(USER_ID, "study"))["Items"])
+
+        self.assertEqual(len(indexed_studies()), 1)
+        call_command("backfill_record_type_keys", stdout=io.StringIO())
+        self.assertEqual(len(indexed_studies()), 2)
+        self.assertIn(f"{USER_ID}/P9/old-study/", indexed_studies())
+
+
+class StatsAggregateTests(MotoTestCase):
+
+    def assert_matches_rebuild(self):
+        aggregate = self.record(stats_key(USER_ID)["FileKey"])
+        rebuilt = compute_stats_from_records(USER_ID)
+        for attribute in ("TotalInstances", "TotalStudies", "TotalStudySizeBytes", "LargestStudySizeBytes", "MonthlyStudyCounts"):
+            self.assertEqual(aggregate[attribute], rebuilt[attribute], attribute)
+
+    def test_aggregate_follows_uploads(self):
+        files, study_uid, _ = make_dicom(count=3)
+        self.upload(files)
+        more_files, _, _ = make_dicom(study_uid=study_uid, count=2)
+        self.upload(more_files)
+        self.upload(make_dicom(patient_id="P2")[0])
+
+        stats = self.stats()
+        self.assertEqual(stats["totalInstances"], 6)
+        self.assertEqual(stats["totalStudies"], 2)
+        self.assertEqual(sum(stats["monthlyStudyCounts"].values()), 2)
+        self.assert_matches_rebuild()
+
+    def test_missing_aggregate_is_rebuilt_in_the_background(self):
+        self.upload(make_dicom(count=2)[0])
+        self.table.delete_item(Key=stats_key(USER_ID))
+
+        with mock.patch.object(stats_service, "submit_io") as submit_io:
+            self.assertEqual(self.stats()["totalInstances"], 0)
+            self.assertEqual(self.stats()["totalInstances"], 0)
+        # One rebuild for both requests, run once the response is out
+        submit_io.assert_called_once()
+        run_now(*submit_io.call_args.args)
+
+        self.assertEqual(self.stats()["totalInstances"], 2)
+        self.assertIsNotNone(self.record(stats_key(USER_ID)["FileKey"]))
+
+    def test_deleting_a_series_or_instance_updates_the_study(self):
+        files, study_uid, series_uid = make_dicom(count=3)
+        self.upload(files)
+        other_series, _, other_series_uid = make_dicom(study_uid=study_uid, count=2)
+        self.upload(other_series)
+        study_key = f"{USER_ID}/P1/{study_uid}/"
+
+        self.assertEqual(self.delete(f"{study_key}{other_series_uid}/")[0], 200)
+        study = self.record(study_key)
+        self.assertEqual(study["NumberOfInstances"], 3)
+        self.assertEqual(study["TotalStudySizeBytes"], sum(f.size for f in files))
+        self.assertEqual(study["SeriesInstanceUIDList"], {series_uid})
+        self.assert_matches_rebuild()
+
+        instance_key = f"{study_key}{series_uid}/{files[0].name}"
+        self.assertEqual(self.delete(instance_key)[0], 200)
+        series = self.record(f"{study_key}{series_uid}/")
+        self.assertEqual(series["NumberOfInstances"], 2)
+        self.assertEqual(series["TotalStudySizeBytes"], sum(f.size for f in files[1:]))
+        self.assertEqual(self.record(study_key)["NumberOfInstances"], 2)
+        self.assertEqual(self.stats()["totalInstances"], 2)
+        self.assert_matches_rebuild()
+
+    def test_deleting_the_largest_study(self):
+        small, _, _ = make_dicom(count=1)
+        large, large_study_uid, _ = make_dicom(count=3)
+        self.upload(small)
+        self.upload(large)
+
+        self.delete(f"{USER_ID}/P1/{large_study_uid}/")
+
+        self.assertEqual(self.record(stats_key(USER_ID)["FileKey"])["LargestStudySizeBytes"], small[0].size)
+        self.assertNotIn(large_study_uid, self.record(f"{USER_ID}/P1/")["StudyInstanceUIDList"])
+        self.assert_matches_rebuild()
+
+
+class IndexedStatsAggregateTests(IndexReadsMixin, StatsAggregateTests):
+
+    def test_rebuild_reads_only_study_records(self):
+        self.upload(make_dicom(count=3)[0])
+        with mock.patch.object(stats_service, "iter_query_pages", wraps=stats_service.iter_query_pages) as pages:
+            compute_stats_from_records(USER_ID)
+        self.assertEqual(pages.call_args.args[1]["IndexName"], DICOM_RECORD_TYPE_INDEX_NAME)
+
+
+class BulkDeleteTests(MotoTestCase):
+
+    def s3_keys(self):
+        response = boto3.client("s3", region_name="us-east-1").list_objects_v2(Bucket=S3_BUCKET)
+        return sorted(obj["Key"] for obj in response.get("Contents", []))
+
+    def test_study_is_deleted_with_everything_under_it(self):
+        files, study_uid, _ = make_dicom(count=5)
+        self.upload(files)
+        kept, kept_study_uid, _ = make_dicom(count=2)
+        self.upload(kept)
+
+        with mock.patch("api.views.delete.S3_DELETE_BATCH_SIZE", 2):
+            status, body = self.delete(f"{USER_ID}/P1/{study_uid}/")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["DeletedInstanceCount"], 6)  # the series record and its 5 instances
+        self.assertEqual(sum(1 for key in body["DeletedS3Files"] if key.endswith(".dcm")), 5)
+        self.assertFalse([key for key in self.s3_keys() if study_uid in key])
+        self.assertTrue([key for key in self.s3_keys() if kept_study_uid in key])
+        remaining = [item["FileKey"] for item in self.table.scan()["Items"] if item["FileKey"].startswith(USER_ID)]
+        self.assertFalse([key for key in remaining if study_uid in key])
+        self.assertTrue([key for key in remaining if kept_study_uid in key])
+
+    def test_failed_s3_deletes_are_reported(self):
+        files, study_uid, _ = make_dicom(count=2)
+        self.upload(files)
+
+        def delete_objects(Bucket, Delete):
+            return {"Errors": [{"Key": Delete["Objects"][0]["Key"], "Code": "AccessDenied", "Message": "Access Denied"}]}
+
+        # Clients (unlike resources) can be shared with the thread the S3 delete runs on
+        s3 = boto3.client("s3", region_name="us-east-1")
+        with mock.patch("api.views.delete.get_s3_client", return_value=s3), \
+                mock.patch.object(s3, "delete_objects", side_effect=delete_objects):
+            status, body = self.delete(f"{USER_ID}/P1/{study_uid}/")
+
+        self.assertEqual(status, 207)
+        self.assertEqual(len(body["FailedS3Deletes"]), 1)
+        self.assertEqual(body["FailedS3Deletes"][0]["Code"], "AccessDenied")
+        self.assertEqual(body["FailedRecordDeletes"], [])
+
+    def test_missing_parameters_and_records(self):
+        from api.views.delete import delete_data_by_file_key
+        self.assertEqual(delete_data_by_file_key(self.factory.delete("/api/delete-data-by-file-key")).status_code, 400)
+        self.assertEqual(self.delete(f"{USER_ID}/P1/nothing-here/")[0], 404)
+
+
+class DirectUploadTests(MotoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch("api.views.direct_upload.get_request_user_id", return_value=USER_ID)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def create(self, body):
+        from api.views.direct_upload import create_direct_upload
+        response = create_direct_upload(self.factory.post("/api/direct-upload", json.dumps(body), content_type="application/json", **AUTH_HEADER))
+        return response.status_code, json.loads(response.content)
+
+    def test_staged_files_are_ingested(self):
+        from api.services.ingest_service import ingest_s3_objects, parse_s3_event_records
+        files, study_uid, _ = make_dicom(count=3)
+        status, body = self.create({"files": [{"name": f.name, "size": f.size} for f in files]})
+        self.assertEqual(status, 200)
+        self.assertTrue(all("url" in upload for upload in body["files"]))
+
+        s3 = boto3.client("s3", region_name="us-east-1")
+        records = []
+        for f, upload in zip(files, body["files"]):
+            s3.put_object(Bucket=S3_BUCKET, Key=upload["key"], Body=f.file.getvalue())
+            records.append({"eventSource": "aws:s3", "eventName": "ObjectCreated:Put", "s3": {"bucket": {"name": S3_BUCKET}, "object": {"key": upload["key"], "size": f.size}}})
+        summary = ingest_s3_objects(parse_s3_event_records({"Records": records}))
+
+        self.assertEqual(len(summary["Ingested"]), 3)
+        self.assertEqual(summary["Failed"], [])
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["NumberOfInstances"], 3)
+        # Redelivered events change nothing
+        summary = ingest_s3_objects(parse_s3_event_records({"Records": records}))
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["NumberOfInstances"], 3)
+
+    def test_big_files_get_multipart_urls(self):
+        status, body = self.create({"files": [{"name": "big.dcm", "size": 200 * 1024 * 1024}]})
+        self.assertEqual(status, 200)
+        multipart = body["files"][0]["multipart"]
+        self.assertGreaterEqual(multipart["partSize"] * len(multipart["partUrls"]), 200 * 1024 * 1024)
+
+    def test_unusable_file_entries_are_rejected(self):
+        for files in (["a.dcm"], [{"name": "a.dcm", "size": "big"}], [{"name": "a.dcm"}], [{"size": 10}],
+                      [{"name": "a.dcm", "size": -1}], [{"name": "a.dcm", "size": True}], [{"name": "a.dcm", "size": 1.5}]):
+            self.assertEqual(self.create({"files": files})[0], 400, files)
+
+    def test_uploads_of_other_users_cant_be_completed(self):
+        from api.views.direct_upload import complete_direct_upload
+        body = {"key": "incoming/someone-else/upload/00000-a.dcm", "uploadId": "x", "abort": True}
+        response = complete_direct_upload(self.factory.post("/x", json.dumps(body), content_type="application/json", **AUTH_HEADER))
+        self.assertEqual(response.status_code, 403)
+
+
+class StreamingUploadTests(MotoTestCase):
+
+    def stored_body(self, key):
+        return boto3.client("s3", region_name="us-east-1").get_object(Bucket=S3_BUCKET, Key=key)["Body"].read()
+
+    def s3_keys(self):
+        response = boto3.client("s3", region_name="us-east-1").list_objects_v2(Bucket=S3_BUCKET)
+        return [obj["Key"] for obj in response.get("Contents", [])]
+
+    def upload_counting_multipart(self, files):
+        from api.services.upload_handler import S3StreamingUploadHandler
+        start = S3StreamingUploadHandler._start_multipart_upload
+        with mock.patch.object(S3StreamingUploadHandler, "_start_multipart_upload", autospec=True, side_effect=start) as multipart:
+            status, body = self.upload(files)
+        return status, body, multipart.call_count
+
+    def test_files_smaller_than_a_part_are_put_once(self):
+        files, study_uid, series_uid = make_dicom(count=3)
+        status, body, multipart_uploads = self.upload_counting_multipart(files)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(multipart_uploads, 0)
+        for f in files:
+            self.assertEqual(self.stored_body(f"{USER_ID}/P1/{study_uid}/{series_uid}/{f.name}"), f.file.getvalue())
+
+    def test_bigger_files_are_sent_in_parts(self):
+        # 10MB of pixel data: more than one 8MB part
+        files, study_uid, series_uid = make_dicom(size=1024, frames=5)
+        status, body, multipart_uploads = self.upload_counting_multipart(files)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(multipart_uploads, 1)
+        self.assertEqual(self.stored_body(f"{USER_ID}/P1/{study_uid}/{series_uid}/{files[0].name}"), files[0].file.getvalue())
+
+    def test_rejected_request_leaves_nothing_in_s3(self):
+        files, _, _ = make_dicom(count=2)
+        other_study, _, _ = make_dicom(size=1024, frames=5)
+        status, body = self.upload(files + other_study)
+
+        self.assertEqual(status, 400)
+        self.assertEqual([key for key in self.s3_keys() if key.endswith(".dcm")], [])
+        self.assertEqual(boto3.client("s3", region_name="us-east-1").list_multipart_uploads(Bucket=S3_BUCKET).get("Uploads", []), [])
+
+    def test_files_that_arent_dicom_are_rejected(self):
+        status, body = self.upload([SimpleUploadedFile("notes.txt", b"not a dicom file" * 100, content_type="text/plain")])
+        self.assertEqual(status, 400)
+        self.assertEqual(self.s3_keys(), [])
+
+
+    def upload_with_parts(self, upload_part, files):
+        client = boto3.client("s3", region_name="us-east-1")
+        real_upload_part = client.upload_part
+        with mock.patch("api.services.upload_handler.get_s3_client", return_value=client), \
+                mock.patch.object(client, "upload_part", side_effect=lambda **kwargs: upload_part(real_upload_part, **kwargs)) as parts:
+            status, body = self.upload(files)
+        return status, body, parts.call_count
+
+    def test_failed_parts_are_sent_again(self):
+        files, study_uid, series_uid = make_dicom(size=1024, frames=5)
+        failures = [RuntimeError("connection reset")]
+
+        def flaky(upload_part, **kwargs):
+            if kwargs["PartNumber"] == 2 and failures:
+                raise failures.pop()
+            return upload_part(**kwargs)
+
+        status, body, part_requests = self.upload_with_parts(flaky, files)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(part_requests, 3)
+        self.assertEqual(self.stored_body(f"{USER_ID}/P1/{study_uid}/{series_uid}/{files[0].name}"), files[0].file.getvalue())
+
+    def test_parts_stored_with_another_checksum_fail_the_file(self):
+        from api.services.upload_handler import DICOM_STREAM_PART_ATTEMPTS
+        files, _, _ = make_dicom(size=1024, frames=5)
+
+        def corrupted(upload_part, **kwargs):
+            response = upload_part(**kwargs)
+            return {**response, "ChecksumSHA256": transfer_policy.part_checksum(b"something else")} if kwargs["PartNumber"] == 1 else response
+
+        status, body, part_requests = self.upload_with_parts(corrupted, files)
+
+        self.assertEqual(status, 502)
+        self.assertIn("checksum", body["failedFiles"][0]["error"])
+        self.assertEqual(part_requests, DICOM_STREAM_PART_ATTEMPTS + 1)
+        self.assertEqual([key for key in self.s3_keys() if key.endswith(".dcm")], [])
+        self.assertEqual(boto3.client("s3", region_name="us-east-1").list_multipart_uploads(Bucket=S3_BUCKET).get("Uploads", []), [])
+
+
+class TransferPolicyTests(SimpleTestCase):
+    MB = transfer_policy.MB
+
+    def test_part_size_grows_with_the_file(self):
+        small, large, huge = (transfer_policy.policy_for_size(size) for size in (1 * self.MB, 200 * self.MB, 2048 * self.MB))
+        self.assertEqual(small, transfer_policy.policy_for_size(None))
+        self.assertLess(small.part_size, large.part_size)
+        self.assertLess(large.part_size, huge.part_size)
+        self.assertLessEqual(small.part_concurrency, large.part_concurrency)
+
+    def test_parts_stay_within_s3_limits(self):
+        for size in (0, 1, 64 * self.MB, 64 * self.MB + 1, 1024 * self.MB, 5 * 1024 * 1024 * self.MB):
+            part_size = transfer_policy.policy_for_size(size).part_size
+            self.assertGreaterEqual(part_size, transfer_policy.S3_MIN_PART_SIZE, size)
+            self.assertLessEqual(-(-size // part_size), s3_service.S3_MAX_PARTS, size)
+
+    def test_instance_size_comes_from_the_pixel_attributes(self):
+        dataset = Dataset()
+        dataset.Rows, dataset.Columns, dataset.BitsAllocated, dataset.SamplesPerPixel, dataset.NumberOfFrames = 512, 256, 12, 3, 10
+        self.assertEqual(transfer_policy.estimated_instance_size(dataset, 1000, True), 1000 + 512 * 256 * 2 * 3 * 10)
+        self.assertEqual(transfer_policy.estimated_instance_size(dataset, 1000, False), 1000)
+        del dataset.NumberOfFrames
+        self.assertEqual(transfer_policy.estimated_instance_size(dataset, 1000, True), 1000 + 512 * 256 * 2 * 3)
+
+    def test_multipart_checksum_is_over_the_part_digests(self):
+        parts = [b"a" * 10, b"b" * 20, b"c"]
+        checksums = [transfer_policy.part_checksum(part) for part in parts]
+        self.assertEqual(checksums[0], base64.b64encode(hashlib.sha256(parts[0]).digest()).decode("ascii"))
+
+        digest = hashlib.sha256(b"".join(hashlib.sha256(part).digest() for part in parts)).digest()
+        self.assertEqual(transfer_policy.multipart_checksum(checksums), f"{base64.b64encode(digest).decode('ascii')}-3")
+        self.assertNotEqual(transfer_policy.multipart_checksum(checksums[::-1]), transfer_policy.multipart_checksum(checksums))
+
+    def test_budget_holds_parts_back_until_bytes_are_released(self):
+        budget = transfer_policy.TransferBudget(10)
+        budget.acquire(6)
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (budget.acquire(6), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        budget.release(6)
+        self.assertTrue(acquired.wait(1))
+        waiter.join()
+        # A part bigger than the whole budget still goes, on its own
+        budget.release(6)
+        budget.acquire(25)
+        self.assertEqual(budget.bytes_in_flight, 25)
+
+    def test_budget_spaces_parts_out_at_the_rate_limit(self):
+        budget = transfer_policy.TransferBudget(100, bytes_per_second=1000)
+        with mock.patch("api.services.transfer_policy.time.sleep") as sleep:
+            for _ in range(3):
+                budget.throttle(500)
+        # The clock doesn't move while sleep is mocked: the third part waits for the 1000 bytes before it
+        self.assertEqual(sleep.call_count, 2)
+        self.assertAlmostEqual(sleep.call_args.args[0], 1.0, delta=0.1)
+
+        with mock.patch("api.services.transfer_policy.time.sleep") as sleep:
+            transfer_policy.TransferBudget(100).throttle(10 ** 9)
+        sleep.assert_not_called()
+
+class UpdateRollupTests(MotoTestCase):
+    key = {"UserId": USER_ID, "FileKey": f"{USER_ID}/P1/study/"}
+
+    def test_sets_are_merged_and_counts_added(self):
+        update_rollup(self.table, self.key, {"LastUpdated": "t1"}, {"StudyDate": "20250101"}, {"SeriesInstanceUIDList": {"s1"}, "NumberOfInstances": 2})
+        previous = update_rollup(self.table, self.key, {"LastUpdated": "t2"}, {"StudyDate": "20990101"}, {"SeriesInstanceUIDList": {"s1", "s2"}, "NumberOfInstances": 3})
+
+        record = self.record(self.key["FileKey"])
+        self.assertEqual(previous["NumberOfInstances"], 2)
+        self.assertEqual(record["SeriesInstanceUIDList"], {"s1", "s2"})
+        self.assertEqual(record["NumberOfInstances"], 5)
+        self.assertEqual(record["LastUpdated"], "t2")
+        self.assertEqual(record["StudyDate"], "20250101")
+
+    def test_legacy_lists_are_converted_to_sets(self):
+        self.table.put_item(Item={**self.key, "SeriesInstanceUIDList": ["s1"], "SOPInstanceUIDList": [], "NumberOfInstances": 1})
+
+        update_rollup(self.table, self.key, {"LastUpdated": "t1"}, {}, {"SeriesInstanceUIDList": {"s2"}, "SOPInstanceUIDList": {"i1"}, "NumberOfInstances": 1})
+
+        record = self.record(self.key["FileKey"])
+        self.assertEqual(record["SeriesInstanceUIDList"], {"s1", "s2"})
+        self.assertEqual(record["SOPInstanceUIDList"], {"i1"})
+        self.assertEqual(record["NumberOfInstances"], 2)
+
+    def merge(self, sizes):
+        return merge_instances(self.table, self.key, {"LastUpdated": "t"}, {}, set(sizes), sum(sizes.values()), instance_sizes=sizes)
+
+    def test_instances_already_merged_are_not_counted(self):
+        self.merge({"i1": 10, "i2": 20})
+        previous, new_instances, added_size = self.merge({"i2": 20, "i3": 30})
+
+        record = self.record(self.key["FileKey"])
+        self.assertEqual(previous["NumberOfInstances"], 2)
+        self.assertEqual((new_instances, added_size), (1, 30))
+        self.assertEqual(record["SOPInstanceUIDList"], {"i1", "i2", "i3"})
+        self.assertEqual(record["NumberOfInstances"], 3)
+        self.assertEqual(record["TotalStudySizeBytes"], 60)
+
+    def test_overlap_costs_no_corrective_write(self):
+        self.merge({"i1": 10})
+        with mock.patch.object(self.table, "update_item", wraps=self.table.update_item) as update_item:
+            self.merge({"i1": 10, "i2": 20})
+
+        # The guarded write fails without writing, the retry is the only write, and nothing is ever added twice
+        self.assertEqual(update_item.call_count, 2)
+        for call in update_item.call_args_list:
+            self.assertNotEqual(call.kwargs["ReturnValues"], "ALL_OLD")
+            self.assertTrue(all(value >= 0 for value in call.kwargs["ExpressionAttributeValues"].values() if isinstance(value, int)))
+        self.assertEqual(self.record(self.key["FileKey"])["NumberOfInstances"], 2)
+
+    def test_large_batches_are_merged_in_guarded_chunks(self):
+        sizes = {f"i{n}": n for n in range(1, 6)}
+        with mock.patch("api.services.ingest_service.ROLLUP_GUARD_MAX_UIDS", 2):
+            self.merge(sizes)
+            _, new_instances, added_size = self.merge({**sizes, "i6": 6})
+
+        record = self.record(self.key["FileKey"])
+        self.assertEqual((new_instances, added_size), (1, 6))
+        self.assertEqual(record["NumberOfInstances"], 6)
+        self.assertEqual(record["TotalStudySizeBytes"], 21)
+
+    def test_reupload_counts_once(self):
+        files, study_uid, series_uid = make_dicom(count=2)
+        self.upload(files)
+        self.upload(files)
+
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/{series_uid}/")["NumberOfInstances"], 2)
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["NumberOfInstances"], 2)
+
+
+class AsyncViewTests(MotoTestCase):
+
+    def run_view(self, view, request, *args):
+        response = asyncio.run(view(request, *args))
+        return response.status_code, json.loads(response.content)
+
+    def test_async_views_match_sync_ones(self):
+        from api.views.upload import upload_dicom_async
+        from api.views.delete import delete_data_by_file_key_async
+        from api.services import get_dicom_metadata, get_dicom_metadata_async, get_stats_async
+        files, study_uid, _ = make_dicom(count=2)
+        with mock.patch("api.views.upload.cognito_token_verification", return_value=USER_ID):
+            status, _ = self.run_view(upload_dicom_async, self.factory.post("/api/upload-dicom", {"files": files}, **AUTH_HEADER))
+        self.assertEqual(status, 200)
+
+        params = {"userId": USER_ID, "recordType": "instance"}
+        status, items = self.run_view(get_dicom_metadata_async, self.factory.get("/api/get-dicom-metadata", params))
+        self.assertEqual(status, 200)
+        self.assertEqual(items, json.loads(get_dicom_metadata(self.factory.get("/api/get-dicom-metadata", params)).content))
+        self.assertEqual(len(items), 2)
+        self.assertEqual(self.run_view(get_stats_async, self.factory.get("/api/stats", {"userId": USER_ID}))[1], self.stats())
+
+        query = urlencode({"userId": USER_ID, "fileKey": f"{USER_ID}/P1/{study_uid}/"})
+        status, _ = self.run_view(delete_data_by_file_key_async, self.factory.delete(f"/api/delete-data-by-file-key?{query}"))
+        self.assertEqual(status, 200)
+        self.assertIsNone(self.record(f"{USER_ID}/P1/{study_uid}/"))
+        self.assertEqual(self.stats()["totalInstances"], 0)
+
+    def test_tables_are_only_built_on_io_threads(self):
+        from api.views.search import search_async
+        from api.views.workspace import get_patient_workspace_async
+        from api.services import get_dicom_metadata_async
+        self.upload(make_dicom()[0])
+        threads = []
+        get_dynamodb_resource = ddb_service.get_dynamodb_resource
+
+        def recording_resource(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return get_dynamodb_resource(*args, **kwargs)
+
+        with mock.patch.object(ddb_service, "get_dynamodb_resource", recording_resource):
+            for view, path, params in (
+                (get_dicom_metadata_async, "/api/get-dicom-metadata", {"recordType": "study"}),
+                (search_async, "/api/search", {"q": "P1"}),
+                (get_patient_workspace_async, "/api/workspace", {"fileKey": f"{USER_ID}/P1/"}),
+            ):
+                status, _ = self.run_view(view, self.factory.get(path, {"userId": USER_ID, **params}))
+                self.assertEqual(status, 200, view.__name__)
+
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+
+class SeriesThumbnailTests(MotoTestCase):
+
+    def test_upload_stores_a_thumbnail(self):
+        files, study_uid, series_uid = make_dicom(count=3)
+        self.upload(files)
+
+        series = self.record(f"{USER_ID}/P1/{study_uid}/{series_uid}/")
+        self.assertTrue(series["ThumbnailKey"].endswith("/thumbnail.png"))
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["ThumbnailKey"], series["ThumbnailKey"])
+        thumbnail = boto3.client("s3", region_name="us-east-1").get_object(Bucket=S3_BUCKET, Key=series["ThumbnailKey"])
+        self.assertEqual(thumbnail["Body"].read()[:8], b"\x89PNG\r\n\x1a\n")
+
+    def test_background_render_gets_its_own_table(self):
+        submitted = []
+        with mock.patch("api.views.upload.submit_io", lambda func, *args, **kwargs: submitted.append((func, args, kwargs))):
+            files, study_uid, series_uid = make_dicom()
+            self.upload(files)
+
+        (func, args, kwargs), = submitted
+        self.assertIsInstance(args[0], str)
+        worker = threading.Thread(target=func, args=args, kwargs=kwargs)
+        worker.start()
+        worker.join()
+        self.assertIn("ThumbnailKey", self.record(f"{USER_ID}/P1/{study_uid}/{series_uid}/"))
+
+
+class PresignedUrlTests(MotoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch("api.views.presigned_urls.get_request_user_id", return_value=USER_ID)
+        patch.start()
+        self.addCleanup(patch.stop)
+        s3_service.clear_presigned_url_cache()
+        self.addCleanup(s3_service.clear_presigned_url_cache)
+
+    def get(self, **params):
+        from api.views.presigned_urls import get_presigned_urls
+        response = get_presigned_urls(self.factory.get("/api/presigned-urls", params, **AUTH_HEADER))
+        return response.status_code, json.loads(response.content)
+
+    def post(self, body):
+        from api.views.presigned_urls import get_presigned_urls
+        response = get_presigned_urls(self.factory.post("/api/presigned-urls", json.dumps(body), content_type="application/json", **AUTH_HEADER))
+        return response.status_code, json.loads(response.content)
+
+    def test_prefix_returns_every_instance_in_order(self):
+        files, study_uid, series_uid = make_dicom(count=4)
+        self.upload(files)
+        series_key = f"{USER_ID}/P1/{study_uid}/{series_uid}/"
+
+        status, body = self.get(prefix=series_key)
+
+        self.assertEqual(status, 200)
+        self.assertEqual([url["FileKey"] for url in body["Urls"]], [series_key + f.name for f in files])
+        for url in body["Urls"]:
+            self.assertIn(url["FileKey"], url["Url"])
+        # The study prefix covers the same instances
+        self.assertEqual(self.get(prefix=f"{USER_ID}/P1/{study_uid}/")[1]["Urls"], body["Urls"])
+
+    def test_key_list(self):
+        keys = [f"{USER_ID}/P1/study/series/{n}.dcm" for n in range(3)]
+        status, body = self.post({"keys": keys})
+        self.assertEqual(status, 200)
+        self.assertEqual([url["FileKey"] for url in body["Urls"]], keys)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get()[0], 400)
+        self.assertEqual(self.post({"keys": "not-a-list"})[0], 400)
+        self.assertEqual(self.post({"keys": [f"{USER_ID}/a.dcm", "someone-else/b.dcm"]})[0], 403)
+        self.assertEqual(self.get(prefix="someone-else/")[0], 403)
+        with mock.patch("api.views.presigned_urls.get_request_user_id", return_value=None):
+            self.assertEqual(self.get(prefix=f"{USER_ID}/")[0], 401)
+
+    def test_urls_are_reused_until_close_to_expiry(self):
+        key = f"{USER_ID}/P1/study/series/1.dcm"
+        now = time.time()
+        later = now + s3_service.PRESIGNED_GET_URL_EXPIRATION - s3_service.PRESIGNED_URL_MIN_REMAINING_SECONDS
+        client = s3_service.get_s3_client()
+        with mock.patch("api.services.s3_service.get_s3_client", return_value=client), \
+                mock.patch.object(client, "generate_presigned_url", wraps=client.generate_presigned_url) as sign:
+            for at in (now, now + 1, later - 1):
+                with mock.patch("api.services.s3_service.time.time", return_value=at):
+                    s3_service.presigned_get_url(key)
+            self.assertEqual(sign.call_count, 1)
+            with mock.patch("api.services.s3_service.time.time", return_value=later + 1):
+                s3_service.presigned_get_url(key)
+            self.assertEqual(sign.call_count, 2)
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(s3_service, "PRESIGNED_URL_CACHE_SIZE", 2):
+            s3_service.presigned_get_urls([f"{USER_ID}/{n}.dcm" for n in range(5)])
+        self.assertEqual([key[1] for key in s3_service._presigned_urls], [f"{USER_ID}/3.dcm", f"{USER_ID}/4.dcm"])
+
+
+class MetadataVersionTests(MotoTestCase):
+
+    def get(self, **headers):
+        from api.services.ddb_service import get_dicom_metadata
+        return get_dicom_metadata(self.factory.get("/api/get-dicom-metadata", {"userId": USER_ID, "recordType": "study"}, **headers))
+
+    def test_unchanged_data_is_not_modified(self):
+        self.upload(make_dicom()[0])
+        response = self.get()
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=f"W/{etag}").status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"something-else"').status_code, 200)
+
+    def test_uploads_and_deletes_change_the_etag(self):
+        files, study_uid, _ = make_dicom()
+        self.upload(files)
+        etag = self.get()["ETag"]
+
+        self.upload(make_dicom(patient_id="P2")[0])
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 2)
+
+        etag = response["ETag"]
+        self.delete(f"{USER_ID}/P1/{study_uid}/")
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 1)
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        self.upload(make_dicom()[0])
+        body = self.get().content
+
+        with mock.patch.object(ddb_service, "query_all_metadata", side_effect=AssertionError("queried")):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, body)
+
+    def test_reads_right_after_a_write_are_not_cached(self):
+        self.upload(make_dicom()[0])
+        with mock.patch.object(metadata_cache, "METADATA_SETTLE_SECONDS", 3600):
+            response = self.get()
+            self.assertFalse(response.has_header("ETag"))
+            with mock.patch.object(ddb_service, "query_all_metadata", wraps=ddb_service.query_all_metadata) as query:
+                self.get()
+            self.assertEqual(query.call_count, 1)
+
+
+class MetadataProjectionTests(MotoTestCase):
+
+    def get(self, **params):
+        from api.services.ddb_service import get_dicom_metadata
+        response = get_dicom_metadata(self.factory.get("/api/get-dicom-metadata", {"userId": USER_ID, **params}))
+        return response.status_code, json.loads(response.content)
+
+    def test_fields_limit_the_attributes(self):
+        self.upload(make_dicom(count=2)[0])
+
+        status, items = self.get(recordType="instance", fields="StudyDate,Modality")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(items), 2)
+        for item in items:
+            self.assertEqual(set(item), {"FileKey", "DataType", "00080020", "00080060"})
+            self.assertEqual(item["00080060"], "CT")
+
+    def test_thumbnail_url_projects_the_thumbnail_key(self):
+        self.upload(make_dicom()[0])
+        status, (study,) = self.get(recordType="study", fields="ThumbnailUrl")
+        self.assertEqual(status, 200)
+        self.assertEqual(set(study), {"FileKey", "DataType", "ThumbnailKey", "ThumbnailUrl"})
+
+    def test_unusable_fields_are_rejected(self):
+        for fields in (",", "Study Date", "a-b", ",".join(f"f{n}" for n in range(ddb_service.METADATA_MAX_FIELDS + 1))):
+            self.assertEqual(self.get(recordType="study", fields=fields)[0], 400, fields)
+
+
+class CompressionMiddlewareTests(SimpleTestCase):
+
+    def compress(self, response, **headers):
+        from core.compression import CompressionMiddleware
+        return CompressionMiddleware(lambda request: response)(RequestFactory().get("/", **headers))
+
+    def json_response(self, count=500):
+        return JsonResponse([{"FileKey": f"{USER_ID}/P1/study/{n}.dcm", "00080060": "CT"} for n in range(count)], safe=False)
+
+    def test_large_responses_are_gzipped(self):
+        original = self.json_response()
+        body = original.content
+        original["ETag"] = '"v1"'
+
+        response = self.compress(original, HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertLess(len(response.content), len(body) // 10)
+        self.assertEqual(gzip.decompress(response.content), body)
+        self.assertEqual(response["ETag"], 'W/"v1"')
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_responses_stay_as_they_are(self):
+        cases = (
+            (self.json_response(), {}),
+            (self.json_response(), {"HTTP_ACCEPT_ENCODING": "gzip;q=0"}),
+            (self.json_response(count=1), {"HTTP_ACCEPT_ENCODING": "gzip"}),
+            (HttpResponse(status=304), {"HTTP_ACCEPT_ENCODING": "gzip"}),
+        )
+        for original, headers in cases:
+            body = original.content
+            response = self.compress(original, **headers)
+            self.assertFalse(response.has_header("Content-Encoding"), headers)
+            self.assertEqual(response.content, body)
+
+    def test_streaming_responses_are_gzipped(self):
+        lines = [json.dumps({"FileKey": f"{USER_ID}/{n}.dcm"}) + "\n" for n in range(200)]
+        response = self.compress(StreamingHttpResponse(iter(lines)), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)).decode(), "".join(lines))
+
+    def test_async_streaming_responses_are_one_gzip_stream(self):
+        lines = [json.dumps({"FileKey": f"{USER_ID}/{n}.dcm"}) + "\n" for n in range(200)]
+
+        async def chunks():
+            for line in lines:
+                yield line
+
+        async def read(response):
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        response = self.compress(StreamingHttpResponse(chunks()), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(gzip.decompress(asyncio.run(read(response))).decode(), "".join(lines))
+
+
+class WorkspaceTests(MotoTestCase):
+
+    def get(self, **params):
+        from api.views.workspace import get_patient_workspace
+        response = get_patient_workspace(self.factory.get("/api/workspace", {"userId": USER_ID, **params}))
+        return response.status_code, json.loads(response.content)
+
+    def test_patient_tree_with_counts(self):
+        files, study_uid, series_uid = make_dicom(count=3)
+        self.upload(files)
+        other_series, _, other_series_uid = make_dicom(study_uid=study_uid, count=2)
+        self.upload(other_series)
+        second_study, second_study_uid, _ = make_dicom()
+        self.upload(second_study)
+        self.upload(make_dicom(patient_id="P2")[0])
+
+        status, tree = self.get(fileKey=f"{USER_ID}/P1/")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(tree["Patient"]["FileKey"], f"{USER_ID}/P1/")
+        studies = {study["FileKey"]: study for study in tree["Studies"]}
+        self.assertEqual(set(studies), {f"{USER_ID}/P1/{study_uid}/", f"{USER_ID}/P1/{second_study_uid}/"})
+        study = studies[f"{USER_ID}/P1/{study_uid}/"]
+        self.assertEqual(study["SOPInstanceCount"], 5)
+        self.assertEqual(study["SeriesInstanceCount"], 2)
+        self.assertEqual(
+            {series["FileKey"]: series["SOPInstanceCount"] for series in study["Series"]},
+            {f"{USER_ID}/P1/{study_uid}/{series_uid}/": 3, f"{USER_ID}/P1/{study_uid}/{other_series_uid}/": 2},
+        )
+        for series in study["Series"]:
+            self.assertNotIn("SOPInstanceUIDList", series)
+            self.assertNotIn("Instances", series)
+
+    def test_study_tree_with_instances(self):
+        files, study_uid, series_uid = make_dicom(count=3)
+        self.upload(files)
+
+        status, tree = self.get(fileKey=f"{USER_ID}/P1/{study_uid}/", instances="full")
+
+        self.assertEqual(status, 200)
+        self.assertIsNone(tree["Patient"])
+        (study,) = tree["Studies"]
+        (series,) = study["Series"]
+        self.assertEqual([instance["FileKey"] for instance in series["Instances"]], [f"{USER_ID}/P1/{study_uid}/{series_uid}/{f.name}" for f in files])
+
+    def test_unknown_key_is_an_empty_tree(self):
+        self.assertEqual(self.get(fileKey=f"{USER_ID}/nobody/"), (200, {"Patient": None, "Studies": []}))
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get()[0], 400)
+        self.assertEqual(self.get(fileKey="someone-else/P1/")[0], 400)
+        self.assertEqual(self.get(fileKey=f"{USER_ID}/P1/1.dcm")[0], 400)
+        self.assertEqual(self.get(fileKey=f"{USER_ID}/P1/", instances="all")[0], 400)
+
+
+class IndexedWorkspaceTests(IndexReadsMixin, WorkspaceTests):
+    pass
+
+
+class StudySearchTests(MotoTestCase):
+
+    def search(self, **params):
+        from api.views.search import search
+        response = search(self.factory.get("/api/search", {"userId": USER_ID, **params}))
+        return response.status_code, json.loads(response.content)
+
+    def found(self, **params):
+        status, body = self.search(**params)
+        self.assertEqual(status, 200)
+        return [item["FileKey"] for item in body["Items"]]
+
+    def upload_study(self, patient_id="P1", **attributes):
+        files, study_uid, _ = make_dicom(patient_id=patient_id, **attributes)
+        self.upload(files)
+        return f"{USER_ID}/{patient_id}/{study_uid}/"
+
+    def test_prefixes_of_every_token_match(self):
+        study = self.upload_study()
+        for q in ("doe", "jo do", "JOHN", "chest", "ct", "2025"):
+            self.assertEqual(self.found(q=q), [study], q)
+        self.assertEqual(self.found(q="doe jane"), [])
+
+    def test_leading_zeros_are_kept(self):
+        study = self.upload_study(patient_id="00123")
+        self.assertEqual(self.found(q="00123"), [study])
+        self.assertEqual(self.found(q="001"), [study])
+        self.assertEqual(self.found(q="123"), [])
+
+    def test_newest_studies_first_and_one_page_read(self):
+        studies = [self.upload_study(study_date=date) for date in ("20230101", "20250101", "20240101")]
+
+        table = get_dicom_table()
+        with mock.patch("api.services.search_service.get_dicom_table", return_value=table), \
+                mock.patch.object(table, "query", wraps=table.query) as query:
+            status, body = self.search(q="doe", limit=2)
+
+        self.assertEqual(status, 200)
+        self.assertEqual([item["FileKey"] for item in body["Items"]], [studies[1], studies[2]])
+        self.assertTrue(body["HasMore"])
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(query.call_args.kwargs["Limit"], 3)
+        self.assertFalse(query.call_args.kwargs["ScanIndexForward"])
+        self.assertEqual(self.found(q="doe", limit=3), [studies[1], studies[2], studies[0]])
+
+    def test_date_and_modality_filters(self):
+        old_ct = self.upload_study(study_date="20230101")
+        new_mr = self.upload_study(study_date="20250101", modality="MR")
+        new_ct = self.upload_study(study_date="20250102")
+
+        self.assertEqual(self.found(q="doe", dateFrom="20240101"), [new_ct, new_mr])
+        self.assertEqual(self.found(q="doe", dateTo="20250101"), [new_mr, old_ct])
+        self.assertEqual(self.found(modality="CT"), [new_ct, old_ct])
+        self.assertEqual(self.found(dateFrom="20250101", dateTo="20250101"), [new_mr])
+        self.assertEqual(self.search(dateFrom="2025")[0], 400)
+
+    def test_deleted_studies_leave_no_entries(self):
+        study = self.upload_study(patient_id="00123")
+        self.delete(study)
+
+        self.assertEqual(self.found(q="doe"), [])
+        entries = self.table.query(KeyConditionExpression=Key("UserId").eq(USER_ID) & Key("FileKey").begins_with("#search#"))["Items"]
+        self.assertEqual(entries, [])
+
+    def test_rebuild_recreates_the_index(self):
+        from api.services.search_service import rebuild_search_index
+        study = self.upload_study(patient_id="00123")
+        legacy = self.upload_study(patient_id="0456")
+        # Records from before the raw copy of the search fields: the PatientID comes from the key
+        self.table.update_item(Key={"UserId": USER_ID, "FileKey": legacy}, UpdateExpression="REMOVE SearchFields")
+        for entry in self.table.query(KeyConditionExpression=Key("UserId").eq(USER_ID) & Key("FileKey").begins_with("#search#"))["Items"]:
+            self.table.delete_item(Key={"UserId": USER_ID, "FileKey": entry["FileKey"]})
+
+        self.assertEqual(rebuild_search_index(USER_ID), 2)
+        self.assertEqual(self.found(q="00123"), [study])
+        self.assertEqual(self.found(q="0456"), [legacy])
+
+
+class UploadDuplicateTests(MotoTestCase):
+
+    def stats_instances(self):
+        return self.stats()["totalInstances"]
+
+    def test_same_content_is_skipped(self):
+        files, study_uid, _ = make_dicom(count=2)
+        status, body = self.upload(files)
+        self.assertEqual(status, 200)
+        self.assertEqual(body["skippedCount"], 0)
+
+        status, body = self.upload(files)
+        self.assertEqual(status, 200)
+        self.assertEqual(body["skippedCount"], 2)
+        study = self.record(f"{USER_ID}/P1/{study_uid}/")
+        self.assertEqual(study["NumberOfInstances"], 2)
+        self.assertEqual(study["TotalStudySizeBytes"], sum(f.size for f in files))
+        self.assertEqual(self.stats_instances(), 2)
+
+    def test_different_content_is_not_overwritten(self):
+        files, study_uid, series_uid = make_dicom()
+        self.upload(files)
+        sop_uid = files[0].name[:-len(".dcm")]
+
+        changed, _, _ = make_dicom(study_uid=study_uid, series_uid=series_uid, sop_uid=sop_uid, pixel_offset=1)
+        status, body = self.upload(changed)
+
+        self.assertEqual(status, 502)
+        self.assertEqual(len(body["failedFiles"]), 1)
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["NumberOfInstances"], 1)
+
+    def test_lookup_reads_only_the_uploaded_keys(self):
+        files, study_uid, series_uid = make_dicom(count=5)
+        self.upload(files)
+        more, _, _ = make_dicom(study_uid=study_uid, series_uid=series_uid)
+
+        with mock.patch("api.services.dicom_service.batch_get_items", wraps=ddb_service.batch_get_items) as batch_get:
+            status, body = self.upload(more + files[:1])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["skippedCount"], 1)
+        series_prefix = f"{USER_ID}/P1/{study_uid}/{series_uid}/"
+        self.assertEqual(
+            sorted(key["FileKey"] for call in batch_get.call_args_list for key in call.args[1]),
+            sorted([series_prefix + more[0].name, series_prefix + files[0].name]),
+        )
+
+    def test_sizes_are_not_counted_twice_without_the_lookup(self):
+        files, study_uid, series_uid = make_dicom(count=2)
+        self.upload(files)
+        with mock.patch("api.services.upload_handler.DICOM_UPLOAD_DEDUP_ENABLED", False):
+            status, body = self.upload(files)
+
+        self.assertEqual(status, 200)
+        size = sum(f.size for f in files)
+        for file_key in (f"{USER_ID}/P1/{study_uid}/{series_uid}/", f"{USER_ID}/P1/{study_uid}/"):
+            record = self.record(file_key)
+            self.assertEqual((record["NumberOfInstances"], record["TotalStudySizeBytes"]), (2, size), file_key)
+        self.assertEqual(self.stats_instances(), 2)
+
+    def test_reingested_objects_are_not_counted_twice(self):
+        from api.services.ingest_service import ingest_s3_objects
+        files, study_uid, _ = make_dicom(count=2)
+        s3 = boto3.client("s3", region_name="us-east-1")
+
+        def ingest():
+            objects = []
+            for n, f in enumerate(files):
+                key = f"incoming/{USER_ID}/upload/{n:05d}-{f.name}"
+                s3.put_object(Bucket=S3_BUCKET, Key=key, Body=f.file.getvalue())
+                objects.append({"bucket": S3_BUCKET, "key": key, "size": f.size})
+            return ingest_s3_objects(objects)
+
+        ingest()
+        # As if the lookup had missed them: the rollups still don't count them again
+        with mock.patch("api.services.ingest_service.already_stored_keys", return_value=set()):
+            self.assertEqual(len(ingest()["Ingested"]), 2)
+
+        study = self.record(f"{USER_ID}/P1/{study_uid}/")
+        self.assertEqual((study["NumberOfInstances"], study["TotalStudySizeBytes"]), (2, sum(f.size for f in files)))
+
+
+class UploadSessionTests(MotoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch("api.views.upload_sessions.get_request_user_id", return_value=USER_ID)
+        patch.start()
+        self.addCleanup(patch.stop)
+        from api.views.upload_sessions import upload_sessions
+        self.session_id = json.loads(upload_sessions(self.factory.post("/api/upload-sessions", **AUTH_HEADER)).content)["sessionId"]
+
+    def send_batch(self, batch_id, files):
+        from api.views.upload_sessions import upload_session_batch
+        for f in files:
+            f.seek(0)
+        response = upload_session_batch(self.factory.post("/x", {"files": files}, **AUTH_HEADER), self.session_id, batch_id)
+        return response.status_code, json.loads(response.content)
+
+    def commit(self):
+        from api.views.upload_sessions import commit_upload_session
+        response = commit_upload_session(self.factory.post("/x", **AUTH_HEADER), self.session_id)
+        return response.status_code, json.loads(response.content)
+
+    def test_replayed_batch_counts_once(self):
+        files, study_uid, series_uid = make_dicom(count=4)
+
+        status, first = self.send_batch("b1", files[:2])
+        self.assertEqual(status, 200)
+        self.assertFalse(first.get("replayed"))
+        status, replay = self.send_batch("b1", files[:2])
+        self.assertEqual(status, 200)
+        self.assertTrue(replay["replayed"])
+        self.send_batch("b2", files[2:])
+
+        status, body = self.commit()
+        self.assertEqual(status, 200)
+        study = self.record(f"{USER_ID}/P1/{study_uid}/")
+        series = self.record(f"{USER_ID}/P1/{study_uid}/{series_uid}/")
+        self.assertEqual(study["NumberOfInstances"], 4)
+        self.assertEqual(series["NumberOfInstances"], 4)
+        self.assertEqual(study["TotalStudySizeBytes"], sum(f.size for f in files))
+
+    def test_commit_is_idempotent(self):
+        files, study_uid, _ = make_dicom(count=3)
+        self.send_batch("b1", files)
+
+        status, first = self.commit()
+        self.assertEqual(status, 200)
+        status, again = self.commit()
+        self.assertEqual(status, 200)
+        self.assertEqual(again, first)
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/")["NumberOfInstances"], 3)
+        self.assertEqual(self.stats()["totalInstances"], 3)
+
+    def send_late_batch(self, batch_id, files):
+        # The batch got past the open check before the commit closed the session
+        with mock.patch("api.views.upload_sessions.require_open_session"):
+            return self.send_batch(batch_id, files)
+
+    def test_batch_after_the_commit_is_rolled_up(self):
+        files, study_uid, series_uid = make_dicom(count=2)
+        late, _, late_series_uid = make_dicom(study_uid=study_uid)
+        self.send_batch("b1", files)
+        self.commit()
+
+        status, body = self.send_late_batch("b2", late)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(body["acknowledged"])
+        self.assertEqual(self.record(f"{USER_ID}/P1/{study_uid}/{late_series_uid}/")["NumberOfInstances"], 1)
+        study = self.record(f"{USER_ID}/P1/{study_uid}/")
+        self.assertEqual(study["NumberOfInstances"], 3)
+        self.assertEqual(study["TotalStudySizeBytes"], sum(f.size for f in files + late))
+        self.assertEqual(self.stats()["totalInstances"], 3)
+        # A retry is replayed
+        self.assertTrue(self.send_late_batch("b2", late)[1]["replayed"])
+
+    def test_batch_during_the_commit_counts_once(self):
+        from api.services.upload_session_service import session_key
+        files, study_uid, series_uid = make_dicom(count=3)
+        self.send_batch("b1", files[:2])
+        get_dicom_table().update_item(
+            Key=session_key(USER_ID, self.session_id), UpdateExpression="SET #status = :committing",
+            ExpressionAttributeNames={"#status": "Status"}, ExpressionAttributeValues={":committing": "committing"},
+        )
+
+        # Rolled up by the batch, then read back again by the commit
+        self.assertEqual(self.send_late_batch("b2", files[2:])[0], 200)
+        status, body = self.commit()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["result"]["instanceCount"], 3)
+        for file_key in (f"{USER_ID}/P1/{study_uid}/{series_uid}/", f"{USER_ID}/P1/{study_uid}/"):
+            record = self.record(file_key)
+            self.assertEqual((record["NumberOfInstances"], record["TotalStudySizeBytes"]), (3, sum(f.size for f in files)), file_key)
+        self.assertEqual(self.stats()["totalInstances"], 3)
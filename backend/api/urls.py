@@ -1,10 +1,35 @@
+from django.conf import settings
 from django.urls import path
 from django.http import JsonResponse
 from api.views import upload_dicom
 from api.services import get_dicom_metadata
 from api.views import delete_data_by_file_key
 from api.views import print_something
+from api.views import create_direct_upload, complete_direct_upload
+from api.views import get_presigned_urls, get_presigned_urls_async
+from api.views import get_patient_workspace, get_patient_workspace_async
+from api.views import search, search_async
+from api.views import upload_sessions, upload_session, upload_session_batch, commit_upload_session
+from api.views import upload_sessions_async, upload_session_async, upload_session_batch_async, commit_upload_session_async
 from api.services import get_stats
+from api.views import upload_dicom_async, delete_data_by_file_key_async
+from api.services import get_dicom_metadata_async, get_stats_async
+from api.services import metrics_view
+
+# Under an ASGI server the I/O-bound endpoints are served by their async versions, which hand the AWS calls to a
+# bounded thread pool instead of holding a worker for the whole request
+if settings.ASYNC_VIEWS:
+    upload_dicom = upload_dicom_async
+    get_dicom_metadata = get_dicom_metadata_async
+    delete_data_by_file_key = delete_data_by_file_key_async
+    get_stats = get_stats_async
+    get_presigned_urls = get_presigned_urls_async
+    get_patient_workspace = get_patient_workspace_async
+    search = search_async
+    upload_sessions = upload_sessions_async
+    upload_session = upload_session_async
+    upload_session_batch = upload_session_batch_async
+    commit_upload_session = commit_upload_session_async
 
 def api_only_root(request):
     return JsonResponse({"message": "Backend API is running."})
@@ -15,6 +40,16 @@ urlpatterns = [
     path("delete-data-by-file-key", delete_data_by_file_key, name="delete-data-by-file-key"),
     path("print-something", print_something, name="print-something"),
     path("stats", get_stats, name="stats"),
+    path("direct-upload", create_direct_upload, name="direct-upload"),
+    path("direct-upload/complete", complete_direct_upload, name="direct-upload-complete"),
+    path("presigned-urls", get_presigned_urls, name="presigned-urls"),
+    path("patient-workspace", get_patient_workspace, name="patient-workspace"),
+    path("search", search, name="search"),
+    path("upload-sessions", upload_sessions, name="upload-sessions"),
+    path("upload-sessions/<str:session_id>", upload_session, name="upload-session"),
+    path("upload-sessions/<str:session_id>/batches/<str:batch_id>", upload_session_batch, name="upload-session-batch"),
+    path("upload-sessions/<str:session_id>/commit", commit_upload_session, name="upload-session-commit"),
+    path("metrics", metrics_view, name="metrics"),
     path("", api_only_root)
 ]
 
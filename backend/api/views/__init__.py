@@ -1,3 +1,11 @@
-from .delete import delete_data_by_file_key
-from .upload import upload_dicom
-from .print_something import print_something
\ No newline at end of file
+from .delete import delete_data_by_file_key, delete_data_by_file_key_async
+from .upload import upload_dicom, upload_dicom_async
+from .print_something import print_something
+from .direct_upload import create_direct_upload, complete_direct_upload
+from .presigned_urls import get_presigned_urls, get_presigned_urls_async
+from .workspace import get_patient_workspace, get_patient_workspace_async
+from .search import search, search_async
+from .upload_sessions import (
+    upload_sessions, upload_session, upload_session_batch, commit_upload_session,
+    upload_sessions_async, upload_session_async, upload_session_batch_async, commit_upload_session_async
+)
@@ -1,58 +1,186 @@
+import logging
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import boto3
 import os
-from api.services import get_dynamodb_resource, get_s3_client
+from decimal import Decimal
+from api.services import get_dicom_table, get_s3_client, record_deletion_in_stats, batch_write_requests, iter_query_pages, run_io, timed, inc_counter
+from api.services.metadata_cache import bump_data_version
+from api.services.search_service import unindex_studies, SEARCH_FIELDS, SEARCH_FIELDS_ATTRIBUTE
+from api.services.dicom_service import DICOM_TAGS
+from api.services.ingest_service import remove_instance_from_rollups, remove_series_from_rollups, remove_study_from_patient
+from api.services.upload_session_service import INSTANCE_SIZE_ATTRIBUTE
+
+logger = logging.getLogger(__name__)
 
 S3_BUCKET = os.getenv("AWS_STORAGE_BUCKET_NAME", "yantra-healthcare-imaging")
 S3_REGION = os.getenv("AWS_S3_REGION", "us-east-1")
 
+# delete_objects takes at most 1000 keys per call
+S3_DELETE_BATCH_SIZE = 1000
+S3_DELETE_CONCURRENCY = int(os.getenv("S3_DELETE_CONCURRENCY", "4"))
+
+# Placeholders for the search fields of study records (stored under their tags, which start with a digit, and as
+# raw strings on newer records)
+SEARCH_PROJECTION = {f"#s{i}": DICOM_TAGS[field] for i, field in enumerate(SEARCH_FIELDS)}
+SEARCH_PROJECTION["#sf"] = SEARCH_FIELDS_ATTRIBUTE
+
+def get_record(user_id, file_key):
+    return get_dicom_table().get_item(Key={'UserId': user_id, 'FileKey': file_key}).get("Item")
+
+def delete_records_under_prefix(user_id, file_key):
+    """Delete every record under file_key (the record itself included). Returns (records, failed_record_keys)"""
+    dicom_data_table = get_dicom_table()
+
+    # Only the records under the prefix are read, and only the attributes the delete, the stats update and the
+    # search index need (a study's index entries are keyed on its searchable fields)
+    query_kwargs = {
+        "KeyConditionExpression": boto3.dynamodb.conditions.Key("UserId").eq(user_id) & boto3.dynamodb.conditions.Key("FileKey").begins_with(file_key),
+        "ProjectionExpression": ", ".join(["#uid, #fk, #dt, #size, #ts, #n", *SEARCH_PROJECTION]),
+        "ExpressionAttributeNames": {
+            "#uid": "UserId", "#fk": "FileKey", "#dt": "DataType",
+            "#size": "TotalStudySizeBytes", "#ts": "UploadTimestamp", "#n": "NumberOfInstances",
+            **SEARCH_PROJECTION,
+        }
+    }
+    records = []
+    for page_items in iter_query_pages(dicom_data_table, query_kwargs):
+        records.extend(page_items)
+
+    delete_requests = [{"DeleteRequest": {"Key": {"UserId": record["UserId"], "FileKey": record["FileKey"]}}} for record in records]
+    write_summary = batch_write_requests(dicom_data_table.name, delete_requests)
+    failed_record_keys = [request["DeleteRequest"]["Key"]["FileKey"] for request in write_summary["FailedRequests"]]
+    if records:
+        failed_record_key_set = set(failed_record_keys)
+        unindex_studies(dicom_data_table, user_id, [
+            record for record in records if record.get("DataType") == "study" and record["FileKey"] not in failed_record_key_set
+        ])
+        bump_data_version(dicom_data_table, user_id)
+    return records, failed_record_keys
+
+def remove_deleted_from_rollups(user_id, deleted_item, records, failed_record_keys, object_sizes):
+    """
+    Take what was removed out of the parent series/study/patient records and the user's stats aggregate, counting
+    instances and bytes through the rollups like a stats rebuild does. Returns the records that are gone.
+    """
+    failed_record_key_set = set(failed_record_keys)
+    deleted_records = [record for record in records if record["FileKey"] not in failed_record_key_set]
+    inc_counter("dicom_deleted_records_total", len(deleted_records))
+    if deleted_item["FileKey"] in failed_record_key_set:
+        # The record asked for is still there, so are its totals
+        return deleted_records
+
+    table = get_dicom_table()
+    deleted_studies = [record for record in deleted_records if record.get("DataType") == "study"]
+    deleted_instances = sum(int(study.get("NumberOfInstances", 0)) for study in deleted_studies)
+    deleted_size_bytes = sum(Decimal(str(study.get("TotalStudySizeBytes", 0))) for study in deleted_studies)
+    shrunk_study = None
+    try:
+        data_type = deleted_item.get("DataType")
+        if data_type == "study":
+            remove_study_from_patient(table, user_id, deleted_item["FileKey"])
+        elif data_type == "series":
+            shrunk_study = remove_series_from_rollups(table, user_id, deleted_item)
+            if shrunk_study:
+                deleted_instances = int(deleted_item.get("NumberOfInstances", 0))
+                deleted_size_bytes = Decimal(str(deleted_item.get("TotalStudySizeBytes", 0)))
+        elif data_type == "instance":
+            size_bytes = object_sizes.get(deleted_item["FileKey"], deleted_item.get(INSTANCE_SIZE_ATTRIBUTE, 0))
+            shrunk_study = remove_instance_from_rollups(table, user_id, deleted_item["FileKey"], deleted_item.get(DICOM_TAGS["SOPInstanceUID"]), size_bytes)
+            if shrunk_study:
+                deleted_instances = 1
+                deleted_size_bytes = Decimal(str(size_bytes))
+    except Exception as e:
+        logger.exception("Failed to update the rollups of %s: %s", deleted_item["FileKey"], e)
+        return deleted_records
+
+    try:
+        if deleted_instances or deleted_studies:
+            record_deletion_in_stats(user_id, deleted_instances, deleted_size_bytes, deleted_studies, shrunk_study)
+    except Exception as e:
+        logger.exception("Failed to update the stats aggregate: %s", e)
+    return deleted_records
+
+def timed_call(phase, func, *args):
+    """func(*args) recorded as a delete phase, for the parts that run on another thread"""
+    with timed("delete_data_by_file_key", phase):
+        return func(*args)
+
+def delete_response(deleted_item, file_key, deleted_records, failed_record_keys, deleted_s3_keys, failed_s3_deletes):
+    response = {
+        "Patient": deleted_item.get("PatientName", "Unknown"),
+        "DeletedInstanceCount": sum(1 for record in deleted_records if record["FileKey"] != file_key),
+        "DeletedS3Files": deleted_s3_keys,
+        "S3FilesDeleted": bool(deleted_s3_keys)  # helpful boolean if frontend still wants it
+    }
+    if failed_record_keys or failed_s3_deletes:
+        # Reported so the caller can retry instead of silently leaving orphans behind
+        response["FailedRecordDeletes"] = failed_record_keys
+        response["FailedS3Deletes"] = failed_s3_deletes
+        return JsonResponse(response, status=207)
+
+    return JsonResponse(response, status=200)
+
 @csrf_exempt
 def delete_data_by_file_key(request):
     file_key = request.GET.get("fileKey")
     user_id = request.GET.get("userId")
 
-    print(f"[DEBUG] FileKey received: {file_key}")
+    logger.debug("Delete requested for %s", file_key)
 
-    try:
-        dynamodb_resource = get_dynamodb_resource()
-        dicom_data_table = dynamodb_resource.Table("dicomFileMetadataTable")
+    if not file_key or not user_id:
+        return JsonResponse({"error": "Missing required parameters: userId and/or fileKey"}, status=400)
 
-        # Delete the main study record
-        response = dicom_data_table.delete_item(
-            Key={'UserId': user_id, 'FileKey': file_key},
-            ReturnValues="ALL_OLD"
-        )
-        deleted_item = response.get("Attributes", {})
+    try:
+        # The record the user asked to delete (patient, study, series or instance)
+        with timed("delete_data_by_file_key", "lookup"):
+            deleted_item = get_record(user_id, file_key)
         if not deleted_item:
             return JsonResponse({"error": "No matching record found in DynamoDB."}, status=404)
 
-        deleted_patient_name = deleted_item.get("PatientName", "Unknown")
+        with ThreadPoolExecutor(max_workers=1) as s3_executor:
+            # S3 objects are removed in the background while the DynamoDB records are deleted below
+            s3_future = s3_executor.submit(timed_call, "s3_delete", delete_s3_prefix, file_key)
+            with timed("delete_data_by_file_key", "dynamodb_delete"):
+                records, failed_record_keys = delete_records_under_prefix(user_id, file_key)
+            deleted_s3_keys, failed_s3_deletes, object_sizes = s3_future.result()
 
-        # Delete all child files under that prefix
-        items = dicom_data_table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key("UserId").eq(user_id)
-        )["Items"]
+        with timed("delete_data_by_file_key", "stats_update"):
+            deleted_records = remove_deleted_from_rollups(user_id, deleted_item, records, failed_record_keys, object_sizes)
+        return delete_response(deleted_item, file_key, deleted_records, failed_record_keys, deleted_s3_keys, failed_s3_deletes)
 
-        deleted_count = 0
-        for item in items:
-            if item["FileKey"].startswith(file_key):
-                dicom_data_table.delete_item(
-                    Key={"UserId": item["UserId"], "FileKey": item["FileKey"]}
-                )
-                deleted_count += 1
+    except Exception as e:
+        logger.exception("Failed to delete DICOM data: %s", e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
+
+@csrf_exempt
+async def delete_data_by_file_key_async(request):
+    """delete_data_by_file_key for the ASGI server, S3 and DynamoDB deletes run side by side on the I/O threads"""
+    file_key = request.GET.get("fileKey")
+    user_id = request.GET.get("userId")
 
-        deleted_s3_keys = delete_s3_prefix(file_key)
+    if not file_key or not user_id:
+        return JsonResponse({"error": "Missing required parameters: userId and/or fileKey"}, status=400)
 
-        return JsonResponse({
-            "Patient": deleted_patient_name,
-            "DeletedInstanceCount": deleted_count,
-            "DeletedS3Files": deleted_s3_keys,
-            "S3FilesDeleted": bool(deleted_s3_keys)  # helpful boolean if frontend still wants it
-        }, status=200)
+    try:
+        with timed("delete_data_by_file_key", "lookup"):
+            deleted_item = await run_io(get_record, user_id, file_key)
+        if not deleted_item:
+            return JsonResponse({"error": "No matching record found in DynamoDB."}, status=404)
+
+        (deleted_s3_keys, failed_s3_deletes, object_sizes), (records, failed_record_keys) = await asyncio.gather(
+            run_io(timed_call, "s3_delete", delete_s3_prefix, file_key),
+            run_io(timed_call, "dynamodb_delete", delete_records_under_prefix, user_id, file_key),
+        )
+
+        with timed("delete_data_by_file_key", "stats_update"):
+            deleted_records = await run_io(remove_deleted_from_rollups, user_id, deleted_item, records, failed_record_keys, object_sizes)
+        return delete_response(deleted_item, file_key, deleted_records, failed_record_keys, deleted_s3_keys, failed_s3_deletes)
 
     except Exception as e:
-        print(f"[ERROR] Failed to delete DICOM data: {str(e)}")
+        logger.exception("Failed to delete DICOM data: %s", e)
         return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
 
 def delete_file_from_s3(file_key):
@@ -60,15 +188,48 @@ def delete_file_from_s3(file_key):
     response = s3_client.delete_object(Bucket=S3_BUCKET, Key=file_key)
     return response.get('ResponseMetadata', {})
 
+def delete_s3_keys(s3_client, keys):
+    """Delete up to 1000 keys with one delete_objects call, returns (deleted_keys, per-key errors)"""
+    try:
+        response = s3_client.delete_objects(
+            Bucket=S3_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+    except Exception as e:
+        return [], [{"Key": key, "Code": "RequestFailed", "Message": str(e)} for key in keys]
+
+    # In quiet mode only the failures are listed
+    errors = [
+        {"Key": error.get("Key"), "Code": error.get("Code"), "Message": error.get("Message")}
+        for error in response.get("Errors", [])
+    ]
+    failed_keys = {error["Key"] for error in errors}
+    return [key for key in keys if key not in failed_keys], errors
+
 def delete_s3_prefix(prefix):
+    """
+    Delete every object under a prefix in 1000-key chunks, several chunks at a time.
+    Returns (deleted_keys, errors, {key: size} of the objects listed).
+    """
     s3_client = get_s3_client()
     paginator = s3_client.get_paginator('list_objects_v2')
     pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
 
     deleted_keys = []
-    for page in pages:
-        for obj in page.get('Contents', []):
-            s3_client.delete_object(Bucket=S3_BUCKET, Key=obj['Key'])
-            deleted_keys.append(obj['Key'])
+    errors = []
+    object_sizes = {}
+    with ThreadPoolExecutor(max_workers=S3_DELETE_CONCURRENCY) as executor:
+        # Chunks start deleting while the listing is still being paged through
+        futures = []
+        for page in pages:
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            object_sizes.update((obj['Key'], obj['Size']) for obj in page.get('Contents', []))
+            for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+                futures.append(executor.submit(delete_s3_keys, s3_client, keys[i:i + S3_DELETE_BATCH_SIZE]))
+
+        for future in futures:
+            chunk_deleted, chunk_errors = future.result()
+            deleted_keys.extend(chunk_deleted)
+            errors.extend(chunk_errors)
 
-    return deleted_keys
+    return deleted_keys, errors, object_sizes
@@ -0,0 +1,116 @@
+import logging
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+import json
+import uuid
+from api.services import (
+    get_request_user_id, direct_upload_staging_key, user_id_from_staging_key, generate_presigned_put_url,
+    create_presigned_multipart_upload, complete_multipart_upload, abort_multipart_upload
+)
+from api.services.s3_service import DIRECT_UPLOAD_MULTIPART_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+# Files go from the browser straight to a staging prefix in S3 with presigned URLs, so the API never carries the
+# bytes. The ingest worker (manage.py ingest_s3_events) picks them up from the bucket's ObjectCreated events.
+
+MAX_DIRECT_UPLOAD_FILES = 1000
+
+def _read_json(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+
+def _file_entry_error(index, file_info):
+    """Why a "files" entry can't be used, None if it can"""
+    if not isinstance(file_info, dict):
+        return f"files[{index}] must be an object with a name and a size"
+    name = file_info.get("name")
+    if not isinstance(name, str) or not name:
+        return f"files[{index}].name must be a non-empty string"
+    size = file_info.get("size")
+    # bool is an int too
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return f"files[{index}].size must be a non-negative integer (bytes)"
+    return None
+
+@csrf_exempt
+def create_direct_upload(request):
+    """
+    POST {"files": [{"name": ..., "size": ...}]}
+    Returns one presigned PUT URL per file, or presigned part URLs for files above the multipart threshold.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    user_id = get_request_user_id(request)
+    if not user_id:
+        return JsonResponse({"error": "Missing or invalid Authorization header"}, status=401)
+
+    body = _read_json(request)
+    files = body.get("files") if isinstance(body, dict) else None
+    if not files or not isinstance(files, list):
+        return JsonResponse({"error": "Request body must list the files to upload"}, status=400)
+    if len(files) > MAX_DIRECT_UPLOAD_FILES:
+        return JsonResponse({"error": f"At most {MAX_DIRECT_UPLOAD_FILES} files per upload"}, status=400)
+    for index, file_info in enumerate(files):
+        error = _file_entry_error(index, file_info)
+        if error:
+            return JsonResponse({"error": error}, status=400)
+
+    try:
+        upload_id = uuid.uuid4().hex
+        uploads = []
+        for index, file_info in enumerate(files):
+            name = file_info["name"]
+            size = file_info["size"]
+            key = direct_upload_staging_key(user_id, upload_id, index, name)
+
+            if size >= DIRECT_UPLOAD_MULTIPART_THRESHOLD:
+                uploads.append({"name": name, "key": key, "multipart": create_presigned_multipart_upload(key, size)})
+            else:
+                uploads.append({"name": name, "key": key, "url": generate_presigned_put_url(key)})
+
+        return JsonResponse({"uploadId": upload_id, "files": uploads})
+    except Exception as e:
+        logger.exception("Failed to create direct upload: %s", e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
+
+@csrf_exempt
+def complete_direct_upload(request):
+    """
+    POST {"key": ..., "uploadId": ..., "parts": [{"PartNumber": ..., "ETag": ...}]} finishes a multipart upload,
+    {"key": ..., "uploadId": ..., "abort": true} gives up on it.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    user_id = get_request_user_id(request)
+    if not user_id:
+        return JsonResponse({"error": "Missing or invalid Authorization header"}, status=401)
+
+    body = _read_json(request)
+    if not isinstance(body, dict) or not body.get("key") or not body.get("uploadId"):
+        return JsonResponse({"error": "Missing required fields: key and/or uploadId"}, status=400)
+
+    key = body["key"]
+    # Users can only finish uploads into their own staging area
+    if user_id_from_staging_key(key) != user_id:
+        return JsonResponse({"error": "Forbidden"}, status=403)
+
+    try:
+        if body.get("abort"):
+            abort_multipart_upload(key, body["uploadId"])
+            return JsonResponse({"key": key, "aborted": True})
+
+        parts = body.get("parts")
+        if not parts:
+            return JsonResponse({"error": "Missing required field: parts"}, status=400)
+        if not isinstance(parts, list) or not all(isinstance(part, dict) for part in parts):
+            return JsonResponse({"error": "parts must be a list of {PartNumber, ETag} objects"}, status=400)
+        complete_multipart_upload(key, body["uploadId"], parts)
+        return JsonResponse({"key": key, "completed": True})
+    except Exception as e:
+        logger.exception("Failed to complete direct upload %s: %s", key, e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
@@ -0,0 +1,115 @@
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from api.services import get_request_user_id, get_dicom_table, build_metadata_query, iter_query_pages, run_io
+from api.services.s3_service import presigned_get_urls, PRESIGNED_URL_MIN_REMAINING_SECONDS
+from api.services.dicom_service import DICOM_TAGS
+
+logger = logging.getLogger(__name__)
+
+# Signed GET URLs for every instance of a series or study (or for a list of keys) in one request, so a viewer
+# doesn't make one round-trip per slice.
+
+PRESIGN_BATCH_MAX_KEYS = 10000
+INSTANCE_NUMBER_ATTRIBUTE = DICOM_TAGS["InstanceNumber"]
+
+def _read_json(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+
+def _instance_number(item):
+    try:
+        return Decimal(str(item.get(INSTANCE_NUMBER_ATTRIBUTE, "")))
+    except InvalidOperation:
+        return Decimal(0)
+
+def instance_keys_under_prefix(user_id, prefix):
+    """FileKeys of the instances under a prefix, in InstanceNumber order"""
+    query_kwargs = build_metadata_query(user_id, "instance", prefix)
+    query_kwargs["ProjectionExpression"] = "#file_key, #instance_number"
+    query_kwargs["ExpressionAttributeNames"] = {"#file_key": "FileKey", "#instance_number": INSTANCE_NUMBER_ATTRIBUTE}
+
+    items = []
+    for page_items in iter_query_pages(get_dicom_table(), query_kwargs):
+        items.extend(page_items)
+        if len(items) > PRESIGN_BATCH_MAX_KEYS:
+            break
+    items.sort(key=lambda item: (_instance_number(item), item["FileKey"]))
+    return [item["FileKey"] for item in items]
+
+def parse_presign_request(request, user_id):
+    """({"prefix": ...} or {"keys": [...]}, None), or (None, error response)"""
+    if request.method == "GET":
+        body = {"prefix": request.GET.get("prefix")}
+    elif request.method == "POST":
+        body = _read_json(request)
+    else:
+        return None, JsonResponse({"error": "Method not allowed"}, status=405)
+
+    if not isinstance(body, dict) or not (body.get("prefix") or body.get("keys")):
+        return None, JsonResponse({"error": "Pass a series/study prefix or a list of keys"}, status=400)
+
+    keys = body.get("keys")
+    if keys is not None and (not isinstance(keys, list) or not all(isinstance(key, str) for key in keys)):
+        return None, JsonResponse({"error": "keys must be a list of strings"}, status=400)
+    if keys is not None and len(keys) > PRESIGN_BATCH_MAX_KEYS:
+        return None, JsonResponse({"error": f"At most {PRESIGN_BATCH_MAX_KEYS} keys per request"}, status=400)
+
+    # Users can only sign their own objects
+    own_prefix = f"{user_id}/"
+    if any(not key.startswith(own_prefix) for key in (keys or [body["prefix"]])):
+        return None, JsonResponse({"error": "Forbidden"}, status=403)
+    return {"prefix": body.get("prefix"), "keys": keys}, None
+
+def presigned_urls_response(keys):
+    if len(keys) > PRESIGN_BATCH_MAX_KEYS:
+        return JsonResponse({"error": f"More than {PRESIGN_BATCH_MAX_KEYS} instances, ask for a series at a time"}, status=400)
+    urls = presigned_get_urls(keys)
+    return JsonResponse({
+        "Urls": [{"FileKey": key, "Url": urls[key]} for key in keys],
+        # Cached URLs are reused, but never with less time left than this
+        "MinValidSeconds": PRESIGNED_URL_MIN_REMAINING_SECONDS,
+    })
+
+@csrf_exempt
+def get_presigned_urls(request):
+    """
+    GET ?prefix=<series or study FileKey>, POST {"prefix": ...} or POST {"keys": [...]}
+    Returns {"Urls": [{"FileKey", "Url"}, ...]}, instances of a prefix in InstanceNumber order.
+    """
+    user_id = get_request_user_id(request)
+    if not user_id:
+        return JsonResponse({"error": "Missing or invalid Authorization header"}, status=401)
+
+    params, error_response = parse_presign_request(request, user_id)
+    if error_response:
+        return error_response
+
+    try:
+        keys = params["keys"] if params["keys"] is not None else instance_keys_under_prefix(user_id, params["prefix"])
+        return presigned_urls_response(keys)
+    except Exception as e:
+        logger.exception("Failed to presign URLs: %s", e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
+
+@csrf_exempt
+async def get_presigned_urls_async(request):
+    """get_presigned_urls for the ASGI server, the token check and the DynamoDB query run on the I/O threads"""
+    user_id = await run_io(get_request_user_id, request)
+    if not user_id:
+        return JsonResponse({"error": "Missing or invalid Authorization header"}, status=401)
+
+    params, error_response = parse_presign_request(request, user_id)
+    if error_response:
+        return error_response
+
+    try:
+        keys = params["keys"] if params["keys"] is not None else await run_io(instance_keys_under_prefix, user_id, params["prefix"])
+        return presigned_urls_response(keys)
+    except Exception as e:
+        logger.exception("Failed to presign URLs: %s", e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
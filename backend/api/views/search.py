@@ -0,0 +1,76 @@
+import logging
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from api.services import get_dicom_table, data_version_state, run_io
+from api.services.search_service import search_studies, parse_search_request
+from api.services.metadata_cache import (
+    get_data_version_state, metadata_etag, etag_matches, not_modified_response, with_validators, cached_body, cache_body
+)
+
+logger = logging.getLogger(__name__)
+
+def parse_request(request):
+    """(user_id, search kwargs, None), or (None, None, error response)"""
+    user_id = request.GET.get("userId")
+    if not user_id:
+        return None, None, JsonResponse({"error": "Missing required parameter: userId"}, status=400)
+    try:
+        return user_id, parse_search_request(request), None
+    except ValueError as e:
+        return None, None, JsonResponse({"error": str(e)}, status=400)
+
+def search_response(results, has_more):
+    return JsonResponse({"Items": results, "HasMore": has_more})
+
+@csrf_exempt
+def search(request):
+    """
+    GET ?userId=...&q=<text>[&modality=CT,MR][&dateFrom=YYYYMMDD][&dateTo=YYYYMMDD][&limit=50]
+    Studies whose patient name/ID, accession number, description, modality or date have tokens starting with
+    every word of q, as {"Items": [{"FileKey", "PatientKey", "PatientName", ...}], "HasMore": bool}.
+    """
+    user_id, search_kwargs, error_response = parse_request(request)
+    if error_response:
+        return error_response
+
+    try:
+        # Results only change when the user's data does, same validators as the metadata reads
+        version, settled = get_data_version_state(get_dicom_table(), user_id)
+        etag = metadata_etag(user_id, version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        body = cached_body(etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        response = search_response(*search_studies(user_id, **search_kwargs))
+        cache_body(etag, response.content)
+        return with_validators(response, etag)
+
+    except Exception as e:
+        logger.exception("Search failed: %s", e)
+        return JsonResponse({"error": f"Search failed: {str(e)}"}, status=500)
+
+@csrf_exempt
+async def search_async(request):
+    """search for the ASGI server, the DynamoDB calls run on the I/O threads"""
+    user_id, search_kwargs, error_response = parse_request(request)
+    if error_response:
+        return error_response
+
+    try:
+        version, settled = await run_io(data_version_state, user_id)
+        etag = metadata_etag(user_id, version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        body = await run_io(cached_body, etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        response = search_response(*await run_io(search_studies, user_id, **search_kwargs))
+        await run_io(cache_body, etag, response.content)
+        return with_validators(response, etag)
+
+    except Exception as e:
+        logger.exception("Search failed: %s", e)
+        return JsonResponse({"error": f"Search failed: {str(e)}"}, status=500)
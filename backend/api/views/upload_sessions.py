@@ -0,0 +1,172 @@
+import logging
+import os
+from datetime import datetime
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from api.services import get_request_user_id, batch_put_items, get_dicom_table, S3StreamingUploadHandler, run_io, timed, inc_counter
+from api.services.dicom_service import get_dicom_value, build_base_metadata, build_instance_metadata
+from api.services.metadata_cache import bump_data_version
+from api.services.upload_session_service import (
+    UploadSessionError, UPLOAD_SESSION_ID_ATTRIBUTE, INSTANCE_SIZE_ATTRIBUTE, create_session, load_session,
+    require_open_session, bind_study, get_batch_ack, acknowledge_batch, session_progress, commit_session,
+    is_valid_batch_id
+)
+
+logger = logging.getLogger(__name__)
+
+# Upload sessions, for studies too big to go through upload_dicom in one request:
+#   POST /api/upload-sessions                                  open a session
+#   POST /api/upload-sessions/<id>/batches/<batch id>          files=... (any order, retries are replayed)
+#   GET  /api/upload-sessions/<id>                             progress, which batches were acknowledged
+#   POST /api/upload-sessions/<id>/commit                      write the series/study/patient records
+# A batch is only acknowledged once every file in it is stored; a batch with failed files is simply sent again
+# (under the same id), the files it already stored are recognized and not transferred a second time.
+
+def _error_response(e):
+    return JsonResponse({"error": str(e)}, status=e.status)
+
+def open_session(request, user_id):
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    return JsonResponse(session_progress(create_session(user_id)), status=201)
+
+def show_session(request, user_id, session_id):
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    session = load_session(user_id, session_id)
+    if session is None:
+        return JsonResponse({"error": "No such upload session"}, status=404)
+    return JsonResponse(session_progress(session))
+
+def finish_session(request, user_id, session_id):
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    with timed("upload_session_commit", "rollup"):
+        return JsonResponse(commit_session(user_id, session_id))
+
+def store_batch(request, user_id, session_id, batch_id):
+    """Stream one batch of files to S3 and write their instance records, like store_upload without the rollups"""
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    if not is_valid_batch_id(batch_id):
+        return JsonResponse({"error": "Batch ids are 1-64 letters, digits, '-' or '_'"}, status=400)
+
+    require_open_session(user_id, session_id)
+    # Checked before the body is read: an acknowledged batch costs no transfer the second time
+    ack = get_batch_ack(user_id, session_id, batch_id)
+    if ack is not None:
+        return JsonResponse({**ack, "replayed": True})
+
+    handler = S3StreamingUploadHandler(request, user_id, os.environ.get("AWS_STORAGE_BUCKET_NAME"))
+    request.upload_handlers = [handler]
+    try:
+        with timed("upload_session_batch", "parse"):
+            files = request.FILES.getlist("files")
+        if not files:
+            return JsonResponse({"error": "No DICOM files uploaded"}, status=400)
+        for f in files:
+            if f.dataset is None:
+                return JsonResponse({"error": f"{f.name} could not be read as DICOM: {f.error}"}, status=400)
+
+        # Series may differ from file to file, the study may not
+        studies = {(get_dicom_value(f.dataset, "PatientID"), get_dicom_value(f.dataset, "StudyInstanceUID")) for f in files}
+        if len(studies) != 1:
+            return JsonResponse({"error": "All files of a batch must belong to the same patient and study"}, status=400)
+        bind_study(user_id, session_id, *studies.pop())
+
+        with timed("upload_session_batch", "s3_transfer"):
+            handler.complete(files)
+
+        timestamp = datetime.utcnow().isoformat()
+        base_metadata = build_base_metadata(files[0].dataset, user_id, timestamp)
+        failed_files = []
+        new_files = []
+        items = []
+        total_size_bytes = 0
+        for f in files:
+            if f.error:
+                failed_files.append({"file": f.name, "FileKey": f.s3_key, "error": f.error})
+            elif not f.duplicate:
+                total_size_bytes += f.size
+                item = build_instance_metadata(f.dataset, base_metadata, f.s3_key, f.has_pixel_data, total_size_bytes, content_sha256=f.content_sha256)
+                item[UPLOAD_SESSION_ID_ATTRIBUTE] = session_id
+                item[INSTANCE_SIZE_ATTRIBUTE] = f.size
+                items.append(item)
+                new_files.append(f)
+
+        with timed("upload_session_batch", "dynamodb_write"):
+            write_summary = batch_put_items(get_dicom_table().name, items)
+        if items:
+            # The instance records are readable right away, cached metadata reads mustn't hide them until the commit
+            bump_data_version(get_dicom_table(), user_id)
+        unwritten_keys = {request["PutRequest"]["Item"]["FileKey"] for request in write_summary["FailedRequests"]}
+        for f in new_files:
+            if f.s3_key in unwritten_keys:
+                failed_files.append({"file": f.name, "FileKey": f.s3_key, "error": "Metadata could not be written to DynamoDB"})
+        stored = [f for f in new_files if f.s3_key not in unwritten_keys]
+        stored_bytes = sum(f.size for f in stored)
+        stored_items = [item for item in items if item["FileKey"] not in unwritten_keys]
+
+        inc_counter("dicom_uploaded_instances_total", len(stored))
+        inc_counter("dicom_uploaded_bytes_total", stored_bytes)
+        response = {
+            "sessionId": session_id,
+            "batchId": batch_id,
+            "storedCount": len(stored),
+            "skippedCount": sum(1 for f in files if f.duplicate),
+        }
+        if failed_files:
+            inc_counter("dicom_failed_instances_total", len(failed_files))
+            return JsonResponse({**response, "acknowledged": False, "failedFiles": failed_files}, status=207)
+
+        return JsonResponse(acknowledge_batch(user_id, session_id, batch_id, {**response, "acknowledged": True}, stored_items, stored_bytes))
+    finally:
+        handler.close()
+
+def _run(view, request, *args):
+    user_id = get_request_user_id(request)
+    if not user_id:
+        return JsonResponse({"error": "Missing or invalid Authorization header"}, status=401)
+    try:
+        return view(request, user_id, *args)
+    except UploadSessionError as e:
+        return _error_response(e)
+    except Exception as e:
+        logger.exception("Upload session request failed: %s", e)
+        return JsonResponse({"error": f"Internal server error: {str(e)}"}, status=500)
+
+async def _run_async(view, request, *args):
+    # Token check and the whole request (S3 streaming included) run on the I/O threads
+    return await run_io(_run, view, request, *args)
+
+@csrf_exempt
+def upload_sessions(request):
+    return _run(open_session, request)
+
+@csrf_exempt
+def upload_session(request, session_id):
+    return _run(show_session, request, session_id)
+
+@csrf_exempt
+def upload_session_batch(request, session_id, batch_id):
+    return _run(store_batch, request, session_id, batch_id)
+
+@csrf_exempt
+def commit_upload_session(request, session_id):
+    return _run(finish_session, request, session_id)
+
+@csrf_exempt
+async def upload_sessions_async(request):
+    return await _run_async(open_session, request)
+
+@csrf_exempt
+async def upload_session_async(request, session_id):
+    return await _run_async(show_session, request, session_id)
+
+@csrf_exempt
+async def upload_session_batch_async(request, session_id, batch_id):
+    return await _run_async(store_batch, request, session_id, batch_id)
+
+@csrf_exempt
+async def commit_upload_session_async(request, session_id):
+    return await _run_async(finish_session, request, session_id)
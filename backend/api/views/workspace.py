@@ -0,0 +1,162 @@
+import logging
+from decimal import Decimal, InvalidOperation
+from boto3.dynamodb.conditions import Key
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from api.services import get_dicom_table, data_version_state, iter_query_pages, build_metadata_query, run_io, timed
+from api.services.ddb_service import DynamoJSONEncoder
+from api.services.dicom_service import DICOM_TAGS
+from api.services.thumbnail_service import add_thumbnail_urls
+from api.services.metadata_cache import (
+    get_data_version_state, metadata_etag, etag_matches, not_modified_response, with_validators, cached_body, cache_body
+)
+
+logger = logging.getLogger(__name__)
+
+# Everything the patient details page shows, as one patient -> studies -> series tree. The root record is one
+# GetItem, its studies and series one record type index query each (instance records, most of a big patient's
+# items, are never read for a summary). With instances, all records share the root's FileKey prefix and the whole
+# tree is one begins_with query on the user's partition.
+
+WORKSPACE_INSTANCE_MODES = ("summary", "full")
+SERIES_NUMBER_ATTRIBUTE = DICOM_TAGS["SeriesNumber"]
+INSTANCE_NUMBER_ATTRIBUTE = DICOM_TAGS["InstanceNumber"]
+# Per-instance UID sets on the rollups, replaced by their counts in summaries
+ROLLUP_UID_LISTS = ("SOPInstanceUIDList", "SeriesInstanceUIDList")
+
+def _number(item, attribute):
+    try:
+        return Decimal(str(item.get(attribute, "")))
+    except InvalidOperation:
+        return Decimal(0)
+
+def parent_file_key(file_key):
+    """<user>/<patient>/<study>/ -> <user>/<patient>/, .../<series>/<sop>.dcm -> .../<series>/"""
+    return file_key.rstrip("/").rsplit("/", 1)[0] + "/"
+
+def parse_workspace_request(request):
+    """(params, None), or (None, error response)"""
+    user_id = request.GET.get("userId")
+    file_key = request.GET.get("fileKey", "")
+    instances = request.GET.get("instances", "summary")
+
+    if not user_id or not file_key:
+        return None, JsonResponse({"error": "Missing required parameters: userId and/or fileKey"}, status=400)
+    # A patient (<user>/<patient>/) or study (<user>/<patient>/<study>/) key of this user. Patient IDs may contain
+    # "/", so which one it is comes from the record itself (query_workspace_records)
+    if not file_key.startswith(f"{user_id}/") or not file_key.endswith("/") or len(file_key) <= len(user_id) + 2:
+        return None, JsonResponse({"error": "fileKey must be a patient or study key"}, status=400)
+    if instances not in WORKSPACE_INSTANCE_MODES:
+        return None, JsonResponse({"error": f"instances must be one of {', '.join(WORKSPACE_INSTANCE_MODES)}"}, status=400)
+    return {"user_id": user_id, "file_key": file_key, "instances": instances}, None
+
+def query_workspace_records(user_id, file_key, include_instances):
+    """The patient or study record at file_key and every record below it (instances only if asked for)"""
+    table = get_dicom_table()
+    items = []
+    with timed("patient_workspace", "query"):
+        root = table.get_item(Key={"UserId": user_id, "FileKey": file_key}).get("Item")
+        if root is None or root.get("DataType") not in ("patient", "study"):
+            return []
+
+        if include_instances:
+            query_kwargs = {"KeyConditionExpression": Key("UserId").eq(user_id) & Key("FileKey").begins_with(file_key)}
+            for page_items in iter_query_pages(table, query_kwargs):
+                items.extend(page_items)
+        else:
+            items.append(root)
+            record_types = ("study", "series") if root["DataType"] == "patient" else ("series",)
+            for record_type in record_types:
+                for page_items in iter_query_pages(table, build_metadata_query(user_id, record_type, file_key)):
+                    items.extend(page_items)
+    return add_thumbnail_urls(items)
+
+def build_workspace_tree(items, include_instances):
+    """{"Patient": record or None (study keys), "Studies": [study with "Series": [series with "Instances"?]]}"""
+    by_type = {"patient": [], "study": [], "series": [], "instance": []}
+    for item in items:
+        if item.get("DataType") in by_type:
+            by_type[item["DataType"]].append(item)
+
+    studies = {study["FileKey"]: {**study, "Series": []} for study in by_type["study"]}
+    series_by_key = {}
+    for series in sorted(by_type["series"], key=lambda s: (_number(s, SERIES_NUMBER_ATTRIBUTE), s["FileKey"])):
+        series = {**series, "Instances": []} if include_instances else dict(series)
+        study = studies.get(parent_file_key(series["FileKey"]))
+        if study is None:
+            logger.warning("Series record %s has no study record", series["FileKey"])
+            continue
+        study["Series"].append(series)
+        series_by_key[series["FileKey"]] = series
+
+    if include_instances:
+        for instance in sorted(by_type["instance"], key=lambda i: (_number(i, INSTANCE_NUMBER_ATTRIBUTE), i["FileKey"])):
+            series = series_by_key.get(parent_file_key(instance["FileKey"]))
+            if series is not None:
+                series["Instances"].append(instance)
+    else:
+        for record in (*studies.values(), *series_by_key.values()):
+            for attribute in ROLLUP_UID_LISTS:
+                if attribute in record:
+                    record[attribute.replace("UIDList", "Count")] = len(record.pop(attribute))
+
+    return {
+        "Patient": by_type["patient"][0] if by_type["patient"] else None,
+        "Studies": list(studies.values()),
+    }
+
+@csrf_exempt
+def get_patient_workspace(request):
+    """
+    GET ?userId=...&fileKey=<patient or study key>[&instances=summary|full]
+    The patient record and its studies, each with its series. instances=full nests the instance records under
+    their series (InstanceNumber order); the default summary gives counts instead.
+    """
+    try:
+        params, error_response = parse_workspace_request(request)
+        if error_response:
+            return error_response
+
+        version, settled = get_data_version_state(get_dicom_table(), params["user_id"])
+        etag = metadata_etag(params["user_id"], version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        body = cached_body(etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        include_instances = params["instances"] == "full"
+        items = query_workspace_records(params["user_id"], params["file_key"], include_instances)
+        response = JsonResponse(build_workspace_tree(items, include_instances), encoder=DynamoJSONEncoder)
+        cache_body(etag, response.content)
+        return with_validators(response, etag)
+
+    except Exception as e:
+        logger.exception("Failed to get the patient workspace: %s", e)
+        return JsonResponse({"error": f"Failed to get the patient workspace: {str(e)}"}, status=500)
+
+@csrf_exempt
+async def get_patient_workspace_async(request):
+    """get_patient_workspace for the ASGI server, the DynamoDB calls run on the I/O threads"""
+    try:
+        params, error_response = parse_workspace_request(request)
+        if error_response:
+            return error_response
+
+        version, settled = await run_io(data_version_state, params["user_id"])
+        etag = metadata_etag(params["user_id"], version, request, settled)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        body = await run_io(cached_body, etag)
+        if body is not None:
+            return with_validators(HttpResponse(body, content_type="application/json"), etag)
+
+        include_instances = params["instances"] == "full"
+        items = await run_io(query_workspace_records, params["user_id"], params["file_key"], include_instances)
+        response = JsonResponse(build_workspace_tree(items, include_instances), encoder=DynamoJSONEncoder)
+        await run_io(cache_body, etag, response.content)
+        return with_validators(response, etag)
+
+    except Exception as e:
+        logger.exception("Failed to get the patient workspace: %s", e)
+        return JsonResponse({"error": f"Failed to get the patient workspace: {str(e)}"}, status=500)
@@ -0,0 +1,83 @@
+import os
+import zlib
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+# Brotli is optional (pip install brotli): without it everything is gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this go out as they are, compressing them saves less than it costs
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))  # 11 is the max, but far too slow to do per request
+# Same BREACH mitigation as Django's GZipMiddleware (random bytes in the gzip header)
+GZIP_MAX_RANDOM_BYTES = 100
+
+
+def _accepted_encodings(request):
+    encodings = set()
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+async def _agzip_sequence(chunks):
+    # One gzip stream for the whole response (Django's async path compresses every chunk on its own, which for
+    # one-record NDJSON lines is barely smaller than not compressing at all)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Brotli or gzip for responses above COMPRESSION_MIN_BYTES, depending on Accept-Encoding. Streaming responses are
+    gzipped as they are written.
+    """
+
+    def process_response(self, request, response):
+        if response.has_header("Content-Encoding") or response.status_code == 304:
+            return response
+        if not response.streaming and len(response.content) < COMPRESSION_MIN_BYTES:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encodings = _accepted_encodings(request)
+
+        if response.streaming:
+            if "gzip" not in encodings:
+                return response
+            if response.is_async:
+                response.streaming_content = _agzip_sequence(response.streaming_content)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content, max_random_bytes=GZIP_MAX_RANDOM_BYTES)
+            del response.headers["Content-Length"]
+            encoding = "gzip"
+        else:
+            if brotli is not None and "br" in encodings:
+                compressed, encoding = brotli.compress(response.content, quality=BROTLI_QUALITY), "br"
+            elif "gzip" in encodings:
+                compressed, encoding = compress_string(response.content, max_random_bytes=GZIP_MAX_RANDOM_BYTES), "gzip"
+            else:
+                return response
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers["Content-Length"] = str(len(compressed))
+
+        # The compressed body isn't byte-identical to the one the ETag was computed for (RFC 9110 8.8.1)
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import contextvars
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# JSON-lines logging for the API. Every line carries the id of the request that produced it, messages are only
+# formatted when a handler actually writes them (use logger.debug("... %s", value), not f-strings), and
+# high-volume per-instance events can be sampled.
+
+# Share of records logged with extra={"sampled": True} that are written (1 = all, 0 = none)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has, anything else on a record came in through extra={...}
+_STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id", "sampled"}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through only LOG_SAMPLE_RATE of the records marked with extra={"sampled": True}"""
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < LOG_SAMPLE_RATE
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        # default=str: Decimals, datasets and whatever else ends up in extra shouldn't break logging
+        return json.dumps(entry, default=str)
+
+
+class RequestIdMiddleware:
+    """
+    Tags everything logged while handling a request with its id: the caller's X-Request-ID (e.g. from the load
+    balancer) or a fresh one. The id is echoed back in the response.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self, request):
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        return request_id, request_id_var.set(request_id)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_id, token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_id_var.reset(token)
+        response[REQUEST_ID_HEADER] = request_id
+        return response
+
+    async def __acall__(self, request):
+        request_id, token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_id_var.reset(token)
+        response[REQUEST_ID_HEADER] = request_id
+        return response
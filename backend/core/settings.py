@@ -62,6 +62,21 @@ AWS_S3_CUSTOM_DOMAIN = f"https://{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com"
 
 DATA_UPLOAD_MAX_NUMBER_FILES = 10000
 
+# "asgi" when the container runs uvicorn (see the Dockerfile), which also switches the API to its async views
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS", "1" if SERVER_MODE == "asgi" else "0") == "1"
+
+# Holds cached get_dicom_metadata responses. Local memory is per worker process; point CACHE_BACKEND/CACHE_LOCATION
+# at a shared cache (e.g. django.core.cache.backends.redis.RedisCache + redis://..., needs the redis package) to
+# share them between workers.
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", "metadata"),
+        "TIMEOUT": 300,
+    }
+}
+
 
 # Application definition
 
@@ -79,6 +94,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.logging_utils.RequestIdMiddleware",  # first, so everything below logs with the request id
+    "api.services.metrics.RequestMetricsMiddleware",
+    "core.compression.CompressionMiddleware",  # br/gzip for large JSON responses (brotli needs the brotli package)
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -91,6 +109,34 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "core.urls"
 
+# JSON lines on stdout (what CloudWatch picks up). LOG_LEVEL=DEBUG turns on the per-record metadata dumps,
+# LOG_SAMPLE_RATE controls how many per-instance events are written.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "request_id": {"()": "core.logging_utils.RequestIdFilter"},
+        "sampling": {"()": "core.logging_utils.SamplingFilter"},
+    },
+    "formatters": {
+        "json": {"()": "core.logging_utils.JsonFormatter"},
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "json",
+            "filters": ["request_id", "sampling"],
+        },
+    },
+    "root": {"handlers": ["console"], "level": "WARNING"},
+    "loggers": {
+        "api": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": False},
+        "django": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
 # Template files are html files. Static files are anything else, including css and js.
 TEMPLATES = [
     {
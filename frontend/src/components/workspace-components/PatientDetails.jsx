@@ -87,7 +87,8 @@ const PatientDetails = () => {
     const fetchStudyData = async () => {
       try {
         console.log("🌐 Fetching study data from API...");
-        const response = await fetch(`${API_BASE_URL}/api/get-dicom-metadata?userId=${userId}&recordType=study&fileKey=${fileKey}`, {
+        // Studies with their series in one request
+        const response = await fetch(`${API_BASE_URL}/api/patient-workspace?userId=${userId}&fileKey=${encodeURIComponent(fileKey)}`, {
           method: 'GET',
           headers: {
             'Content-Type': 'application/json'
@@ -98,8 +99,11 @@ const PatientDetails = () => {
           throw new Error(`HTTP error! Status: ${response.status}`);
         }
 
-        const preliminaryStudyData = await response.json();
-        const named = getNamedData(preliminaryStudyData);
+        const workspace = await response.json();
+        const named = getNamedData(workspace.Studies).map((study) => ({
+          ...study,
+          Series: getNamedData(study.Series || []),
+        }));
 
         console.log("✅ API data fetched and transformed:", named);
 
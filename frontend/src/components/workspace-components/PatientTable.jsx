@@ -48,6 +48,7 @@ import { setSnackbar } from '../../redux/slices/snackbarSlice';
 // util imports
 import { handleDicomDataFetching } from './table-utils';
 import { handleDicomDelete } from './table-utils';
+import { handleStudySearch } from './table-utils';
 import DeleteDialog from './table-utils/DeleteDialog';
 import { formatName, formatDate, formatAge } from './table-utils';
 // auth imports
@@ -121,6 +122,8 @@ function PatientTable() {
   const [dataExists, setDataExists] = useState(false);
   const [loading, setLoading] = useState(true);
   const [searchTerm, setSearchTerm] = useState('');
+  // PatientKeys of the studies the server found for searchTerm, null while there is no server result
+  const [searchMatches, setSearchMatches] = useState(null);
   const [filterAnchorEl, setFilterAnchorEl] = useState(null);
   const [activeFilters, setActiveFilters] = useState([]);
   const [sortConfig, setSortConfig] = useState({ key: null, direction: 'asc' });
@@ -288,14 +291,40 @@ function PatientTable() {
     fetchData();
   }, [dicomDataRefresh, userId, dispatch]);
 
+  // Search on the server (debounced), the rows are only the patients; matching is done over their studies
+  useEffect(() => {
+    if (!userId || searchTerm.trim() === '') {
+      setSearchMatches(null);
+      return;
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const result = await handleStudySearch(userId, searchTerm, controller.signal);
+        setSearchMatches(new Set(result.Items.map((item) => item.PatientKey)));
+      } catch (error) {
+        if (error.name !== 'AbortError') {
+          console.error("Search failed, filtering locally:", error);
+          setSearchMatches(null);
+        }
+      }
+    }, 250);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [searchTerm, userId]);
+
   // Filter and sort data
   const filteredAndSortedData = React.useMemo(() => {
     // First, filter the data
     let filteredData = [...rows].filter(row => {
       // Apply search term filter
-      const matchesSearch = Object.values(row).some(
-        value => value && value.toString().toLowerCase().includes(searchTerm.toLowerCase())
-      );
+      const matchesSearch = searchMatches
+        ? searchMatches.has(row.FileKey)
+        : Object.values(row).some(
+          value => value && value.toString().toLowerCase().includes(searchTerm.toLowerCase())
+        );
       
       // Apply active filters
       const matchesFilters = activeFilters.length === 0 || 
@@ -332,7 +361,7 @@ function PatientTable() {
     }
     
     return filteredData;
-  }, [rows, searchTerm, activeFilters, sortConfig]);
+  }, [rows, searchTerm, searchMatches, activeFilters, sortConfig]);
 
   // Get unique modalities for filter menu
   const uniqueModalities = React.useMemo(() => {
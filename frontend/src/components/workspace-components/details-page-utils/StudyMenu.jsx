@@ -326,6 +326,17 @@ export default function StudyMenu({ study }) {
                 alignItems: "center",
                 }}
               >
+                <Box sx={{ display: "flex", alignItems: "center", gap: 2 }}>
+                {/* Rendered at upload, a few KB instead of the study's DICOMs */}
+                {study["ThumbnailUrl"] && (
+                  <Box
+                  component="img"
+                  src={study["ThumbnailUrl"]}
+                  alt="Study preview"
+                  loading="lazy"
+                  sx={{ width: 64, height: 64, objectFit: "contain", bgcolor: "black", borderRadius: 2 }}
+                  />
+                )}
                 <Box>
                 <Typography variant="h6" color="black">
                   {formatDate(study["StudyDate"]) || "Unknown Date"}
@@ -334,6 +345,7 @@ export default function StudyMenu({ study }) {
                   {study["StudyTime"] || "Unknown Time"}
                 </Typography>
                 </Box>
+                </Box>
 
                 {/* Buttons */}
                 <Stack direction="row" sx={{ spacing: { xs: 2, sm: 1 } }} mt={3}>
@@ -406,11 +418,11 @@ export default function StudyMenu({ study }) {
                   />
                   <LabelValueRow
                     label="# Of Series:"
-                    value={study?.SeriesInstanceUIDList?.length || 0}
+                    value={study?.SeriesInstanceCount ?? study?.SeriesInstanceUIDList?.length ?? 0}
                   />
                   <LabelValueRow
                     label="# Of Instances:"
-                    value={study?.SOPInstanceUIDList?.length || 0}
+                    value={study?.SOPInstanceCount ?? study?.SOPInstanceUIDList?.length ?? 0}
                   />
                   </Grid>
                 </Grid>
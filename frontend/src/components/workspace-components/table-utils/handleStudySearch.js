@@ -0,0 +1,20 @@
+const API_BASE_URL = import.meta.env.VITE_API_URL || "http://localhost:8000";
+
+// Server-side search over the user's studies (patient name/ID, accession number, description, modality, date)
+const handleStudySearch = async (userId, searchTerm, signal) => {
+    const params = new URLSearchParams({ userId, q: searchTerm, limit: "200" });
+    const response = await fetch(`${API_BASE_URL}/api/search?${params}`, {
+      method: 'GET',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      signal
+    });
+
+    if (!response.ok) {
+      throw new Error(`HTTP error! Status: ${response.status}`);
+    }
+    return response.json();
+  };
+
+export default handleStudySearch;
@@ -1,5 +1,6 @@
 export { default as handleDicomDataFetching } from './handleDicomDataFetching';
 export { default as handleDicomDelete } from './handleDicomDelete';
+export { default as handleStudySearch } from './handleStudySearch';
 export {formatName, formatDate, formatAge} from './formatHelpers'
 export { default as UploadButton } from './UploadButton';
 export { default as removeLSItemsByPrefix } from './removeLSItemsByPrefix';
\ No newline at end of file
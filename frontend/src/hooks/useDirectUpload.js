@@ -0,0 +1,130 @@
+import { useState } from 'react';
+import { useDispatch } from 'react-redux';
+import { triggerRefresh } from '../redux/slices/dicomDataSlice';
+import { setSnackbar } from '../redux/slices/snackbarSlice';
+import { useAuthCustom } from './useAuthCustom';
+import { removeLSItemsByPrefix } from '../components/workspace-components/table-utils';
+
+// Same interface as useFileUpload, but the files go straight to S3 with presigned URLs
+// instead of through /api/upload-dicom. The backend ingests them from the bucket's events.
+const PARALLEL_UPLOADS = 6;
+
+const putToS3 = async (url, body) => {
+  const response = await fetch(url, { method: "PUT", body, headers: { "Content-Type": "application/dicom" } });
+  if (!response.ok) throw new Error(`S3 upload failed (${response.status})`);
+  return response.headers.get("ETag");
+};
+
+export const useDirectUpload = () => {
+  const [uploading, setUploading] = useState(false);
+  const [uploadingStudy, setUploadingStudy] = useState(false);
+  const auth = useAuthCustom();
+  const dispatch = useDispatch();
+
+  const API_BASE_URL = import.meta.env.VITE_API_URL || "http://localhost:8000";
+
+  const uploadMultipart = async (file, target, token) => {
+    const { uploadId, partSize, partUrls } = target.multipart;
+    try {
+      const parts = [];
+      for (let i = 0; i < partUrls.length; i++) {
+        const etag = await putToS3(partUrls[i], file.slice(i * partSize, (i + 1) * partSize));
+        parts.push({ PartNumber: i + 1, ETag: etag });
+      }
+
+      const response = await fetch(`${API_BASE_URL}/api/direct-upload/complete`, {
+        method: "POST",
+        headers: { Authorization: `Bearer ${token}`, "Content-Type": "application/json" },
+        body: JSON.stringify({ key: target.key, uploadId, parts }),
+      });
+      if (!response.ok) throw new Error((await response.json()).error || "Upload failed");
+    } catch (error) {
+      // Don't leave half-finished uploads (and their storage) behind
+      await fetch(`${API_BASE_URL}/api/direct-upload/complete`, {
+        method: "POST",
+        headers: { Authorization: `Bearer ${token}`, "Content-Type": "application/json" },
+        body: JSON.stringify({ key: target.key, uploadId, abort: true }),
+      }).catch(() => {});
+      throw error;
+    }
+  };
+
+  const handleDicomUpload = async (filesArray, isStudy = false) => {
+    if (!filesArray || filesArray.length === 0) {
+      dispatch(setSnackbar({
+        open: true,
+        message: "Please select a file or folder!",
+        severity: "error"
+      }));
+      return;
+    }
+
+    try {
+      const token = auth.tokens?.access_token;
+      if (!token) throw new Error("User is not authenticated");
+
+      if (isStudy) {
+        setUploadingStudy(true);
+      } else {
+        setUploading(true);
+      }
+
+      const files = Array.from(filesArray);
+      const response = await fetch(`${API_BASE_URL}/api/direct-upload`, {
+        method: "POST",
+        headers: {
+          Authorization: `Bearer ${token}`,
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ files: files.map((file) => ({ name: file.name, size: file.size })) }),
+      });
+      const result = await response.json();
+      if (!response.ok) throw new Error(result.error || "Upload failed");
+
+      // A few files in flight at a time
+      let next = 0;
+      const worker = async () => {
+        while (next < files.length) {
+          const index = next++;
+          const target = result.files[index];
+          if (target.multipart) {
+            await uploadMultipart(files[index], target, token);
+          } else {
+            await putToS3(target.url, files[index]);
+          }
+        }
+      };
+      await Promise.all(Array.from({ length: Math.min(PARALLEL_UPLOADS, files.length) }, worker));
+
+      dispatch(setSnackbar({
+        open: true,
+        message: "Upload complete, the study will show up once it has been processed",
+        severity: "success"
+      }));
+
+      removeLSItemsByPrefix("patientData");
+      removeLSItemsByPrefix("statsData");
+      removeLSItemsByPrefix("studyData");
+
+      // Ingestion runs asynchronously, give it a moment before refreshing
+      setTimeout(() => dispatch(triggerRefresh()), 3000);
+
+    } catch (error) {
+      dispatch(setSnackbar({
+        open: true,
+        message: error.message,
+        severity: "error"
+      }));
+    } finally {
+      setUploading(false);
+      setUploadingStudy(false);
+    }
+  };
+
+  return {
+    handleDicomUpload,
+    uploading,
+    uploadingStudy,
+    isUploading: uploading || uploadingStudy
+  };
+};